@@ -0,0 +1,354 @@
+"""
+Routine Convert - admission control
+
+
+Summary
+-------
+Several encodes at once keep a machine busy, but a few x265 "Very Slow" Blu-Ray encodes side by side can run it out
+of memory, or fill the output disk halfway through.  Before a job is started, its memory and the size of its output
+are estimated from the probe (resolution, duration, bit rate) and its preset.  It's only started if it fits: in the
+memory available, in the free space of the disks it writes to, and in the cores left over by the jobs already
+running.  Otherwise it waits for a job to finish (or for memory to free up).  A job is always started when nothing
+else is running, however big it is.
+
+Memory already taken by running jobs shows up as memory no longer available, so only what they're still expected to
+take on top is held back for them (on Linux, where a process' memory can be read).  The same goes for disk space and
+the partial files jobs are writing (see staging.py).
+
+Each encode can also be run at a lower priority (niceness), and pinned to its own share of the cores (see
+tune_process - whether or not admission control is on).
+
+
+Description
+--------
+available_memory (function):        memory available to new processes
+estimate_memory (function):         memory a job is expected to need
+estimate_output_bytes (function):   size of the file a job is expected to make
+tune_process (function):            lowers the priority of an encode, and pins it to its share of the cores
+Claim (object):                     what a job is expected to take: memory, disk space, cores
+AdmissionController (object):       starts jobs only when they fit
+"""
+import ctypes
+import os
+import shutil
+import threading
+
+import decisions as dc
+import staging as stg
+import settings as st
+
+
+# Rough MB of memory per megapixel of output frame, for x265 at each encoder speed (slower speeds look further ahead,
+# and keep more reference frames)
+_MEMORY_MB_PER_MEGAPIXEL = {
+    'ultrafast': 150,
+    'superfast': 200,
+    'veryfast': 250,
+    'faster': 300,
+    'fast': 400,
+    'medium': 500,
+    'slow': 700,
+    'slower': 900,
+    'veryslow': 1100,
+    'placebo': 1400,
+}
+
+# How much less memory other encoders need than x265, by the start of their name
+_ENCODER_MEMORY_FACTORS = {
+    'x264': 0.5,
+    'svt_av1': 1.0,
+    # Hardware encoders keep their frames on the GPU
+    'nvenc': 0.25,
+    'qsv': 0.25,
+    'vce': 0.25,
+    'vt': 0.25,
+    'mf': 0.25,
+}
+
+
+def available_memory():
+    """
+    :return: (int or None) bytes of memory available to new processes, or None if it can't be told on this system
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                # Ex:  MemAvailable:   12345678 kB
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if os.name == 'nt':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MemoryStatus(dwLength=ctypes.sizeof(MemoryStatus))
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    return None
+
+
+def _process_memory(pid):
+    """
+    :param pid: (int) process id
+    :return: (int or None) bytes of memory (resident) the process is using, or None if it can't be told
+    """
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _output_frame(m, preset):
+    """
+    :param m: (Media) media object
+    :param preset: (Preset or None) preset it's encoded with
+    :return: (tuple) width and height of the encoded video (scaled down to the preset's height), 0s if it has none
+    """
+    video = m.video_stream
+    if not video or not video.height:
+        return 0, 0
+    height = min(video.height, preset.max_height) if preset and preset.max_height else video.height
+    return video.width * height // video.height, height
+
+
+def estimate_memory(m, preset, remux=False) -> int:
+    """
+    :param m: (Media) media object
+    :param preset: (Preset or None) preset it's encoded with
+    :param remux: (bool) whether it's only remuxed (streams copied, not encoded)
+    :return: (int) bytes of memory the job is expected to need
+    """
+    base = st.admission_base_mb * 2 ** 20
+    if remux:
+        return base
+    width, height = _output_frame(m, preset)
+    per_megapixel = _MEMORY_MB_PER_MEGAPIXEL.get(preset.speed if preset else '', _MEMORY_MB_PER_MEGAPIXEL['medium'])
+    encoder = next((f for e, f in _ENCODER_MEMORY_FACTORS.items() if preset and preset.encoder.startswith(e)), 1.0)
+    return base + int(width * height / 1e6 * per_megapixel * encoder * 2 ** 20)
+
+
+def estimate_output_bytes(m, preset, secs=None, remux=False) -> int:
+    """
+    Summary
+    ---
+    Size of the file a job makes: a remux is as big as its source, and an encode comes out at (about) the target bit
+    rate for its height (see settings.target_bit_rates), or the source's if that's lower.  Padded by
+    settings.admission_size_margin.
+
+    :param m: (Media) media object
+    :param preset: (Preset or None) preset it's encoded with
+    :param secs: (optional -> float) length of media the job encodes (for a part), defaults to the whole
+    :param remux: (bool) whether it's only remuxed
+    :return: (int) bytes the job is expected to write
+    """
+    secs = m.duration if secs is None else secs
+    share = secs / m.duration if m.duration else 1.0
+    _, height = _output_frame(m, preset)
+    if remux or not height:
+        estimate = m.size * share
+    else:
+        bit_rate = dc.target_bit_rate(height)
+        if m.bit_rate:
+            bit_rate = min(bit_rate, m.bit_rate)
+        estimate = bit_rate / 8 * secs
+    return int(estimate * st.admission_size_margin)
+
+
+def tune_process(pid, slot, workers):
+    """
+    Summary
+    ---
+    Lower the priority of an encode's process (see settings.encode_nice), and pin it to the cores of its slot (see
+    settings.pin_encode_cores) when more than one encode runs at once.
+
+    :param pid: (int) process id
+    :param slot: (int) share of the cores the process is given, from 0 to workers - 1
+    :param workers: (int) number of encodes run at once
+    :return: None
+    """
+    try:
+        if st.encode_nice and hasattr(os, 'setpriority'):
+            os.setpriority(os.PRIO_PROCESS, pid, st.encode_nice)
+        if st.pin_encode_cores and workers > 1 and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            share = max(1, len(cpus) // workers)
+            cpus = cpus[slot * share:(slot + 1) * share] or cpus
+            # Every thread the process has started so far (those started later take after them)
+            for tid in os.listdir(f'/proc/{pid}/task'):
+                os.sched_setaffinity(int(tid), cpus)
+    except OSError:
+        # The process has already finished
+        pass
+
+
+class Claim:
+    """
+    Summary
+    ---
+    What a job is expected to take while it runs: bytes of memory, bytes of disk space (by disk) and cores.  Once
+    started, its process is kept too.
+    """
+    __slots__ = ('memory', 'disk', 'cores', 'partial', 'pid')
+
+    def __init__(self, memory, disk, cores, partial=None):
+        """
+        :param memory: (int) bytes of memory
+        :param disk: (dict) devices (keys) with a folder on the device and the bytes written to it (values)
+        :param cores: (int) cores the job uses
+        :param partial: (optional -> str) file the job writes to while it runs (see staging.py)
+        """
+        self.memory = memory
+        self.disk = disk
+        self.cores = cores
+        self.partial = partial
+        self.pid = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.memory / 2 ** 30:.1f} GB memory, ' \
+               f'{sum(b for _, b in self.disk.values()) / 2 ** 30:.1f} GB disk, {self.cores} core(s))'
+
+    def pending_memory(self) -> int:
+        """
+        :return: (int) bytes of memory the job is still expected to take, on top of what it already uses
+        """
+        used = _process_memory(self.pid) if self.pid else None
+        return max(0, self.memory - (used or 0))
+
+    def pending_disk(self, device) -> int:
+        """
+        :param device: (int) device (see os.stat)
+        :return: (int) bytes the job is still expected to write to the device
+        """
+        if device not in self.disk:
+            return 0
+        written = 0
+        if self.partial:
+            try:
+                stat = os.stat(self.partial)
+                written = stat.st_size if stat.st_dev == device else 0
+            except OSError:
+                pass
+        return max(0, self.disk[device][1] - written)
+
+
+class AdmissionController:
+    """
+    Summary
+    ---
+    Decides which jobs can be started (see admit), and keeps track of what the running ones were given.  Jobs are
+    identified by a key (the media object or part the dispatcher runs).
+    """
+    def __init__(self, cores=None):
+        """
+        :param cores: (optional -> int) cores jobs may use between them, defaults to settings.admission_cores (or
+        every core)
+        """
+        self.cores = cores or st.admission_cores or os.cpu_count() or 1
+        # Claims (values) of running jobs (keys)
+        self._claims = {}
+        # Job last reported as waiting (so it's only reported once)
+        self._waiting = None
+        self._lock = threading.Lock()
+
+    def claim(self, m, preset, output, secs=None, threads=0, remux=False) -> Claim:
+        """
+        :param m: (Media) media object
+        :param preset: (Preset or None) preset it's encoded with
+        :param output: (str) file the job makes
+        :param secs: (optional -> float) length of media the job encodes (for a part), defaults to the whole
+        :param threads: (int) threads the encoder may use (0 for all of them)
+        :param remux: (bool) whether it's only remuxed
+        :return: (Claim) what the job is expected to take
+        """
+        size = estimate_output_bytes(m, preset, secs, remux)
+        partial = stg.partial_path(output)
+        disk = {}
+        # The partial file is written first, then moved to the output (copied, if they're on different disks)
+        for path in (partial, output):
+            folder = os.path.dirname(path)
+            try:
+                disk[os.stat(folder).st_dev] = (folder, size)
+            except OSError:
+                continue
+        cores = 1 if remux else min(threads or self.cores, self.cores)
+        return Claim(estimate_memory(m, preset, remux), disk, cores, partial)
+
+    def _short_of(self, claim) -> str:
+        """
+        :param claim: (Claim) what a job is expected to take
+        :return: (str) what there isn't enough of for the job, or '' if it fits.  Call with the lock held.
+        """
+        running = self._claims.values()
+        if claim.cores + sum(c.cores for c in running) > self.cores:
+            return 'cores'
+
+        available = available_memory()
+        if available is not None:
+            room = available - st.admission_reserve_mb * 2 ** 20 - sum(c.pending_memory() for c in running)
+            if claim.memory > room:
+                return f'memory ({claim.memory / 2 ** 30:.1f} GB needed, {max(0, room) / 2 ** 30:.1f} GB free)'
+
+        for device, (folder, size) in claim.disk.items():
+            try:
+                free = shutil.disk_usage(folder).free
+            except OSError:
+                continue
+            room = free - st.admission_reserve_gb * 2 ** 30 - sum(c.pending_disk(device) for c in running)
+            if size > room:
+                return f'disk space in {folder} ({size / 2 ** 30:.1f} GB needed, {max(0, room) / 2 ** 30:.1f} GB free)'
+        return ''
+
+    def admit(self, key, claim, name='') -> bool:
+        """
+        Summary
+        ---
+        Start a job if it fits (or nothing else is running).  A job that has to wait is reported, once.
+
+        :param key: (object) the job
+        :param claim: (Claim) what it's expected to take
+        :param name: (optional -> str) name of the job, when reporting it waiting
+        :return: (bool) whether the job may start (if so, call release once it's done)
+        """
+        with self._lock:
+            short_of = self._short_of(claim)
+            if short_of and self._claims:
+                if self._waiting is not key:
+                    self._waiting = key
+                    print(f'>>> Waiting for {short_of}:\t{name or key}')
+                return False
+            if short_of:
+                print(f'>>> Not enough {short_of}, starting anyway (nothing else is running):\t{name or key}')
+
+            self._claims[key] = claim
+            self._waiting = None
+            return True
+
+    def started(self, key, process):
+        """
+        Summary
+        ---
+        Called with the process of a job once it has started, so the memory it already takes is counted as taken.
+
+        :param key: (object) the job
+        :param process: (Popen) its process
+        :return: None
+        """
+        with self._lock:
+            claim = self._claims.get(key)
+            if claim is not None:
+                claim.pid = process.pid
+
+    def release(self, key):
+        """
+        :param key: (object) a job that has finished
+        :return: None
+        """
+        with self._lock:
+            self._claims.pop(key, None)
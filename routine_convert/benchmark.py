@@ -0,0 +1,402 @@
+"""
+Routine Convert - benchmarks
+
+
+Summary
+-------
+Measure how quickly routine convert gets going: how long each module takes to import, and how long it takes from
+starting up to having the first job ready to convert.  Run this as a script to print a report.
+
+The pipeline itself (finding, probing, planning and running jobs) is measured at scale in a sandbox: a made-up media
+root with thousands of files, and stand-in ffprobe and HandBrakeCLI executables (small python scripts) that answer
+after a set delay with a set output.  It runs on any Linux (or macOS) box without the real tools, so a change that
+slows down one of these steps shows up in the report.
+
+
+Description
+--------
+bench_imports (function):       import time of each module, each in a fresh interpreter
+bench_first_job (function):     time from start up to the first job being ready (searching the media on disk)
+make_tree (function):           made-up media root, with thousands of source files
+make_fake_bins (function):      stand-in ffprobe and HandBrakeCLI executables
+use_sandbox (function):         point the settings at a made-up media root, fake executables and data folder
+bench_pipeline (function):      time and memory used to scan, probe, plan and dispatch every file found
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    # Peak memory of whole processes (not on Windows)
+    import resource
+except ImportError:
+    resource = None
+
+
+# Modules to time, in the order they are usually imported
+modules = [
+    'settings',
+    'folder_hierarchy',
+    'media',
+    'source',
+    'convert_to',
+    'watcher',
+]
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# What the fake ffprobe answers for every file (its "format" is completed with the file's name, size and title).  By
+# default a 1080p H.264 title with English AC3 audio and subtitles, which is encoded rather than skipped or remuxed.
+FAKE_PROBE = {
+    'format': {
+        'format_name': 'matroska,webm',
+        'nb_streams': 3,
+        'duration': '5400.000000',
+        'bit_rate': '12000000',
+    },
+    'streams': [
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'profile': 'High', 'width': 1920, 'height': 1080,
+         'pix_fmt': 'yuv420p', 'avg_frame_rate': '24000/1001', 'field_order': 'progressive'},
+        {'index': 1, 'codec_type': 'audio', 'codec_name': 'ac3', 'channels': 6, 'tags': {'language': 'eng'}},
+        {'index': 2, 'codec_type': 'subtitle', 'codec_name': 'subrip', 'tags': {'language': 'eng'}},
+    ],
+    'chapters': [],
+}
+
+# Stand-in ffprobe: reads its settings from the JSON file next to it ("ffprobe.json")
+_FAKE_FFPROBE = '''
+import json, os, sys, time
+
+with open(os.path.abspath(__file__) + '.json') as f:
+    config = json.load(f)
+time.sleep(config['latency_secs'])
+
+file_ = sys.argv[sys.argv.index('-i') + 1]
+if '-show_chapters' in sys.argv:
+    print(json.dumps({'chapters': config['probe'].get('chapters', [])}))
+    sys.exit()
+
+probe = {'format': dict(config['probe']['format'], filename=file_, size=str(os.path.getsize(file_)),
+                        tags={'title': os.path.splitext(os.path.basename(file_))[0]})}
+if '-show_streams' in sys.argv:
+    probe['streams'] = config['probe'].get('streams', [])
+print(json.dumps(probe))
+'''
+
+# Stand-in HandBrakeCLI: reads its settings from the JSON file next to it ("HandBrakeCLI.json")
+_FAKE_HANDBRAKE = '''
+import json, os, sys, time
+
+with open(os.path.abspath(__file__) + '.json') as f:
+    config = json.load(f)
+
+lines = max(1, config['progress_lines'])
+for i in range(lines):
+    sys.stdout.write(f'\\rEncoding: task 1 of 1, {100 * i / lines:.2f} % (30.00 fps, avg 25.50 fps, ETA 00h00m01s)')
+    sys.stdout.flush()
+    time.sleep(config['latency_secs'] / lines)
+sys.stdout.write('\\n[00:00:00] work: average encoding speed for job is 25.500000 fps\\n')
+
+with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:
+    f.write(b'\\0' * config['output_bytes'])
+sys.exit(config['returncode'])
+'''
+
+
+def bench_imports(repeat=3):
+    """
+    Summary
+    ---
+    Time importing each module in a fresh python process (so nothing is already imported), keeping the best of
+    "repeat" tries.
+
+    :param repeat: (int) tries per module
+    :return: (dict) seconds (values) to import each module (keys)
+    """
+    code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'
+    results = {}
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c', code.format(module)], cwd=_HERE)
+            times.append(float(out.decode().split()[-1]))
+        results[module] = min(times)
+    return results
+
+
+def bench_first_job(lazy=True):
+    """
+    Summary
+    ---
+    Time from start up to the first job being ready to convert: find media on disk and make its CLI string.
+
+    :param lazy: (bool) find media without probing it all first (the first job is probed when its CLI string is made)
+    :return: (dict) seconds to import, to find media, and to make the first job, plus the number of files found
+    """
+    started = time.perf_counter()
+    import convert_to as ct
+    import source as sc
+    imported = time.perf_counter()
+
+    media_list = sc.SourceFiles(lazy=lazy).movies
+    found = time.perf_counter()
+
+    if media_list:
+        ct.Handbrake().make_cli_str(media_list[0])
+    first_job = time.perf_counter()
+
+    return {
+        'import_secs': imported - started,
+        'find_secs': found - imported,
+        'first_job_secs': first_job - started,
+        'files': len(media_list),
+    }
+
+
+def make_tree(root, files=2000, show_share=0.25, file_bytes=1024) -> int:
+    """
+    Summary
+    ---
+    Make a media root with every folder routine convert expects, and fill the source folders with made-up files,
+    spread evenly over the disc formats.  Shows have several files (discs) each.
+
+    :param root: (str) folder to make the media root in
+    :param files: (int) number of source files
+    :param show_share: (float) share of the files that are shows, rather than movies
+    :param file_bytes: (int) size of each file
+    :return: (int) number of files made
+    """
+    import folder_hierarchy as fh
+    import settings as st
+
+    root_dir, st.root_dir = st.root_dir, root
+    try:
+        hierarchy = fh.Hierarchy()
+        for paths in hierarchy.process_paths.values():
+            for p in paths:
+                os.makedirs(p, exist_ok=True)
+        sources = hierarchy.source_path_info()
+    finally:
+        st.root_dir = root_dir
+
+    movie_dirs = [p for p, (_, cat) in sources.items() if cat == st.movie_cat]
+    show_dirs = [p for p, (_, cat) in sources.items() if cat == st.show_cat]
+    shows = int(files * show_share)
+    for i in range(files):
+        if i < shows:
+            file_ = os.path.join(show_dirs[i % len(show_dirs)], f'Show {i // 8:04d} s01d{i % 8 + 1}.mkv')
+        else:
+            file_ = os.path.join(movie_dirs[i % len(movie_dirs)], f'Movie {i:05d}.mkv')
+        with open(file_, 'wb') as f:
+            # Every file is different (or they'd all be duplicates, see fingerprint.py)
+            f.write(os.path.basename(file_).encode().ljust(file_bytes, b'\0'))
+    return files
+
+
+def make_fake_bins(folder, probe_secs=0.0, encode_secs=0.0, probe=None, progress_lines=5, output_bytes=1024,
+                   returncode=0) -> dict:
+    """
+    Summary
+    ---
+    Write stand-in ffprobe and HandBrakeCLI executables to folder.  Their settings are kept in a JSON file next to
+    each, and can be changed between runs.
+
+    :param folder: (str) folder to write them to
+    :param probe_secs: (float) how long ffprobe takes to answer
+    :param encode_secs: (float) how long each encode takes
+    :param probe: (optional -> dict) "format", "streams" and "chapters" ffprobe answers with, defaults to FAKE_PROBE
+    :param progress_lines: (int) progress updates printed by each encode
+    :param output_bytes: (int) size of each encoded file
+    :param returncode: (int) return code of each encode
+    :return: (dict) paths to the "ffprobe" and "HandBrakeCLI" executables
+    """
+    os.makedirs(folder, exist_ok=True)
+    fakes = {
+        'ffprobe': (_FAKE_FFPROBE, {'latency_secs': probe_secs, 'probe': probe or FAKE_PROBE}),
+        'HandBrakeCLI': (_FAKE_HANDBRAKE, {'latency_secs': encode_secs, 'progress_lines': progress_lines,
+                                           'output_bytes': output_bytes, 'returncode': returncode}),
+    }
+    paths = {}
+    for name, (script, config) in fakes.items():
+        paths[name] = os.path.join(folder, name)
+        with open(paths[name], 'w') as f:
+            f.write(f'#!{sys.executable} -S{script}')
+        os.chmod(paths[name], os.stat(paths[name]).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        with open(paths[name] + '.json', 'w') as f:
+            json.dump(config, f)
+    return paths
+
+
+def _write_presets_file(path):
+    """
+    Write a presets file holding every preset in settings.presets and settings.preset_rules.
+
+    :param path: (str) file to write
+    :return: None
+    """
+    import settings as st
+
+    folders = {}
+    for name in list(st.presets.values()) + [r['preset'] for r in st.preset_rules]:
+        category, _, preset = name.rpartition('/')
+        folders.setdefault(category, {})[preset] = {
+            'PresetName': preset, 'Type': 1, 'VideoEncoder': 'x265', 'VideoPreset': 'medium', 'VideoQualityType': 2,
+            'VideoQualitySlider': 22, 'AudioCopyMask': ['copy:ac3'], 'AudioList': [{'AudioEncoder': 'av_aac'}],
+        }
+
+    preset_list = []
+    for category, presets in folders.items():
+        if category:
+            preset_list.append({'PresetName': category, 'Folder': True, 'Type': 1,
+                                'ChildrenArray': list(presets.values())})
+        else:
+            preset_list += presets.values()
+    with open(path, 'w') as f:
+        json.dump({'VersionMajor': 47, 'VersionMinor': 0, 'VersionMicro': 0, 'PresetList': preset_list}, f)
+
+
+def use_sandbox(folder, files=2000, **fake_bins):
+    """
+    Summary
+    ---
+    Fill folder with a made-up media root (see make_tree), fake executables (see make_fake_bins) and a presets file,
+    and point the settings at them.  Everything kept on disk between runs (probe cache, journal, speed history...)
+    goes in the sandbox too, so each run starts cold.  Failed jobs aren't tried again, so a run never waits on a
+    retry, and fake encodes take no cores, so every worker runs (see admission.py).
+
+    Must be called before a run uses any of them: the files kept on disk are opened the first time they're used, at
+    the paths in the settings then (see store.Lazy).
+
+    :param folder: (str) empty folder to use
+    :param files: (int) number of source files
+    :param fake_bins: (optional) settings of the fake executables, see make_fake_bins
+    :return: None
+    """
+    import settings as st
+
+    root, data_dir, bin_dir = (os.path.join(folder, d) for d in ('media', 'data', 'bin'))
+    make_tree(root, files)
+    bins = make_fake_bins(bin_dir, **fake_bins)
+    os.makedirs(data_dir, exist_ok=True)
+    _write_presets_file(os.path.join(bin_dir, 'presets.json'))
+
+    # Every file and folder under the data folder moves to the sandbox's
+    for k, v in vars(st).items():
+        if k.isupper() and isinstance(v, str) and v.startswith(os.path.join(st.DATA_DIR, '')):
+            setattr(st, k, os.path.join(data_dir, os.path.relpath(v, st.DATA_DIR)))
+    st.root_dir, st.DATA_DIR = root, data_dir
+    st.FFPROBE, st.HB_BIN = bins['ffprobe'], bins['HandBrakeCLI']
+    st.PRESET_FILE = os.path.join(bin_dir, 'presets.json')
+    st.quality_search = False
+    st.job_max_attempts = 1
+    st.admission_cores = 2 ** 10
+
+
+def _measure(func, trace_memory=True):
+    """
+    Run func with its output hidden, timing it and (if trace_memory) tracing the peak memory it allocates.
+
+    :return: result of func, (float) seconds it took and (int) peak bytes allocated (0 if not traced)
+    """
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = func()
+        secs = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        tracemalloc.stop()
+    return result, secs, peak
+
+
+def bench_pipeline(workers=None, trace_memory=True) -> dict:
+    """
+    Summary
+    ---
+    Take every file in the media root through the pipeline, one step at a time:
+
+    - scan:     walk the source folders and make a media object for each file (without probing)
+    - probe:    probe every file (see media.Media.materialize_all)
+    - plan:     pick presets, decide what to do with each file and make its command (see make_cli_str_from_media)
+    - dispatch: order and run every job, and move the sources when done (see process_cli_strs)
+
+    Meant to be run in a sandbox (see use_sandbox).  Each fake ffprobe or HandBrakeCLI is a python process, so
+    probing and dispatching take at least the start up time of one per file (spread over the cores).  Tracing memory
+    slows python down, so compare times with trace_memory off.
+
+    :param workers: (optional -> int) number of concurrent encodes, defaults to the settings value
+    :param trace_memory: (bool) trace the peak memory python allocates in each step
+    :return: (dict) for each step (keys): seconds, peak MB allocated and number of files or jobs (values)
+    """
+    import convert_to as ct
+    import media as me
+    import source as sc
+
+    results = {}
+    source_files = sc.SourceFiles(lazy=True)
+    media_list, secs, peak = _measure(source_files._get_media_on_disk, trace_memory)
+    results['scan'] = {'secs': secs, 'peak_mb': peak / 2 ** 20, 'count': len(media_list)}
+
+    errors, secs, peak = _measure(lambda: me.Media.materialize_all(media_list), trace_memory)
+    media_list = [m for m in media_list if m.filename not in errors]
+    results['probe'] = {'secs': secs, 'peak_mb': peak / 2 ** 20, 'count': len(media_list)}
+
+    hb = ct.Handbrake()
+    jobs, secs, peak = _measure(lambda: dict(hb.make_cli_str_from_media(media_list)), trace_memory)
+    results['plan'] = {'secs': secs, 'peak_mb': peak / 2 ** 20, 'count': len(jobs)}
+
+    _, secs, peak = _measure(lambda: hb.process_cli_strs(workers=workers), trace_memory)
+    results['dispatch'] = {'secs': secs, 'peak_mb': peak / 2 ** 20, 'count': len(jobs)}
+
+    if resource:
+        # Largest resident size of this process, and of any single child process (KB on Linux)
+        results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        results['child_max_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return results
+
+
+if __name__ == "__main__":
+    # For running this as a script in CLI, to print start up times and how long each step of the pipeline takes
+    parser = argparse.ArgumentParser(description='Time routine convert, in a sandbox with fake ffprobe/HandBrakeCLI.')
+    parser.add_argument('--files', type=int, default=2000, help='number of made-up source files')
+    parser.add_argument('--probe-ms', type=float, default=0, help='how long the fake ffprobe takes to answer')
+    parser.add_argument('--encode-ms', type=float, default=0, help='how long each fake encode takes')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent encodes')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory (tracing slows python down)")
+    parser.add_argument('--keep', action='store_true', help='keep the sandbox folder afterwards')
+    args = parser.parse_args()
+
+    sys.path.insert(0, _HERE)
+    print('>>> Import times:')
+    for module, secs in bench_imports().items():
+        print(f'\t{secs * 1000:8.1f} ms\t{module}')
+
+    sandbox = tempfile.mkdtemp(prefix='routine_convert_bench_')
+    try:
+        use_sandbox(sandbox, files=args.files, probe_secs=args.probe_ms / 1000, encode_secs=args.encode_ms / 1000)
+
+        print('>>> Time to first job:')
+        for k, v in bench_first_job().items():
+            print(f'\t{k}:\t{v:.3f}' if isinstance(v, float) else f'\t{k}:\t{v}')
+
+        print(f'>>> Pipeline ({args.files} files, {args.workers} worker(s)):')
+        for step, v in bench_pipeline(workers=args.workers, trace_memory=not args.no_memory).items():
+            if isinstance(v, dict):
+                print(f'\t{step}:\t{v["secs"]:8.3f} s\t{v["peak_mb"]:8.1f} MB peak\t{v["count"]}')
+            else:
+                print(f'\t{step}:\t{v:.1f}')
+    finally:
+        if args.keep:
+            print(f'>>> Sandbox kept in:\t{sandbox}')
+        else:
+            shutil.rmtree(sandbox, ignore_errors=True)
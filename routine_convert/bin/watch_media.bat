@@ -0,0 +1,4 @@
+REM Process to keep running, converting media as soon as it is placed in a "TO_CONVERT" folder
+REM ===========
+REM Call python.exe, then the path to the "watcher.py" script
+C:\path\to\python\python.exe "..\watcher.py"
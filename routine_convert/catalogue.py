@@ -0,0 +1,302 @@
+"""
+Routine Convert - catalogue
+
+
+Summary
+-------
+Once a source is converted, all that's left of it is a file under "CONVERTED" and one under "SOURCE_PROCESSED".
+Knowing what's left to convert, or how much space a preset has saved, would mean walking and probing the whole
+library again.  Instead, every source is kept in a catalogue as it's queued: what was probed from it (title, length,
+codec, resolution, size), its disc format and preset, and what will be done with it.  Once converted, the time its
+encode took and the size of what it was converted to are added, and its IMDb details, if it has been looked up (see
+metadata.py).
+
+The catalogue is a SQLite file, indexed on title, year, disc format and codec.  Query it from python (see Catalogue),
+or from the command line:
+
+    python catalogue.py left
+    python catalogue.py savings
+    python catalogue.py find --title "Dr. Strangelove" --disc-format Blu-Ray
+
+
+Description
+--------
+Catalogue (SqliteStore):    every source queued, and what it was converted to
+library (Catalogue):        catalogue in settings.CATALOGUE_FILE (None if settings.use_catalogue is off)
+"""
+import os
+import time
+
+import decisions as dc
+import preset_rules as pr
+import settings as st
+import store
+
+
+class Catalogue(store.SqliteStore):
+    PENDING = 'pending'
+    CONVERTED = 'converted'
+    FAILED = 'failed'
+
+    # Columns returned by find
+    COLUMNS = ('source', 'category', 'title', 'year', 'disc_format', 'codec', 'width', 'height', 'duration',
+               'source_size', 'action', 'preset', 'state', 'output', 'output_size', 'encode_secs', 'imdb_id',
+               'imdb_title', 'genres', 'rating', 'added', 'converted')
+
+    # A source queued again once converted (a new rip, with the same name) gets a new entry, so the old one is kept
+    schema = '''
+        CREATE TABLE IF NOT EXISTS media (
+            id INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            category TEXT NOT NULL,
+            title TEXT NOT NULL COLLATE NOCASE,
+            year INTEGER,
+            disc_format TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            duration REAL NOT NULL,
+            source_size INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            preset TEXT NOT NULL,
+            state TEXT NOT NULL,
+            output TEXT,
+            output_size INTEGER NOT NULL DEFAULT 0,
+            encode_secs REAL NOT NULL DEFAULT 0,
+            imdb_id TEXT,
+            imdb_title TEXT,
+            genres TEXT,
+            rating REAL,
+            added REAL NOT NULL,
+            converted REAL
+        );
+        CREATE INDEX IF NOT EXISTS media_source ON media (source, state);
+        CREATE INDEX IF NOT EXISTS media_title ON media (title);
+        CREATE INDEX IF NOT EXISTS media_year ON media (year);
+        CREATE INDEX IF NOT EXISTS media_disc_format ON media (disc_format);
+        CREATE INDEX IF NOT EXISTS media_codec ON media (codec);
+        CREATE INDEX IF NOT EXISTS media_state ON media (state, preset);
+    '''
+
+    def _open_id(self, source):
+        """
+        :param source: (str) path to a source
+        :return: (int or None) its entry, if it's queued (or failed) and not yet converted
+        """
+        rows = self.execute('SELECT id FROM media WHERE source = ? AND state != ? ORDER BY id DESC LIMIT 1',
+                            (source, self.CONVERTED))
+        return rows[0][0] if rows else None
+
+    def queued(self, m, action):
+        """
+        Summary
+        ---
+        Add a source as it's queued (or bring its entry up to date, if it was queued before and isn't converted yet).
+        Time and output counted for an earlier attempt are cleared.
+
+        :param m: (Media) media object
+        :param action: (str) what's done with it (see decisions.py)
+        :return: None
+        """
+        self.queued_all([(m, action)])
+
+    def queued_all(self, media_actions):
+        """
+        :param media_actions: (list) media objects queued, and what's done with each (see queued), in one transaction
+        :return: None
+        """
+        with self._lock, self.conn:
+            for m, action in media_actions:
+                video = m.video_stream
+                year = int(m.year) if str(m.year).isdigit() else None
+                values = (m.filename, m.media_category, m.title, year, m.disc_format,
+                          video.codec_name if video else '', video.width if video else 0,
+                          video.height if video else 0, m.duration, m.size, action,
+                          pr.preset_of(m) if action == dc.ENCODE else '', self.PENDING)
+
+                rows = self.conn.execute('SELECT id FROM media WHERE source = ? AND state != ? ORDER BY id DESC '
+                                         'LIMIT 1', (m.filename, self.CONVERTED)).fetchall()
+                if not rows:
+                    self.conn.execute('INSERT INTO media (source, category, title, year, disc_format, codec, width, '
+                                      'height, duration, source_size, action, preset, state, added) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values + (time.time(),))
+                else:
+                    self.conn.execute('UPDATE media SET source = ?, category = ?, title = ?, year = ?, '
+                                      'disc_format = ?, codec = ?, width = ?, height = ?, duration = ?, '
+                                      'source_size = ?, action = ?, preset = ?, state = ?, output_size = 0, '
+                                      'encode_secs = 0 WHERE id = ?', values + (rows[0][0],))
+
+    def job_done(self, source, wall_secs, output):
+        """
+        Summary
+        ---
+        Count a job that succeeded (a whole source, or one of its parts) towards the source's entry.
+
+        :param source: (str) path to the source
+        :param wall_secs: (float) how long the job took
+        :param output: (str) file it made
+        :return: None
+        """
+        size = os.path.getsize(output) if os.path.exists(output) else 0
+        self.execute('UPDATE media SET encode_secs = encode_secs + ?, output_size = output_size + ? '
+                     'WHERE source = ? AND state != ?', (wall_secs, size, source, self.CONVERTED))
+
+    def converted(self, m, output, record=None):
+        """
+        Summary
+        ---
+        Mark a source converted (found by the path it was queued from, so it may have been moved out of
+        "TO_CONVERT" already).  The size of what it was converted to is taken from output, if it's there; a show
+        split into episodes keeps the sizes its jobs added up (see job_done).
+
+        :param m: (Media) media object
+        :param output: (str) file it was converted to
+        :param record: (optional) its IMDb movie/episode, if it has been looked up
+        :return: None
+        """
+        with self._lock:
+            id_ = self._open_id(m.filename)
+            if id_ is None:
+                self.queued(m, dc.SKIP)
+                id_ = self._open_id(m.filename)
+            if os.path.exists(output):
+                self.execute('UPDATE media SET output_size = ? WHERE id = ?', (os.path.getsize(output), id_))
+            self.execute('UPDATE media SET state = ?, output = ?, converted = ? WHERE id = ?',
+                         (self.CONVERTED, output, time.time(), id_))
+            if record:
+                self._set_imdb(id_, record)
+
+    def failed(self, source):
+        """
+        :param source: (str) path to a source whose job failed (its time and output are cleared)
+        :return: None
+        """
+        self.execute('UPDATE media SET state = ?, output_size = 0, encode_secs = 0 WHERE source = ? AND state != ?',
+                     (self.FAILED, source, self.CONVERTED))
+
+    def _set_imdb(self, id_, record):
+        genres = record.get('genres') or []
+        year = record.get('year')
+        self.execute('UPDATE media SET imdb_id = ?, imdb_title = ?, genres = ?, rating = ?, year = COALESCE(?, year) '
+                     'WHERE id = ?', (str(record.getID()), record.get('title'), ', '.join(genres),
+                                      record.get('rating'), int(year) if year else None, id_))
+
+    def add_imdb(self, m, record):
+        """
+        :param m: (Media) media object, looked up on IMDb
+        :param record: IMDb movie/episode found for it
+        :return: None
+        """
+        rows = self.execute('SELECT id FROM media WHERE source = ? ORDER BY id DESC LIMIT 1', (m.filename,))
+        if rows:
+            self._set_imdb(rows[0][0], record)
+
+    def evict_missing(self):
+        """
+        Summary
+        ---
+        Forget sources that were queued but are no longer there (and weren't converted).
+
+        :return: (int) number of entries removed
+        """
+        missing = [(id_,) for id_, source in self.execute('SELECT id, source FROM media WHERE state != ?',
+                                                          (self.CONVERTED,)) if not os.path.exists(source)]
+        self.executemany('DELETE FROM media WHERE id = ?', missing)
+        return len(missing)
+
+    def find(self, title=None, year=None, disc_format=None, codec=None, state=None) -> list:
+        """
+        :param title: (optional -> str) start of the title (any case)
+        :param year: (optional -> int) year
+        :param disc_format: (optional -> str) disc format (e.g. settings.blu_name)
+        :param codec: (optional -> str) codec of the source's video, as ffprobe names it (e.g. "h264")
+        :param state: (optional -> str) PENDING, CONVERTED or FAILED
+        :return: (list) dicts of COLUMNS for each entry that matches, by title
+        """
+        where, params = [], []
+        if title:
+            where.append("title LIKE ? ESCAPE '\\'")
+            params.append(title.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        for column, value in (('year', year), ('disc_format', disc_format), ('codec', codec), ('state', state)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+
+        sql = f'SELECT {", ".join(self.COLUMNS)} FROM media'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [dict(zip(self.COLUMNS, row)) for row in self.execute(sql + ' ORDER BY title, year', params)]
+
+    def left(self) -> list:
+        """
+        :return: (list) dicts of COLUMNS for each source queued (or failed), but not yet converted
+        """
+        return self.find(state=self.PENDING) + self.find(state=self.FAILED)
+
+    def savings(self) -> list:
+        """
+        :return: (list) for each preset (remuxed and skipped sources have none) with sources converted: its name, the
+        number of sources, their size, the size of what they were converted to, and the hours spent encoding them
+        """
+        return self.execute('SELECT action, preset, COUNT(*), SUM(source_size), SUM(output_size), '
+                            'SUM(encode_secs) / 3600 FROM media WHERE state = ? GROUP BY action, preset '
+                            'ORDER BY SUM(source_size) - SUM(output_size) DESC', (self.CONVERTED,))
+
+
+library = store.Lazy(lambda: Catalogue(st.CATALOGUE_FILE) if st.use_catalogue else None)
+
+
+def _gb(size):
+    return f'{(size or 0) / 2 ** 30:.1f} GB'
+
+
+def print_left():
+    import scheduling as sch
+
+    left = library.left()
+    for row in left:
+        print(f'{row["state"]:<10}{row["disc_format"]:<10}{sch.format_secs(row["duration"]):>8}\t'
+              f'{_gb(row["source_size"]):>9}\t{row["source"]}')
+    print(f'>>> {len(left)} file(s) left to convert, '
+          f'{_gb(sum(row["source_size"] for row in left))} and {sum(row["duration"] for row in left) / 3600:.1f} '
+          f'hour(s) of media')
+
+
+def print_savings():
+    total = 0
+    for action, preset, count, source_size, output_size, hours in library.savings():
+        total += source_size - output_size
+        print(f'{_gb(source_size - output_size):>10} saved\t{count:>5} file(s)\t{hours:6.1f} h\t{preset or action}')
+    print(f'>>> {_gb(total)} saved in all')
+
+
+def print_found(rows):
+    for row in rows:
+        title = row['title'] + (f' ({row["year"]})' if row['year'] else '')
+        print(f'{title}\t{row["disc_format"]}\t{row["codec"]} {row["height"]}p\t{row["state"]}\t'
+              f'{row["output"] or row["source"]}')
+    print(f'>>> {len(rows)} file(s) found')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Query the catalogue of queued and converted media.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('left', help='sources queued but not yet converted')
+    commands.add_parser('savings', help='space saved (and time spent encoding) per preset')
+    find = commands.add_parser('find', help='sources by title, year, disc format or codec')
+    find.add_argument('--title', help='start of the title')
+    find.add_argument('--year', type=int)
+    find.add_argument('--disc-format')
+    find.add_argument('--codec', help='codec of the source video (e.g. h264)')
+    find.add_argument('--state', choices=[Catalogue.PENDING, Catalogue.CONVERTED, Catalogue.FAILED])
+    args = parser.parse_args()
+
+    if not library:
+        parser.exit(1, 'The catalogue is turned off (see settings.use_catalogue)\n')
+    if args.command == 'left':
+        print_left()
+    elif args.command == 'savings':
+        print_savings()
+    else:
+        print_found(library.find(args.title, args.year, args.disc_format, args.codec, args.state))
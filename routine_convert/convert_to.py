@@ -15,23 +15,87 @@ Description
 Handbrake (object):     class containing preset data, list of media objects to convert and methods to
 determine file locations before/after converting (such as moving "source" files to a different folder
 when finished converting, so we don't attempt to convert them the next time!)
+
+Features turned on in the settings (the journal, admission control, quality search...) are imported in the code that
+uses them, and what they keep for a run is made the first time it's used (see store.Lazy), so importing this module
+- or a run that doesn't use them - doesn't pay for them.
 """
 import os
+import shlex
 import subprocess
+import threading
+import time
 
+import catalogue as cg
+import decisions as dc
+import media as me
+import preset_rules as pr
+import presets as ps
 import settings as st
 import source as sc
+import staging as stg
+import store
+
+
+def _journal():
+    import journal as jn
+    return jn.JobJournal(st.JOURNAL_FILE) if st.use_journal else None
+
+
+def _progress():
+    import progress as pg
+    return pg.make_sinks()
+
+
+def _prefetcher():
+    return stg.Prefetcher() if st.PREFETCH_DIR else None
+
+
+def _admission():
+    import admission as ad
+    return ad.AdmissionController() if st.use_admission_control else None
 
 
 class Handbrake:
-    # TODO: Movies working for now, TV shows still need work (some shows have a file per episode, some don't
-    #  and instead... lump a few together in one file!)
-    # source_files = sc.SourceFiles().media
-    source_files = sc.SourceFiles().movies
+    # Media found on disk, only searched for once it's needed (see source_files)
+    _source_files = None
 
     # A dictionary containing media objects (keys) and strings (values) to call in handbrake CLI.
     _clr_str_dict = {}
 
+    # What to do with each media object found (keys): skip, remux or encode it, and why (values, see decisions.py)
+    decisions = {}
+
+    # RF picked for media by a quality search (see quality.py), used instead of its preset's
+    quality = {}
+
+    # State of every job, kept on disk so interrupted or failed jobs are picked up again (see journal.py)
+    journal = store.Lazy(_journal)
+
+    # Where progress of running encodes is reported (see progress.py)
+    progress = store.Lazy(_progress)
+
+    # Copies sources of upcoming jobs to a local disk (see staging.py)
+    prefetcher = store.Lazy(_prefetcher)
+
+    # Starts jobs only when they fit in memory, disk space and cores (see admission.py)
+    admission = store.Lazy(_admission)
+
+    # Encodes run at once, and the shares of the cores (slots, see admission.tune_process) given to those running
+    workers = 1
+    _slots = set()
+    _slots_lock = threading.Lock()
+
+    @property
+    def source_files(self):
+        if self._source_files is None:
+            self._source_files = sc.SourceFiles().media
+        return self._source_files
+
+    @source_files.setter
+    def source_files(self, media_list):
+        self._source_files = media_list
+
     @staticmethod
     def get_output_from_source_path(source: str) -> str:
         """
@@ -56,64 +120,699 @@ class Handbrake:
         """
         return source.replace(st.process_dirs[st.source_key], st.process_dirs[st.old_source_key])
 
+    def get_output_file(self, m) -> str:
+        """
+        Summary
+        ---
+        Given the media object, return the converted file's location.  Reformat movie title to be in a more
+        user-friendly name (best as possible).
+
+        :param m: Media - media object to convert
+        :return: str - output file
+        """
+        output_media_name = m.title + f'.{st.ext}'
+        return os.path.join(self.get_output_dir(m), output_media_name)
+
+    def get_output_dir(self, m) -> str:
+        """
+        :param m: Media - media object to convert
+        :return: str - folder the converted file(s) go in
+        """
+        return os.path.dirname(self.get_output_from_source_path(m.filename))
+
+    def make_cli_str(self, m, output=None, extra_args='', tracks=True) -> str:
+        """
+        Summary
+        ---
+        Combine filenames and variables of a single media object into a handbrake-ready string.
+
+        :param m: Media - media object to convert
+        :param output: str - (optional) file to write to, instead of the output folder (see get_output_file)
+        :param extra_args: str - (optional) additional HandBrakeCLI arguments
+        :param tracks: bool - (optional) whether to pick the audio and subtitle tracks (see tracks.py), left out when
+        extra_args picks them itself
+        :return: str - command to run
+        """
+        media_out = output or self.get_output_file(m)
+        preset = pr.preset_of(m)
+
+        cli_str = f'"{st.HB_BIN}" --preset-import-file "{ps.index.import_file(preset)}" ' \
+                  f'-i "{m.filename}" --preset "{preset}" -o "{media_out}" -f "{st.container}"'
+
+        if tracks and st.select_tracks:
+            import tracks as tr
+            selected = tr.select_tracks(m, preset)
+            if selected:
+                cli_str += f' {selected.cli_args()}'
+        if m in self.quality:
+            cli_str += f' --quality {self.quality[m].rf:g}'
+        return f'{cli_str} {extra_args}' if extra_args else cli_str
+
+    def make_remux_str(self, m) -> str:
+        """
+        Summary
+        ---
+        Command to copy every stream of a single media object into the output container, without encoding them.
+
+        :param m: Media - media object to remux
+        :return: str - command to run
+        """
+        return f'"{st.FFMPEG}" -y -hide_banner -loglevel error -i "{m.filename}" -map 0 -c copy ' \
+               f'"{self.get_output_file(m)}"'
+
     def make_cli_str_from_media(self, media_list=None):
         """
         Summary
         ---
-        Combine filenames and variables into a handbrake-ready string.  Reformat movie title
-        to be in a more user-friendly name (best as possible).
+        Combine filenames and variables into a handbrake-ready string, for each media object in the list.  Media
+        that doesn't need encoding (see decisions.py) gets a remux command instead, or no command if it's skipped.
         """
         if media_list:
+            # Pick every preset at once (see preset_rules.py)
+            pr.assign_presets(media_list)
             for m in media_list:
-                output_media_name = m.title + f'.{st.ext}'
-                output_dir = os.path.dirname(self.get_output_from_source_path(m.filename))
-                media_out = os.path.join(output_dir, output_media_name)
-                preset = st.presets[m.disc_format]
-
-                cli_str = f'"{st.HB_BIN}" --preset-import-file "{st.PRESET_FILE}" ' \
-                          f'-i "{m.filename}" --preset "{preset}" -o "{media_out}" -f "{st.container}"'
+                decision = self.decisions[m] = dc.decide(m)
+                if decision.action != dc.ENCODE:
+                    print(f'>>> {decision.action.title()} ({decision.reason}):\t{m.filename}')
+                if decision.action == dc.SKIP:
+                    continue
 
-                self._clr_str_dict[m] = cli_str
+                if decision.action == dc.REMUX:
+                    self._clr_str_dict[m] = self.make_remux_str(m)
+                else:
+                    self._clr_str_dict[m] = self.make_cli_str(m)
+                if self.journal:
+                    self.journal.enqueue(m.filename, self._clr_str_dict[m])
+            if cg.library:
+                cg.library.queued_all([(m, self.decisions[m].action) for m in media_list])
         return self._clr_str_dict
 
-    def process_cli_strs(self):
+    @staticmethod
+    def get_threads_per_job(workers: int) -> int:
         """
         Summary
         ---
-        Run the created CLI string(s).  This is expected to kick off handbrake processes, one after another.
+        Determine how many threads each HandBrakeCLI worker is allowed to use.  When the setting is left at 0,
+        split the machine's cores evenly between the workers.
+
+        :param workers: int - number of concurrent encodes
+        :return: int - threads per encode
+        """
+        if st.encode_threads_per_job:
+            return st.encode_threads_per_job
+        return max(1, (os.cpu_count() or 1) // workers)
 
+    @staticmethod
+    def _split_cli_str(cli_str: str):
+        """
+        Summary
+        ---
+        Windows hands the full command string over to the process, other platforms need a list of arguments.
+
+        :param cli_str: str - command to run
+        :return: str or list - command ready for subprocess
+        """
+        return cli_str if os.name == 'nt' else shlex.split(cli_str)
+
+    def _encode(self, cli_str: str, threads=0, on_progress=None, on_line=None, on_start=None) -> int:
+        """
+        Summary
+        ---
+        Run a single HandBrakeCLI process.  If a thread budget is given, pass it along to the encoder.  The process is
+        given its priority and share of the cores (see _tune).  Its output is read as it runs, and each progress
+        update is handed to on_progress.
+
+        :param cli_str: str - command created by make_cli_str_from_media
+        :param threads: int - (optional) threads the encoder may use
+        :param on_progress: callable - (optional) called with each progress.ProgressEvent
+        :param on_line: callable - (optional) called with every line of output
+        :param on_start: callable - (optional) called with the process once it has started (to stop it early)
+        :return: int - return code of the process
+        """
+        import progress as pg
+        if threads:
+            cli_str += f' --encopts "{st.encode_thread_opt.format(threads=threads)}"'
+        slot = None
+        try:
+            with subprocess.Popen(self._split_cli_str(cli_str), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT) as process:
+                slot = self._tune(process)
+                if on_start:
+                    on_start(process)
+                for line in pg.read_lines(process.stdout):
+                    if on_line:
+                        on_line(line)
+                    event = pg.parse_progress(line)
+                    if event and on_progress:
+                        on_progress(event)
+        finally:
+            if slot is not None:
+                with self._slots_lock:
+                    self._slots.discard(slot)
+        return process.returncode
+
+    def _tune(self, process):
+        """
+        Summary
+        ---
+        Lower the priority of an encode and pin it to a share of the cores no other running encode has (see
+        settings.encode_nice, settings.pin_encode_cores and admission.tune_process).
+
+        :param process: Popen - process of the encode
+        :return: int or None - its slot, handed back once it's done, or None if the settings leave processes be
+        """
+        if not (st.encode_nice or st.pin_encode_cores):
+            return None
+        import admission as ad
+        with self._slots_lock:
+            slot = next(s for s in range(len(self._slots) + 1) if s not in self._slots)
+            self._slots.add(slot)
+        ad.tune_process(process.pid, slot, self.workers)
+        return slot
+
+    def _finish(self, m, returncode: int):
+        """
+        Summary
+        ---
+        Called as each encode finishes.  Move the source out of the queue when the encode succeeded (checked, if it's
+        copied to another disk, before the original is removed - see staging.py).
+
+        :param m: Media - media object that was converted
+        :param returncode: int - return code of the HandBrakeCLI process
         :return: None
         """
-        for m, v in self._clr_str_dict.items():
-            # Convert movie
-            process = subprocess.run(v, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if self.prefetcher:
+            self.prefetcher.release(m.filename)
+        if returncode:
+            enc_fail_msg = '=======================ENCODING FAILED========================='
+            print(f"{enc_fail_msg}\n{m.filename}\n{enc_fail_msg}")
+            if cg.library:
+                cg.library.failed(m.filename)
+        else:
+            if sc.SourceFiles.fingerprints:
+                sc.SourceFiles.fingerprints.add_converted(m, self.get_output_file(m))
+            # Move old source file
+            try:
+                stg.move_file(m.filename, self.get_processed_from_source_path(m.filename))
+            except OSError as e:
+                print(f'>>> Could not move the source out of the queue:\t{m.filename}\n\t\t{e}')
+            if cg.library:
+                cg.library.converted(m, self.get_output_file(m), sc.SourceFiles.metadata.cached(m))
+
+        if self.journal:
+            self.journal.finish(m.filename, returncode)
+
+    def _skip(self, m):
+        """
+        Summary
+        ---
+        Move a source that doesn't need converting (see decisions.py) straight to its place in the output folder.
+
+        :param m: Media - media object to skip
+        :return: None
+        """
+        if os.path.exists(self.get_output_file(m)):
+            print(f'>>> Not replacing a file already converted:\t{self.get_output_file(m)}')
+            return
+        if sc.SourceFiles.fingerprints:
+            sc.SourceFiles.fingerprints.add_converted(m, self.get_output_file(m))
+        stg.move_file(m.filename, self.get_output_file(m))
+        if cg.library:
+            cg.library.converted(m, self.get_output_file(m), sc.SourceFiles.metadata.cached(m))
+        print(f'>>> Skipped, moved as it is:\t{m.filename}')
+
+    def _run_job(self, m, cli_str: str, threads=0, job_id=None, media_secs=None, record_speed=True,
+                 output=None, on_start=None) -> int:
+        """
+        Summary
+        ---
+        Run a job, reporting its progress.  A process that fails to start counts as a failed encode.  Once it
+        succeeds, record how fast it went, to better estimate the next jobs (see speed_history.py).
+
+        The job writes to a partial file, moved to its output once it succeeds, and reads a local copy of its source
+        if one has been prefetched (see staging.py).
+
+        :param m: Media - media object to convert
+        :param cli_str: str - command to run
+        :param threads: int - (optional) threads the encoder may use
+        :param job_id: str - (optional) name of the job in progress reports, defaults to the media's filename
+        :param media_secs: float - (optional) length of media the job encodes, defaults to the media's duration
+        :param record_speed: bool - (optional) whether to record the speed of the job (not for remuxes)
+        :param output: str - (optional) file the job makes (as in cli_str), written to a partial file until it's done
+        :param on_start: callable - (optional) called with the process once it has started
+        :return: int - return code of the process
+        """
+        import progress as pg
+        import scheduling as sch
+        job_id = job_id or m.filename
+        if output and os.path.exists(output):
+            print(f'>>> Not replacing a file already converted:\t{output}')
+            return 1
+        if output:
+            cli_str = cli_str.replace(f'"{output}"', f'"{stg.partial_path(output)}"')
+        if self.prefetcher:
+            cli_str = cli_str.replace(f'"{m.filename}"', f'"{self.prefetcher.local(m.filename)}"')
+        media_secs = m.duration if media_secs is None else media_secs
+        self.progress.start(job_id)
+
+        summary = {}
+
+        def on_line(line):
+            avg_fps = pg.parse_avg_fps(line)
+            if avg_fps is not None:
+                summary['avg_fps'] = avg_fps
+
+        def on_progress(event):
+            if event.avg_fps:
+                summary['avg_fps'] = event.avg_fps
+            self.progress.update(job_id, event)
+
+        started = time.monotonic()
+        try:
+            returncode = self._encode(cli_str, threads, on_progress=on_progress, on_line=on_line, on_start=on_start)
+        except OSError as e:
+            # One encode that fails to start shouldn't stop the rest of the queue
+            print(e)
+            returncode = -1
+        wall_secs = time.monotonic() - started
+        if output:
+            returncode = stg.finish_output(output, returncode)
+        self.progress.finish(job_id, returncode)
+
+        if not returncode:
+            print(f'>>> Converted in {sch.format_secs(wall_secs)}'
+                  + (f' (avg {summary["avg_fps"]:.2f} fps)' if 'avg_fps' in summary else '') + f':\t{job_id}')
+            if sch.history and record_speed:
+                import speed_history as sh
+                sch.history.record(pr.preset_of(m), sh.resolution_of(m), wall_secs, media_secs,
+                                   avg_fps=summary.get('avg_fps'))
+            if cg.library and output:
+                cg.library.job_done(m.filename, wall_secs, output)
+        return returncode
 
-            if process.returncode:
-                enc_fail_msg = '=======================ENCODING FAILED========================='
-                print(f"{enc_fail_msg}\n{m.filename}\n{enc_fail_msg}")
+    def print_plan(self, queue, workers):
+        """
+        Summary
+        ---
+        Print the queued jobs, in order, with an estimate of when each one (and the whole batch) will be done.
+
+        :param queue: list - ordered media objects
+        :param workers: int - number of concurrent encodes
+        :return: None
+        """
+        import scheduling as sch
+        etas, batch_secs = sch.plan_etas(queue, workers, self.decisions)
+        print(f'>>> {len(queue)} job(s) queued, estimated to be done in {sch.format_secs(batch_secs)}:')
+        for m, secs in etas:
+            print(f'\t{sch.format_secs(secs):>8}\t{m.filename}')
+
+    def encode_media(self, m, threads=0):
+        """
+        Summary
+        ---
+        Convert a single media object, straight away, and move its source when done.  Used when media is queued
+        one file at a time (see watcher.py), rather than all at once.  A show file is converted one episode after
+        the other (numbered on from the discs of its season converted before).  A job that isn't due (it failed, and
+        isn't due to be retried yet or has used up its attempts - see journal.py), or is being run by another process,
+        isn't run.  One that doesn't fit alongside the jobs running waits until it does (see admission.py).
+
+        :param m: Media - media object to convert
+        :param threads: int - (optional) threads the encoder may use
+        :return: int or None - return code of the process, or None if the job wasn't due
+        """
+        pr.assign_presets([m])
+        decision = self.decisions[m] = dc.decide(m)
+        if cg.library:
+            cg.library.queued(m, decision.action)
+        if decision.action != dc.ENCODE:
+            print(f'>>> {decision.action.title()} ({decision.reason}):\t{m.filename}')
+        if decision.action == dc.SKIP:
+            self._skip(m)
+            return 0
+
+        cli_str = self.make_remux_str(m) if decision.action == dc.REMUX else self.make_cli_str(m)
+        if self.journal:
+            self.journal.enqueue(m.filename, cli_str)
+            if not self.journal.is_ready(m.filename):
+                print(f'>>> Skipping job not due (failed, or run elsewhere):\t{m.filename}')
+                return None
+        if self.admission:
+            # Wait for the job to fit alongside the others running (memory may free up without one finishing)
+            while not self.admit(m, threads):
+                time.sleep(st.admission_poll_secs)
+        try:
+            returncode = self._encode_media(m, decision, cli_str, threads)
+        finally:
+            if self.admission:
+                self.admission.release(m)
+        self._finish(m, returncode)
+        return returncode
+
+    def _encode_media(self, m, decision, cli_str, threads):
+        """
+        :param m: Media - media object to convert, admitted (see encode_media)
+        :param decision: Decision - what to do with it
+        :param cli_str: str - command to convert it
+        :param threads: int - threads the encoder may use
+        :return: int - return code of the job
+        """
+        if self.journal:
+            self.journal.start(m.filename)
+        on_start = (lambda process: self.admission.started(m, process)) if self.admission else None
+        parts = None
+        if decision.action == dc.ENCODE and isinstance(m, me.Show):
+            import episodes as ep
+            parts = ep.plan_episodes([m], self.get_output_dir).get(m)
+        if decision.action == dc.REMUX:
+            return self._run_job(m, cli_str, record_speed=False, output=self.get_output_file(m), on_start=on_start)
+        if parts is not None:
+            returncode = 0
+            for part in parts:
+                part_str = self.make_cli_str(m, output=part.output, extra_args=part.cli_args())
+                returncode = returncode or self._run_job(m, part_str, threads, job_id=part.job_id,
+                                                         media_secs=part.length, output=part.output,
+                                                         on_start=on_start)
+            return returncode
+        return self._run_job(m, cli_str, threads, output=self.get_output_file(m), on_start=on_start)
+
+    def prepare_queue(self, workers):
+        """
+        Summary
+        ---
+        Move media that doesn't need converting straight to its output folder, then order the jobs to run (see
+        scheduling.py), leaving out failed jobs that aren't due to be retried, and print the plan.  Show files holding
+        several episodes are split up too, and every episode is named by its number (see episodes.py).
+
+        :param workers: int - number of concurrent encodes
+        :return: tuple - list of ordered media objects, and dict of show files (keys) with their episodes (values)
+        """
+        skipped = [m for m, d in self.decisions.items() if d.action == dc.SKIP]
+        for m in skipped:
+            del self.decisions[m]
+            self._skip(m)
+
+        if not self._clr_str_dict:
+            if not skipped:
+                print('>>> No files found to convert!\n'
+                      'Make sure you have media placed in your "TO_CONVERT" folder(s).\n'
+                      'If you do not have any folder structure set up, make sure to\n'
+                      'run this batch file FIRST:\n\n\t'
+                      r'\routine_convert\bin\create_paths.bat')
+            return [], {}
+
+        import episodes as ep
+        import scheduling as sch
+        queue = sch.order_jobs(list(self._clr_str_dict), workers=workers, decisions=self.decisions)
+        if self.journal:
+            for source in self.journal.recover():
+                print(f'>>> Resuming interrupted job:\t{source}')
+            waiting = [m for m in queue if not self.journal.is_ready(m.filename)]
+            for m in waiting:
+                print(f'>>> Skipping failed job (retries exhausted or not due yet):\t{m.filename}')
+            queue = [m for m in queue if m not in waiting]
+
+        self.print_plan(queue, workers)
+
+        # Show files (keys), and the episodes to encode from each (values)
+        episodes = ep.plan_episodes([m for m in queue if isinstance(m, me.Show)
+                                     and self.decisions[m].action == dc.ENCODE], self.get_output_dir)
+        # Every episode converted already, before an earlier attempt failed
+        for m in [m for m, parts in episodes.items() if not parts]:
+            del episodes[m]
+            queue.remove(m)
+            self._finish(m, 0)
+        return queue, episodes
+
+    @staticmethod
+    def split_media(m, episodes, workers):
+        """
+        :param m: Media - media object to encode
+        :param episodes: dict - show files (keys) and their episodes (values), see prepare_queue
+        :param workers: int - number of concurrent encodes
+        :return: list or None - parts (episodes or segments) to encode in place of m, or None to encode it whole
+        """
+        import segments as sg
+        if m in episodes:
+            return episodes[m]
+        if sg.should_segment(m, workers):
+            # Split long titles up
+            return sg.plan_segments(m, st.segment_count or workers)
+        return None
+
+    def admit(self, unit, threads) -> bool:
+        """
+        :param unit: Media or MediaPart - job next in the queue
+        :param threads: int - threads the encoder may use
+        :return: bool - True if it may start now (see admission.py), otherwise it waits for running jobs
+        """
+        m, secs = (unit.media, unit.length) if isinstance(unit, me.MediaPart) else (unit, None)
+        output = unit.output if isinstance(unit, me.MediaPart) else self.get_output_file(m)
+        remux = self.decisions[m].action == dc.REMUX
+        claim = self.admission.claim(m, ps.find_preset(pr.preset_of(m)), output, secs, 0 if remux else threads, remux)
+        return self.admission.admit(unit, claim, unit.job_id if isinstance(unit, me.MediaPart) else m.filename)
+
+    @staticmethod
+    def part_done(part, returncode, split):
+        """
+        Summary
+        ---
+        Count a finished part (episode or segment) of a media object.  Quick, so it can be called with a lock held
+        (see farm.py); the parts are joined up afterwards, by join_parts.
+
+        :param part: MediaPart - part that finished
+        :param returncode: int - return code of the part
+        :param split: dict - media being encoded in parts (keys): the parts, how many are not yet done and the first
+        failure (values)
+        :return: tuple or None - the parts and the first failure once every part is done, otherwise None
+        """
+        m, state = part.media, split[part.media]
+        state[1] -= 1
+        state[2] = state[2] or returncode
+        if state[1]:
+            return None
+        del split[m]
+        return state[0], state[2]
+
+    def join_parts(self, m, parts, returncode) -> int:
+        """
+        :param m: Media - media object encoded in parts
+        :param parts: list - its parts, every one done
+        :param returncode: int - first failure of a part (0 if none)
+        :return: int - return code of the whole media object, once segments are joined up (unless one failed, when
+        they're removed)
+        """
+        import segments as sg
+        if isinstance(parts[0], sg.Segment):
+            if returncode:
+                sg.remove_segments(m)
             else:
-                # Move old source file
-                os.rename(m.filename, self.get_processed_from_source_path(m.filename))
-        else:
-            print('>>> No files found to convert!\n'
-                  'Make sure you have media placed in your "TO_CONVERT" folder(s).\n'
-                  'If you do not have any folder structure set up, make sure to\n'
-                  'run this batch file FIRST:\n\n\t'
-                  r'\routine_convert\bin\create_paths.bat')
+                output = self.get_output_file(m)
+                returncode = stg.finish_output(output, sg.join_segments(parts, stg.partial_path(output)))
+        return returncode
 
-    def run(self):
+    def part_finished(self, part, returncode, split):
+        """
+        Summary
+        ---
+        Count a finished part (episode or segment) of a media object.  Once every part is done, segments are joined
+        up (unless one failed).
+
+        :param part: MediaPart - part that finished
+        :param returncode: int - return code of the part
+        :param split: dict - media being encoded in parts (keys): the parts, how many are not yet done and the first
+        failure (values)
+        :return: int or None - return code of the whole media object once every part is done, otherwise None
+        """
+        done = self.part_done(part, returncode, split)
+        return None if done is None else self.join_parts(part.media, *done)
+
+    def process_cli_strs(self, workers=None):
+        """
+        Summary
+        ---
+        Run the created CLI string(s).  This is expected to kick off handbrake processes, up to "workers" at a
+        time.  Each source is moved to the "processed" folder as soon as its own encode is done.
+
+        :param workers: int - (optional) number of concurrent encodes, defaults to the settings value
+        :return: None
+        """
+        import concurrent.futures
+        workers = max(1, workers or st.encode_workers)
+        queue, episodes = self.prepare_queue(workers)
+        if not queue:
+            return
+        # A single encode is free to use the whole machine
+        threads = self.get_threads_per_job(workers) if workers > 1 else 0
+
+        # Failed jobs (keys) that will be tried again in this run, and when (values)
+        retries = {}
+        # Running jobs: futures (keys) and the media object or part (segment, episode) they are encoding (values)
+        jobs = {}
+        # Media being encoded in parts (keys): the parts, how many are not yet done and the first failure (values)
+        split = {}
+
+        self.workers = workers
+        self.progress.open(workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while queue or jobs or retries:
+                now = time.time()
+                for m in [m for m, at in retries.items() if at <= now]:
+                    del retries[m]
+                    queue.append(m)
+
+                # Only hand the pool as many jobs as it has workers, so the queue stays in our hands.  Jobs that
+                # don't fit yet (see admission.py) hold back the rest of the queue, so it's still run in order
+                blocked = False
+                while queue and len(jobs) < workers:
+                    unit = queue[0]
+                    if not isinstance(unit, me.MediaPart) and self.decisions[unit].action == dc.ENCODE:
+                        parts = self.split_media(unit, episodes, workers)
+                        if parts:
+                            # Queue the parts in place of the media
+                            if self.journal:
+                                self.journal.start(unit.filename)
+                            split[unit] = [parts, len(parts), 0]
+                            queue[:1] = parts
+                            continue
+
+                    if self.admission and not self.admit(unit, threads):
+                        blocked = True
+                        break
+                    queue.pop(0)
+                    on_start = (lambda process, unit=unit: self.admission.started(unit, process)) \
+                        if self.admission else None
+
+                    if isinstance(unit, me.MediaPart):
+                        part_str = self.make_cli_str(unit.media, output=unit.output, extra_args=unit.cli_args())
+                        jobs[pool.submit(self._run_job, unit.media, part_str, threads, job_id=unit.job_id,
+                                         media_secs=unit.length, output=unit.output, on_start=on_start)] = unit
+                        continue
+
+                    if self.journal:
+                        self.journal.start(unit.filename)
+                    remux = self.decisions[unit].action == dc.REMUX
+                    jobs[pool.submit(self._run_job, unit, self._clr_str_dict[unit], 0 if remux else threads,
+                                     record_speed=not remux, output=self.get_output_file(unit),
+                                     on_start=on_start)] = unit
+
+                # Copy the source of the next job to a local disk while these run
+                if self.prefetcher and queue:
+                    unit = queue[0]
+                    self.prefetcher.fetch(unit.media.filename if isinstance(unit, me.MediaPart) else unit.filename)
+
+                timeout = max(0, min(retries.values()) - now) if retries else None
+                if blocked:
+                    # Memory frees up without a job finishing too
+                    timeout = min(timeout, st.admission_poll_secs) if timeout is not None else st.admission_poll_secs
+                if not jobs:
+                    # Nothing running, only failed jobs waiting to be retried (wait() returns straight away)
+                    time.sleep(timeout or 0)
+                    continue
+                done, _ = concurrent.futures.wait(jobs, timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for job in done:
+                    unit, returncode = jobs.pop(job), job.result()
+                    if self.admission:
+                        self.admission.release(unit)
+
+                    if isinstance(unit, me.MediaPart):
+                        m, returncode = unit.media, self.part_finished(unit, returncode, split)
+                        if returncode is None:
+                            continue
+                    else:
+                        m = unit
+
+                    self._finish(m, returncode)
+
+                    retry_at = self.journal.retry_at(m.filename) if self.journal else None
+                    if retry_at is not None:
+                        retries[m] = retry_at
+        self.progress.close()
+
+    @staticmethod
+    def check_presets() -> bool:
+        """
+        Summary
+        ---
+        Check every preset in settings.presets (and settings.preset_rules) is in the presets file, before any job is
+        queued with it.
+
+        :return: bool - True if they all are
+        """
+        pr.check_rules(st.preset_rules)
+        missing = ps.index.missing(list(st.presets.values()) + [r['preset'] for r in st.preset_rules])
+        for name in missing:
+            print(f'>>> Preset not found in "{ps.index.path}":\t{name}')
+        return not missing
+
+    def search_quality(self):
+        """
+        Summary
+        ---
+        For every media object queued to be encoded, search for the highest RF that meets the quality target (see
+        quality.py), and use it in place of the preset's.  A search that fails leaves the preset's RF.
+
+        :return: None
+        """
+        import quality as ql
+        for m in [m for m in self._clr_str_dict if self.decisions[m].action == dc.ENCODE]:
+            def encode_clip(output, extra_args, m=m):
+                return self._encode(self.make_cli_str(m, output=output, extra_args=extra_args, tracks=False))
+
+            try:
+                self.quality[m] = ql.search_rf(m, pr.preset_of(m), encode_clip)
+            except (OSError, subprocess.SubprocessError, ValueError) as e:
+                print(f'>>> Quality search failed, keeping the preset\'s RF:\t{m.filename}\n\t\t{e}')
+                continue
+
+            print(f'>>> {self.quality[m]}:\t{m.filename}')
+            self._clr_str_dict[m] = self.make_cli_str(m)
+            if self.journal:
+                self.journal.enqueue(m.filename, self._clr_str_dict[m])
+
+    def run(self, workers=None):
         """
         Summary
         ---
         Kick-off the conversion!
 
+        :param workers: int - (optional) number of concurrent encodes, defaults to the settings value
         :return: None
         """
+        if not self.check_presets():
+            return
         self.make_cli_str_from_media(self.source_files)
-        self.process_cli_strs()
+        if st.quality_search:
+            self.search_quality()
+        self.process_cli_strs(workers=workers)
+
+
+def list_jobs():
+    """
+    Summary
+    ---
+    Print the media that would be converted, with the preset of the folder each is in, without probing or converting
+    anything (rules picking presets by content need the files probed, see preset_rules.py).
+
+    :return: None
+    """
+    Handbrake.check_presets()
+    media_list = sc.SourceFiles(lazy=True).media
+    for m in media_list:
+        print(f'{pr.preset_of(m)}\t{m.filename}')
+    print(f'>>> {len(media_list)} file(s) to convert')
 
 
 if __name__ == "__main__":
     # For running this as a script in CLI, to begin conversion
-    hb = Handbrake()
-    hb.run()
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert media placed in the "TO_CONVERT" folders.')
+    parser.add_argument('--dry-run', action='store_true', help='list the media that would be converted, and exit')
+    parser.add_argument('--workers', type=int, help='number of concurrent encodes (see settings.encode_workers)')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        list_jobs()
+    else:
+        hb = Handbrake()
+        hb.run(workers=args.workers)
@@ -0,0 +1,105 @@
+"""
+Routine Convert - skip, remux or encode
+
+
+Summary
+-------
+Not every rip needs hours of encoding.  Some are already HEVC at a sensible bit rate, and only need their container
+changed (a remux, which copies the streams as they are and takes seconds) - or nothing at all, if they're already in
+the output container.  Using the probed streams, each source is classified before it's queued, and every decision
+comes with the reason for it.
+
+
+Description
+--------
+Decision (object):              what to do with a source, and why
+target_bit_rate (function):     highest bit rate not worth encoding again, for a video height
+decide (function):              decide what to do with a source
+"""
+import settings as st
+
+
+SKIP = 'skip'
+REMUX = 'remux'
+ENCODE = 'encode'
+
+# Output containers (keys) and the ffprobe format name(s) they show up as (values)
+_CONTAINER_FORMATS = {
+    'av_mkv': ('matroska',),
+    'av_mp4': ('mp4', 'mov'),
+}
+
+# Subtitle codecs that can be copied into an mp4 as they are
+_MP4_SUBTITLES = ('mov_text',)
+
+
+class Decision:
+    """
+    Summary
+    ---
+    What to do with a source (SKIP, REMUX or ENCODE), and the reason for it.
+    """
+    __slots__ = ('action', 'reason')
+
+    def __init__(self, action, reason):
+        self.action = action
+        self.reason = reason
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.action}: {self.reason})'
+
+
+def target_bit_rate(height) -> int:
+    """
+    :param height: (int) height of the video, in pixels
+    :return: (int) bits per second (see settings.target_bit_rates), for the smallest listed height the video fits in
+    """
+    heights = sorted(st.target_bit_rates)
+    fits = [h for h in heights if height <= h]
+    return st.target_bit_rates[fits[0] if fits else heights[-1]]
+
+
+def _in_container(m) -> bool:
+    """
+    :param m: (Media) media object
+    :return: (bool) whether the source is already in the output container (and has its file extension)
+    """
+    formats = _CONTAINER_FORMATS.get(st.container, ())
+    return m.filename.lower().endswith('.' + st.ext) and any(f in m.format_name.split(',') for f in formats)
+
+
+def decide(m):
+    """
+    Summary
+    ---
+    Decide what to do with a source.  It's encoded unless its video is already in one of settings.target_codecs, at
+    or under the target bit rate for its resolution (see target_bit_rate).  Such a source is skipped if it's
+    already in the output container, otherwise remuxed.  Sources whose streams weren't probed are always encoded.
+
+    :param m: (Media) media object
+    :return: (Decision) what to do with it
+    """
+    video = m.video_stream
+    if not st.use_fast_path or video is None:
+        return Decision(ENCODE, 'video stream not probed' if st.use_fast_path else 'fast path is off')
+
+    if video.codec_name not in st.target_codecs:
+        return Decision(ENCODE, f'video is {video.codec_name}, not {"/".join(st.target_codecs)}')
+
+    # Streams in a Matroska file rarely report a bit rate, but the file as a whole does (which is never lower)
+    bit_rate = video.bit_rate or m.bit_rate
+    target = target_bit_rate(video.height)
+    if not bit_rate:
+        return Decision(ENCODE, f'{video.codec_name}, bit rate unknown')
+    if bit_rate > target:
+        return Decision(ENCODE, f'{video.codec_name} at {bit_rate / 10 ** 6:.1f} Mbit/s, above the '
+                                f'{target / 10 ** 6:.1f} Mbit/s target for {video.height}p')
+
+    if _in_container(m):
+        return Decision(SKIP, f'already {video.codec_name} at {bit_rate / 10 ** 6:.1f} Mbit/s in {st.container}')
+
+    if st.container == 'av_mp4' and any(s.codec_name not in _MP4_SUBTITLES for s in m.streams_of_type('subtitle')):
+        return Decision(ENCODE, f'{video.codec_name} at {bit_rate / 10 ** 6:.1f} Mbit/s, but its subtitles can not '
+                                f'be copied into {st.container}')
+
+    return Decision(REMUX, f'{video.codec_name} at {bit_rate / 10 ** 6:.1f} Mbit/s, only the container changes')
@@ -0,0 +1,251 @@
+"""
+Routine Convert - TV show episodes
+
+
+Summary
+-------
+Some TV show rips have a file per episode, some lump a few episodes together in one file.  The chapters of each show
+file are scanned (with ffprobe) and grouped into episode-length runs, so every episode can be encoded as a job of
+its own, named after the show, season and episode number.  Files that hold a single episode (or have no chapters)
+are encoded whole, as before.
+
+Episode numbers carry on from one disc to the next, even when the discs are converted in different runs: the numbers
+given to each file are kept (see EpisodeIndex), and a new disc of a season starts after the last number given so far,
+or the last episode already in the output folder.
+
+
+Description
+--------
+Episode (MediaPart):        a run of chapters of a show file, making up one episode
+scan_chapters (function):   start/end times of each chapter in a file
+build_index (function):     group chapters into episodes
+EpisodeIndex (SqliteStore): episodes found in each file, kept until the file changes, and the numbers they were given
+series_title (function):    title of a show, the same for every season and disc
+last_episode_on_disk (function): last episode of a season already in an output folder
+plan_episodes (function):   episodes of every show file, numbered per show and season
+"""
+import json
+import os
+import re
+import subprocess
+
+import media as me
+import settings as st
+import store
+
+
+# Season and disc markers in a title (e.g. "Season 2", "Disc 1", "S02D1"), which differ between the files of one show
+_SEASON_DISC_RE = re.compile(r'[\s_.-]*\b(?:season[\s_.-]*\d+|s\d+(?:d\d+)?|dis[ck][\s_.-]*\d+|d\d+)\b', re.IGNORECASE)
+
+
+class Episode(me.MediaPart):
+    """
+    Summary
+    ---
+    An episode held in a show file: chapters first_chapter to last_chapter (counted from 1, as HandBrakeCLI does), or
+    the whole file if it holds a single episode (no chapters).
+    """
+    __slots__ = ('first_chapter', 'last_chapter', 'season', 'episode_num')
+
+    def __init__(self, media, index, count, start, length, output, first_chapter, last_chapter, season, episode_num):
+        super().__init__(media, index, count, start, length, output)
+        self.first_chapter = first_chapter
+        self.last_chapter = last_chapter
+        self.season = season
+        self.episode_num = episode_num
+
+    @property
+    def job_id(self):
+        return f'{self.media.filename} [s{self.season:02d}e{self.episode_num:02d}]'
+
+    def cli_args(self) -> str:
+        return f'--chapters {self.first_chapter}-{self.last_chapter}' if self.first_chapter else ''
+
+
+def scan_chapters(file_):
+    """
+    :param file_: (str) path to the media file
+    :return: (list) (start, end) of each chapter, in seconds
+    """
+    out = subprocess.check_output([st.FFPROBE, '-i', file_, '-print_format', 'json', '-show_chapters'],
+                                  stderr=subprocess.PIPE)
+    return [(float(c['start_time']), float(c['end_time'])) for c in json.loads(out).get('chapters', [])]
+
+
+def build_index(chapters, min_secs=None, max_secs=None):
+    """
+    Summary
+    ---
+    Group chapters into episodes.  Chapters are added to an episode until it is at least min_secs long.  A short run
+    of chapters left at the end (credits, extras) is added to the last episode.  A file no longer than max_secs is
+    taken to be a single episode.
+
+    :param chapters: (list) (start, end) of each chapter, in seconds (see scan_chapters)
+    :param min_secs: (optional -> float) shortest episode, defaults to settings.episode_min_minutes
+    :param max_secs: (optional -> float) longest episode, defaults to settings.episode_max_minutes
+    :return: (list) (first chapter, last chapter, start, end) of each episode, chapters counted from 1
+    """
+    min_secs = st.episode_min_minutes * 60 if min_secs is None else min_secs
+    max_secs = st.episode_max_minutes * 60 if max_secs is None else max_secs
+
+    if not chapters or chapters[-1][1] - chapters[0][0] <= max_secs:
+        return []
+
+    episodes = []
+    first = 0
+    for i, (start, end) in enumerate(chapters):
+        if end - chapters[first][0] >= min_secs:
+            episodes.append((first + 1, i + 1, chapters[first][0], end))
+            first = i + 1
+
+    if first < len(chapters):
+        if episodes:
+            first_chapter, _, start, _ = episodes.pop()
+            episodes.append((first_chapter, len(chapters), start, chapters[-1][1]))
+        else:
+            episodes.append((first + 1, len(chapters), chapters[first][0], chapters[-1][1]))
+
+    return episodes if len(episodes) > 1 else []
+
+
+class EpisodeIndex(store.SqliteStore):
+    """
+    Summary
+    ---
+    Episodes found in each show file, so the chapters aren't scanned again until the file's size or modified time
+    changes.  Also the episode numbers each file was given, so they stay the same when it's converted again (after a
+    failure), and the next disc of the season carries on from them.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS episodes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            episodes TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS numbers (
+            path TEXT PRIMARY KEY,
+            series TEXT NOT NULL,
+            season INTEGER NOT NULL,
+            first INTEGER NOT NULL,
+            count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS numbers_season ON numbers (series, season);
+    '''
+
+    def episodes(self, file_):
+        """
+        :param file_: (str) path to the media file
+        :return: (list) episodes in the file (see build_index), empty if the file holds a single episode
+        """
+        stat = os.stat(file_)
+        rows = self.execute('SELECT size, mtime_ns, episodes FROM episodes WHERE path = ?', (file_,))
+        if rows and rows[0][:2] == (stat.st_size, stat.st_mtime_ns):
+            return [tuple(e) for e in json.loads(rows[0][2])]
+
+        found = build_index(scan_chapters(file_))
+        self.execute('INSERT OR REPLACE INTO episodes (path, size, mtime_ns, episodes) VALUES (?, ?, ?, ?)',
+                     (file_, stat.st_size, stat.st_mtime_ns, json.dumps(found)))
+        return found
+
+    def numbers(self, file_, series, season, count, last_on_disk=0) -> int:
+        """
+        Summary
+        ---
+        Number the episodes of a show file: with the numbers it was given before (if it still holds as many
+        episodes), otherwise with the numbers after the last one given for its season (or last_on_disk, if higher).
+
+        :param file_: (str) path to the media file
+        :param series: (str) title of the show (see series_title)
+        :param season: (int) season of the file
+        :param count: (int) number of episodes the file holds
+        :param last_on_disk: (int) last episode number of the season already converted
+        :return: (int) number of the file's first episode
+        """
+        with self._lock:
+            rows = self.execute('SELECT series, season, first, count FROM numbers WHERE path = ?', (file_,))
+            if rows and rows[0][:2] == (series, season) and rows[0][3] == count:
+                return rows[0][2]
+
+            self.execute('DELETE FROM numbers WHERE path = ?', (file_,))
+            last = self.execute('SELECT MAX(first + count - 1) FROM numbers WHERE series = ? AND season = ?',
+                                (series, season))[0][0] or 0
+            first = max(last, last_on_disk) + 1
+            self.execute('INSERT INTO numbers (path, series, season, first, count) VALUES (?, ?, ?, ?, ?)',
+                         (file_, series, season, first, count))
+            return first
+
+
+# Episodes found in each show file (see EpisodeIndex), opened once it's needed
+index = store.Lazy(lambda: EpisodeIndex(st.EPISODE_INDEX_FILE))
+
+
+def series_title(show) -> str:
+    """
+    :param show: (Show) media object
+    :return: (str) title of the show, from its filename without season or disc markers (e.g. "Friends" for
+    "Friends Season 2 Disc 1_t00.mkv").  Not its title: that has already lost the words "season" and "disc", leaving
+    their numbers behind.
+    """
+    name = re.sub(r'[_.]+', ' ', os.path.splitext(os.path.basename(show.filename))[0].split('_t')[0])
+    words = re.findall(r"[^\W_]+(?:'[^\W_]+)?", _SEASON_DISC_RE.sub(' ', name)) or re.findall(r'[^\W_]+', name)
+    return ' '.join(w[0].upper() + w[1:] for w in words)
+
+
+def last_episode_on_disk(folder, series, season) -> int:
+    """
+    :param folder: (str) output folder of a show
+    :param series: (str) title of the show (see series_title)
+    :param season: (int) season
+    :return: (int) highest episode number of the season converted into the folder (0 if none)
+    """
+    tag = re.compile(re.escape(me.Show.make_episode_tagged(series, season, 0))[:-2] + r'(\d+)\b')
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return 0
+    return max((int(found.group(1)) for found in map(tag.match, names) if found), default=0)
+
+
+def plan_episodes(shows, output_dir_of):
+    """
+    Summary
+    ---
+    Split each show file holding several episodes into episode jobs.  Episodes are numbered in filename order, per
+    show and season, carrying on from one file (disc) to the next - and from the discs numbered in earlier runs (see
+    EpisodeIndex.numbers).  A file that holds a single episode is encoded whole, as one episode: numbered and named
+    like the others.  Episodes already in the output folder (converted before the file's last attempt failed) are
+    left out.
+
+    :param shows: (list) Show objects
+    :param output_dir_of: (callable) returns the output folder for a Show
+    :return: (dict) episodes left to encode (values, which may be none) of each show file (keys)
+    """
+    plans = {}
+
+    for show in sorted(shows, key=lambda m: m.filename):
+        series = series_title(show)
+        try:
+            found = index.episodes(show.filename)
+        except (OSError, subprocess.SubprocessError, ValueError) as e:
+            print(f'>>> Could not scan chapters, converting as one episode:\t{show.filename}\n\t\t{e}')
+            found = []
+
+        output_dir = output_dir_of(show)
+        first = index.numbers(show.filename, series, show.season, len(found) or 1,
+                              last_episode_on_disk(output_dir, series, show.season))
+        # A single episode, with no chapters to pick
+        found = found or [(None, None, 0.0, show.duration)]
+
+        episodes = []
+        for i, (first_chapter, last_chapter, start, end) in enumerate(found):
+            name = me.Show.make_episode_tagged(series, show.season, first + i)
+            output = os.path.join(output_dir, f'{name}.{st.ext}')
+            episodes.append(Episode(show, i, len(found), start, end - start, output, first_chapter, last_chapter,
+                                    show.season, first + i))
+        for episode in episodes:
+            if os.path.exists(episode.output):
+                print(f'>>> Episode already converted:\t{episode.output}')
+        plans[show] = [e for e in episodes if not os.path.exists(e.output)]
+
+    return plans
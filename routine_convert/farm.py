@@ -0,0 +1,610 @@
+"""
+Routine Convert - encode farm
+
+
+Summary
+-------
+One machine can only encode so much.  The queue can be shared by several: a coordinator finds, plans and orders the
+jobs (just as a local run does), and workers on other machines lease jobs from it over HTTP, run them and report
+back.  Only the coordinator touches the queue and the journal: a source is moved to "SOURCE_PROCESSED" once the
+coordinator has been told its job succeeded, never by a worker.
+
+A lease is only good for settings.farm_lease_secs, and a worker renews it with a heartbeat while its job runs (the
+heartbeat also carries the job's progress).  If a worker dies or loses the network, its lease runs out and the job
+is handed to the next worker that asks.  A worker whose lease was taken back stops its encode, and its result is
+turned down.
+
+Every machine must see the media root (and the data folder, for episodes) at the same path, e.g. on a network share,
+or map the coordinator's paths to its own with settings.farm_path_map.  Titles are leased whole (or by episode); long
+titles are not split into segments, since the farm already spreads titles over machines.
+
+
+Description
+--------
+is_loopback (function): whether an address is only reachable from this machine
+Lease (object):         a job leased to a worker, until it expires
+Coordinator (object):   owns the queue, and hands out jobs to workers over HTTP
+Worker (object):        leases jobs from a coordinator and runs them
+"""
+import argparse
+import concurrent.futures
+import http.server
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+import urllib.request
+import uuid
+
+import catalogue as cg
+import convert_to as ct
+import decisions as dc
+import media as me
+import preset_rules as pr
+import presets as ps
+import progress as pg
+import scheduling as sch
+import speed_history as sh
+import settings as st
+import staging as stg
+
+
+# Header workers send settings.farm_token in
+_TOKEN_HEADER = 'X-Routine-Convert-Token'
+
+# Seconds to wait for the coordinator to answer a request
+_TIMEOUT_SECS = 30
+
+# Executables in job commands (settings names), swapped for the worker's own
+_BINS = ('HB_BIN', 'FFMPEG')
+
+
+def is_loopback(host) -> bool:
+    """
+    :param host: (str) host name or address to listen on
+    :return: (bool) whether only this machine can reach it
+    """
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (OSError, ValueError):
+        return False
+
+
+class Lease:
+    """
+    Summary
+    ---
+    A job (a media object, or a part of one) leased to a worker.  The token identifies the lease in every request
+    the worker makes about it.
+    """
+    __slots__ = ('token', 'unit', 'worker', 'expires')
+
+    def __init__(self, unit, worker, expires):
+        self.token = uuid.uuid4().hex
+        self.unit = unit
+        self.worker = worker
+        self.expires = expires
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.job_id} -> {self.worker})'
+
+    @property
+    def job_id(self) -> str:
+        return self.unit.job_id if isinstance(self.unit, me.MediaPart) else self.unit.filename
+
+
+class Coordinator:
+    """
+    Summary
+    ---
+    Owns the queue a local run would have (see convert_to.Handbrake), and hands its jobs out to workers.  Requests
+    (JSON, POSTed):
+
+    - /lease:       {"worker"} -> the next job and its lease, {"done": true} once every job is finished, or neither
+                    if jobs are still running (ask again later)
+    - /heartbeat:   {"worker", "lease", "progress"} -> {"renewed"}, False if the lease was taken back
+    - /finish:      {"worker", "lease", "returncode", "wall_secs", "avg_fps"} -> {"confirmed"}, False if the lease was
+                    taken back (the result is ignored)
+
+    And GET /status for the number of jobs queued, leased and waiting to be retried.
+    """
+    def __init__(self, handbrake=None, address=None):
+        """
+        :param handbrake: (optional -> Handbrake) instance to plan and finish jobs with
+        :param address: (optional -> tuple) host and port to listen on, defaults to the settings values
+        """
+        self.handbrake = handbrake or ct.Handbrake()
+        self.address = address or (st.farm_host, st.farm_port)
+        # Media objects and parts waiting to be leased, in order
+        self.queue = []
+        # Show files (keys) and the episodes to encode from each (values)
+        self.episodes = {}
+        # Leases (values) by token (keys)
+        self.leases = {}
+        # Failed jobs (keys) that will be tried again, and when (values)
+        self.retries = {}
+        # Media being encoded in parts (keys): the parts, how many are not yet done and the first failure (values)
+        self.split = {}
+        # Results being taken (see finish), whose jobs may still be retried
+        self.finishing = 0
+        # Media whose job has been started in the journal, until a worker reports its result.  A lease that runs out
+        # isn't a failed attempt: the job is leased again without starting it again.
+        self.started = set()
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def finished(self) -> bool:
+        with self._lock:
+            return not (self.queue or self.leases or self.retries or self.finishing)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'queued': len(self.queue),
+                'leased': [{'job': lease.job_id, 'worker': lease.worker} for lease in self.leases.values()],
+                'retries': len(self.retries),
+            }
+
+    def _reap(self, now):
+        """
+        Queue jobs whose lease has run out again (in front, they were due first), and failed jobs due to be retried.
+        Call with the lock held.
+
+        :param now: (float) current time
+        :return: None
+        """
+        for token in [t for t, lease in self.leases.items() if lease.expires <= now]:
+            lease = self.leases.pop(token)
+            print(f'>>> Lease ran out ({lease.worker} stopped answering), queued again:\t{lease.job_id}')
+            self.handbrake.progress.finish(lease.job_id, -1)
+            self.queue.insert(0, lease.unit)
+        for m in [m for m, at in self.retries.items() if at <= now]:
+            del self.retries[m]
+            self.queue.append(m)
+
+    def _next_unit(self):
+        """
+        The next media object or part to lease.  Show files are split into their episodes as they come up.  Call
+        with the lock held.
+
+        :return: (Media, MediaPart or None) what to lease next, or None if nothing is queued
+        """
+        while self.queue:
+            unit = self.queue.pop(0)
+            if isinstance(unit, me.MediaPart):
+                return unit
+
+            if self.handbrake.journal and unit not in self.started:
+                self.handbrake.journal.start(unit.filename)
+            self.started.add(unit)
+            parts = self.handbrake.split_media(unit, self.episodes, workers=1) \
+                if self.handbrake.decisions[unit].action == dc.ENCODE else None
+            if not parts:
+                return unit
+            # Queue the parts in place of the media
+            self.split[unit] = [parts, len(parts), 0]
+            self.queue[:0] = parts
+        return None
+
+    def _job(self, lease) -> dict:
+        """
+        :param lease: (Lease) lease of the job
+        :return: (dict) what a worker needs to run the job: its command, what it does (see decisions.py), the file
+        it makes, and the single-preset file it imports
+        """
+        unit = lease.unit
+        m = unit.media if isinstance(unit, me.MediaPart) else unit
+        if isinstance(unit, me.MediaPart):
+            output = unit.output
+            cli_str = self.handbrake.make_cli_str(m, output=output, extra_args=unit.cli_args())
+        else:
+            output = self.handbrake.get_output_file(m)
+            cli_str = self.handbrake._clr_str_dict[m]
+
+        job = {
+            'lease': lease.token,
+            'job_id': lease.job_id,
+            'cli_str': cli_str,
+            'action': self.handbrake.decisions[m].action,
+            'output': output,
+            'bins': {k: getattr(st, k) for k in _BINS},
+            'lease_secs': st.farm_lease_secs,
+            'heartbeat_secs': st.farm_heartbeat_secs,
+        }
+        if self.handbrake.decisions[m].action == dc.ENCODE:
+            job['preset_file'] = ps.index.import_file(pr.preset_of(m))
+            with open(job['preset_file']) as f:
+                job['preset'] = json.load(f)
+        return job
+
+    def lease(self, worker) -> dict:
+        """
+        :param worker: (str) name of the worker asking
+        :return: (dict) the job leased, or {"done": True} if there are none left at all
+        """
+        now = time.time()
+        with self._lock:
+            self._reap(now)
+            unit = self._next_unit()
+            if unit is None:
+                return {'done': not (self.leases or self.retries or self.finishing)}
+            lease = Lease(unit, worker, now + st.farm_lease_secs)
+            self.leases[lease.token] = lease
+            job = self._job(lease)
+
+        print(f'>>> Leased to {worker}:\t{lease.job_id}')
+        self.handbrake.progress.start(lease.job_id)
+        return job
+
+    def heartbeat(self, worker, token, progress=None) -> dict:
+        """
+        :param worker: (str) name of the worker
+        :param token: (str) lease token
+        :param progress: (optional -> dict) progress of the job (see progress.ProgressEvent)
+        :return: (dict) whether the lease was renewed
+        """
+        with self._lock:
+            lease = self.leases.get(token)
+            if lease is None or lease.worker != worker:
+                return {'renewed': False}
+            lease.expires = time.time() + st.farm_lease_secs
+
+        if progress:
+            self.handbrake.progress.update(lease.job_id, pg.ProgressEvent(**progress))
+        return {'renewed': True}
+
+    def finish(self, worker, token, returncode, wall_secs=0.0, avg_fps=None) -> dict:
+        """
+        Summary
+        ---
+        Take the result of a leased job.  Only now is the source moved (when the whole media object is done), and
+        a failed job queued to be retried (see journal.py).  The lock is only held to settle the lease and count the
+        part: moving files and writing the journal and catalogue would hold up other workers' leases and heartbeats.
+
+        :param worker: (str) name of the worker
+        :param token: (str) lease token
+        :param returncode: (int) return code of the job
+        :param wall_secs: (float) how long the job took
+        :param avg_fps: (optional -> float) average fps of the job
+        :return: (dict) whether the result was taken
+        """
+        with self._lock:
+            lease = self.leases.get(token)
+            if lease is None or lease.worker != worker:
+                return {'confirmed': False}
+            del self.leases[token]
+            self.finishing += 1
+
+        retry_at = None
+        try:
+            unit = lease.unit
+            m = unit.media if isinstance(unit, me.MediaPart) else unit
+            self.handbrake.progress.finish(lease.job_id, returncode)
+            if returncode:
+                print(f'>>> Failed on {worker} (returned {returncode}):\t{lease.job_id}')
+            else:
+                print(f'>>> Converted in {sch.format_secs(wall_secs)} on {worker}'
+                      + (f' (avg {avg_fps:.2f} fps)' if avg_fps else '') + f':\t{lease.job_id}')
+                if sch.history and self.handbrake.decisions[m].action == dc.ENCODE:
+                    media_secs = unit.length if isinstance(unit, me.MediaPart) else m.duration
+                    sch.history.record(pr.preset_of(m), sh.resolution_of(m), wall_secs, media_secs, avg_fps=avg_fps)
+                if cg.library:
+                    output = unit.output if isinstance(unit, me.MediaPart) else self.handbrake.get_output_file(m)
+                    cg.library.job_done(m.filename, wall_secs, output)
+
+            if isinstance(unit, me.MediaPart):
+                with self._lock:
+                    done = self.handbrake.part_done(unit, returncode, self.split)
+                if done is None:
+                    return {'confirmed': True}
+                returncode = self.handbrake.join_parts(m, *done)
+
+            self.handbrake._finish(m, returncode)
+            retry_at = self.handbrake.journal.retry_at(m.filename) if self.handbrake.journal else None
+        finally:
+            with self._lock:
+                self.finishing -= 1
+                self.started.discard(m)
+                if retry_at is not None:
+                    self.retries[m] = retry_at
+        return {'confirmed': True}
+
+    def _make_server(self):
+        """
+        :return: (ThreadingHTTPServer) server answering workers' requests
+        """
+        coordinator = self
+        routes = {
+            '/lease': lambda r: coordinator.lease(r['worker']),
+            '/heartbeat': lambda r: coordinator.heartbeat(r['worker'], r['lease'], r.get('progress')),
+            '/finish': lambda r: coordinator.finish(r['worker'], r['lease'], r['returncode'], r.get('wall_secs', 0.0),
+                                                    r.get('avg_fps')),
+        }
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _reply(self, body):
+                body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != '/status':
+                    self.send_error(404)
+                    return
+                self._reply(coordinator.status())
+
+            def do_POST(self):
+                if self.path not in routes:
+                    self.send_error(404)
+                    return
+                if st.farm_token and self.headers.get(_TOKEN_HEADER) != st.farm_token:
+                    self.send_error(403)
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    reply = routes[self.path](request)
+                except (ValueError, KeyError, TypeError) as e:
+                    self.send_error(400, str(e))
+                    return
+                self._reply(reply)
+
+            def log_message(self, *args):
+                pass
+
+        return http.server.ThreadingHTTPServer(self.address, Handler)
+
+    def run(self, workers=None):
+        """
+        Summary
+        ---
+        Find and plan the jobs, as a local run would, then hand them out until every one is finished (or has run
+        out of retries).
+
+        :param workers: int - (optional) number of workers expected (to order jobs and estimate the plan), defaults
+        to the settings value
+        :return: None
+        """
+        hb = self.handbrake
+        if not st.farm_token and not is_loopback(self.address[0]):
+            print(f'>>> Not listening on {self.address[0]} without a farm_token (see settings.py): anyone who can '
+                  f'reach it could lease its jobs or report them done')
+            return
+        if not hb.check_presets():
+            return
+        hb.make_cli_str_from_media(hb.source_files)
+        if st.quality_search:
+            hb.search_quality()
+
+        workers = max(1, workers or st.encode_workers)
+        queue, self.episodes = hb.prepare_queue(workers)
+        with self._lock:
+            self.queue = queue
+        if not queue:
+            return
+
+        self._server = self._make_server()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f'>>> Coordinator listening on {self.address[0]}:{self.address[1]}')
+        hb.progress.open(workers)
+        try:
+            while not self.finished:
+                time.sleep(1)
+                with self._lock:
+                    self._reap(time.time())
+            # Workers asking for more in the meantime are told there's nothing left
+            time.sleep(st.farm_poll_secs)
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+            hb.progress.close()
+
+
+class Worker:
+    """
+    Summary
+    ---
+    Lease jobs from a coordinator, run them and report back, until the coordinator has none left (or can't be
+    reached for longer than a lease lasts).
+    """
+    def __init__(self, url=None, name=None):
+        """
+        :param url: (optional -> str) address of the coordinator, defaults to settings.farm_url
+        :param name: (optional -> str) name of the worker, defaults to "<host name>-<process id>"
+        """
+        self.url = (url or st.farm_url).rstrip('/')
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.handbrake = ct.Handbrake()
+
+    def _call(self, path, body) -> dict:
+        """
+        :param path: (str) request path, e.g. "/lease"
+        :param body: (dict) request
+        :return: (dict) reply (raises OSError if the coordinator can't be reached, or turns the request down)
+        """
+        request = urllib.request.Request(self.url + path, data=json.dumps(dict(body, worker=self.name)).encode(),
+                                         headers={'Content-Type': 'application/json', _TOKEN_HEADER: st.farm_token},
+                                         method='POST')
+        with urllib.request.urlopen(request, timeout=_TIMEOUT_SECS) as response:
+            return json.load(response)
+
+    @staticmethod
+    def map_path(path) -> str:
+        """
+        :param path: (str) path on the coordinator
+        :return: (str) where this machine sees it (see settings.farm_path_map)
+        """
+        for remote, local in st.farm_path_map.items():
+            if path.startswith(remote):
+                return local + path[len(remote):]
+        return path
+
+    @staticmethod
+    def localize(job) -> str:
+        """
+        Summary
+        ---
+        Command of a job, made to run on this machine: with this machine's executables, its own copy of the
+        single-preset file, and paths mapped (see settings.farm_path_map).
+
+        :param job: (dict) job leased from the coordinator
+        :return: (str) command to run
+        """
+        cli_str = job['cli_str']
+        for k, path in job['bins'].items():
+            cli_str = cli_str.replace(f'"{path}"', f'"{getattr(st, k)}"')
+
+        if 'preset' in job:
+            preset_file = os.path.join(st.PRESET_CACHE_DIR, os.path.basename(job['preset_file']))
+            os.makedirs(st.PRESET_CACHE_DIR, exist_ok=True)
+            # Written aside and renamed, so another job starting at the same time never reads half a file
+            partial = f'{preset_file}.{os.getpid()}.{threading.get_ident()}'
+            with open(partial, 'w') as f:
+                json.dump(job['preset'], f, indent=1)
+            os.replace(partial, preset_file)
+            cli_str = cli_str.replace(f'"{job["preset_file"]}"', f'"{preset_file}"')
+
+        for remote, local in st.farm_path_map.items():
+            cli_str = cli_str.replace(f'"{remote}', f'"{local}')
+        return cli_str
+
+    def run_job(self, job, threads=0) -> int:
+        """
+        Summary
+        ---
+        Run a leased job, renewing its lease (and reporting progress) every few seconds.  If the lease is taken
+        back, the encode is stopped.  The job writes to a partial file, moved into place once it succeeds (see
+        staging.py), before the coordinator is told.
+
+        :param job: (dict) job leased from the coordinator
+        :param threads: (int) threads the encoder may use (not passed on to a remux)
+        :return: (int or None) return code of the job, or None if the lease was taken back
+        """
+        if job.get('action', dc.ENCODE) != dc.ENCODE:
+            # ffmpeg doesn't take HandBrakeCLI's encoder options
+            threads = 0
+        print(f'>>> Started:\t{job["job_id"]}')
+        state = {'event': None, 'avg_fps': None, 'process': None}
+        done, lost = threading.Event(), threading.Event()
+
+        def on_line(line):
+            avg_fps = pg.parse_avg_fps(line)
+            if avg_fps is not None:
+                state['avg_fps'] = avg_fps
+
+        def on_progress(event):
+            state['event'] = event
+
+        def on_start(process):
+            state['process'] = process
+            if lost.is_set():
+                process.terminate()
+
+        def heartbeat():
+            while not done.wait(job['heartbeat_secs']):
+                event = state['event']
+                try:
+                    renewed = self._call('/heartbeat', {'lease': job['lease'],
+                                                        'progress': event.as_dict() if event else None})['renewed']
+                except OSError as e:
+                    # Keep going, the coordinator may be back before the lease runs out
+                    print(f'>>> Heartbeat failed:\t{e}')
+                    continue
+                if not renewed:
+                    lost.set()
+                    if state['process']:
+                        state['process'].terminate()
+                    return
+
+        output = self.map_path(job['output'])
+        cli_str = self.localize(job).replace(f'"{output}"', f'"{stg.partial_path(output)}"')
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        started = time.monotonic()
+        try:
+            returncode = self.handbrake._encode(cli_str, threads, on_progress=on_progress, on_line=on_line,
+                                                on_start=on_start)
+        except OSError as e:
+            # Reported as a failed job, so the coordinator can retry it
+            print(e)
+            returncode = -1
+        finally:
+            done.set()
+        wall_secs = time.monotonic() - started
+
+        if lost.is_set():
+            stg.finish_output(output, returncode or -1)
+            print(f'>>> Lease taken back, stopped:\t{job["job_id"]}')
+            return None
+        returncode = stg.finish_output(output, returncode)
+        try:
+            confirmed = self._call('/finish', {'lease': job['lease'], 'returncode': returncode, 'wall_secs': wall_secs,
+                                               'avg_fps': state['avg_fps']})['confirmed']
+        except OSError as e:
+            confirmed = False
+            print(f'>>> Could not report the result:\t{e}')
+        print(f'>>> {"Finished" if confirmed else "Result turned down"} (returned {returncode}):\t{job["job_id"]}')
+        return returncode
+
+    def _work(self, threads):
+        """
+        Lease and run jobs, one after the other, until there are none left.
+
+        :param threads: (int) threads the encoder may use
+        :return: None
+        """
+        unreachable_since = None
+        while True:
+            try:
+                job = self._call('/lease', {})
+            except OSError as e:
+                unreachable_since = unreachable_since or time.monotonic()
+                if time.monotonic() - unreachable_since > st.farm_lease_secs:
+                    print(f'>>> Coordinator at {self.url} could not be reached, stopping:\t{e}')
+                    return
+                time.sleep(st.farm_poll_secs)
+                continue
+
+            unreachable_since = None
+            if job.get('done'):
+                return
+            if 'lease' in job:
+                self.run_job(job, threads)
+            else:
+                # Nothing to lease yet (jobs still running elsewhere may fail, and be retried)
+                time.sleep(st.farm_poll_secs)
+
+    def run(self, workers=None):
+        """
+        :param workers: int - (optional) number of jobs to run at once on this machine, defaults to the settings value
+        :return: None
+        """
+        workers = max(1, workers or st.encode_workers)
+        # A single encode is free to use the whole machine
+        threads = self.handbrake.get_threads_per_job(workers) if workers > 1 else 0
+        self.handbrake.workers = workers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for job in [pool.submit(self._work, threads) for _ in range(workers)]:
+                job.result()
+
+
+if __name__ == "__main__":
+    # For running this as a script in CLI, to share the queue between machines
+    parser = argparse.ArgumentParser(description='Share the conversion queue between several machines.')
+    parser.add_argument('role', choices=['coordinator', 'worker'],
+                        help='"coordinator" finds the media and hands out jobs, "worker" runs them')
+    parser.add_argument('--workers', type=int,
+                        help='jobs run at once by a worker (or workers expected, for the coordinator)')
+    parser.add_argument('--port', type=int, help='port the coordinator listens on (see settings.farm_port)')
+    parser.add_argument('--url', help='address of the coordinator, for a worker (see settings.farm_url)')
+    args = parser.parse_args()
+
+    if args.role == 'coordinator':
+        Coordinator(address=(st.farm_host, args.port or st.farm_port)).run(workers=args.workers)
+    else:
+        Worker(url=args.url).run(workers=args.workers)
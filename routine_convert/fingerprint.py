@@ -0,0 +1,305 @@
+"""
+Routine Convert - duplicate sources
+
+
+Summary
+-------
+The same disc gets ripped twice, or both the DVD and the Blu-Ray of a title end up in "TO_CONVERT" - and each copy
+costs hours of encoding.  As sources are found, each is fingerprinted: its size and a few blocks sampled across it
+are hashed, so even a file of many GB is fingerprinted from a couple of MB (read through mmap, so only the pages
+sampled are read from disk).  Fingerprints are kept between runs, and only worked out again when a file changes.
+
+Two sources with the same fingerprint are the same file.  Two probed movies with the same title and (about) the
+same length are the same title, even when ripped differently; the one with the larger video is kept (the Blu-Ray,
+over the DVD).  Shows are only compared by fingerprint: the episodes ripped from a disc ("X_t00", "X_t01"...) share
+a title, and are about the same length.  For the same reason, titles ripped from one disc are never taken for each
+other.  Sources are also checked against every source converted before (kept in an index, once their job
+succeeds), so a title already in "CONVERTED" isn't converted again - unless the new source is larger.
+
+
+Description
+--------
+fingerprint (function):         fingerprint of a file, from its size and sampled blocks
+title_key (function):           title of a media object, as compared between sources
+Duplicate (object):             a source that duplicates another, and why
+FingerprintIndex (SqliteStore): fingerprints of sources, and the sources converted so far
+find_duplicates (function):     sources that duplicate another source, or one already converted
+"""
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import re
+import time
+
+import media as me
+import settings as st
+import store
+
+
+def fingerprint(path) -> str:
+    """
+    Summary
+    ---
+    Hash the size of a file and settings.fingerprint_samples blocks spread evenly across it (the first and last
+    included).  Small files are hashed whole.
+
+    :param path: (str) file
+    :return: (str) fingerprint (BLAKE2b, hex)
+    """
+    size = os.path.getsize(path)
+    block = st.fingerprint_block_kb * 2 ** 10
+    samples = max(2, st.fingerprint_samples)
+
+    digest = hashlib.blake2b(size.to_bytes(8, 'little'), digest_size=20)
+    with open(path, 'rb') as f:
+        if size <= block * samples:
+            for chunk in iter(lambda: f.read(block), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+        offsets = [i * (size - block) // (samples - 1) for i in range(samples)]
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    # Don't read ahead past the sampled blocks
+                    mapped.madvise(mmap.MADV_RANDOM)
+                for offset in offsets:
+                    digest.update(mapped[offset:offset + block])
+        except (OSError, ValueError, OverflowError):
+            # Can't be mapped (a 32-bit python, or some network shares): read the same blocks instead
+            digest = hashlib.blake2b(size.to_bytes(8, 'little'), digest_size=20)
+            for offset in offsets:
+                f.seek(offset)
+                digest.update(f.read(block))
+    return digest.hexdigest()
+
+
+def title_key(m) -> str:
+    """
+    :param m: (Media) media object
+    :return: (str) its title, lower case with only letters and digits
+    """
+    return ' '.join(re.findall(r'[a-z0-9]+', m.title.lower()))
+
+
+def _same_disc(m, other) -> bool:
+    """
+    :return: (bool) whether two sources are titles ripped from the same disc (MakeMKV names them "<disc>_t00",
+    "<disc>_t01"...)
+    """
+    return os.path.dirname(m.filename) == os.path.dirname(other.filename) and m.basename == other.basename
+
+
+def _height(m) -> int:
+    video = m.video_stream
+    return video.height if video else 0
+
+
+def _same_length(secs, other_secs) -> bool:
+    """
+    :return: (bool) whether two lengths are within settings.duplicate_length_tolerance (a share) of each other
+    """
+    return bool(secs and other_secs) and abs(secs - other_secs) <= st.duplicate_length_tolerance * max(secs,
+                                                                                                       other_secs)
+
+
+class Duplicate:
+    """
+    Summary
+    ---
+    A source that duplicates another: a source found in the same search, or one converted before.
+    """
+    SAME_FILE = 'same file'
+    SAME_TITLE = 'same title and length'
+
+    __slots__ = ('media', 'original', 'reason', 'converted')
+
+    def __init__(self, media, original, reason, converted=False):
+        """
+        :param media: (Media) the duplicate
+        :param original: (str) source it duplicates (or, if converted, the file it was converted to)
+        :param reason: (str) SAME_FILE or SAME_TITLE
+        :param converted: (bool) whether the original was converted before
+        """
+        self.media = media
+        self.original = original
+        self.reason = reason
+        self.converted = converted
+
+    def __repr__(self):
+        converted = 'already converted to ' if self.converted else ''
+        return f'{self.media.filename}\n\t\t{self.reason} as {converted}{self.original}'
+
+
+class FingerprintIndex(store.SqliteStore):
+    schema = '''
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS converted (
+            fingerprint TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            duration REAL NOT NULL,
+            height INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            output TEXT NOT NULL,
+            converted REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS converted_title ON converted (title);
+    '''
+
+    def fingerprint(self, path, stored_only=False) -> str:
+        """
+        Summary
+        ---
+        Fingerprint of a file: the one kept from before if the file hasn't changed (size and modified time), otherwise
+        worked out and kept.
+
+        :param path: (str) file
+        :param stored_only: (optional -> bool) only return a fingerprint kept from before, without reading the file
+        :return: (str or None) fingerprint, or None if stored_only and there's none kept for the file as it is
+        """
+        stat = os.stat(path)
+        rows = self.execute('SELECT size, mtime_ns, fingerprint FROM fingerprints WHERE path = ?', (path,))
+        if rows and rows[0][:2] == (stat.st_size, stat.st_mtime_ns):
+            return rows[0][2]
+        if stored_only:
+            return None
+
+        fingerprint_ = fingerprint(path)
+        self.execute('INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, fingerprint) VALUES (?, ?, ?, ?)',
+                     (path, stat.st_size, stat.st_mtime_ns, fingerprint_))
+        return fingerprint_
+
+    def fingerprint_all(self, paths, workers=None, stored_only=False) -> dict:
+        """
+        :param paths: (list) files
+        :param workers: (optional -> int) number of files read at once, defaults to settings.probe_workers
+        :param stored_only: (optional -> bool) only use fingerprints kept from before, without reading any file
+        :return: (dict) fingerprints (values) of the files (keys) that could be read (or had one kept)
+        """
+        results = {}
+        if stored_only:
+            for p in paths:
+                try:
+                    fingerprint_ = self.fingerprint(p, stored_only=True)
+                except OSError:
+                    continue
+                if fingerprint_ is not None:
+                    results[p] = fingerprint_
+            return results
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or st.probe_workers) as pool:
+            futures = {pool.submit(self.fingerprint, p): p for p in paths}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except OSError:
+                    continue
+        return results
+
+    def add_converted(self, m, output):
+        """
+        Summary
+        ---
+        Remember a source once its job has succeeded (call before it's moved out of "TO_CONVERT").
+
+        :param m: (Media) media object that was converted
+        :param output: (str) file it was converted to
+        :return: None
+        """
+        try:
+            fingerprint_ = self.fingerprint(m.filename)
+        except OSError:
+            return
+        self.execute('INSERT OR REPLACE INTO converted (fingerprint, title, duration, height, source, output, '
+                     'converted) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (fingerprint_, title_key(m), m.duration, _height(m), m.filename, output, time.time()))
+
+    def converted_file(self, fingerprint_):
+        """
+        :param fingerprint_: (str) fingerprint of a source
+        :return: (str or None) file a source with that fingerprint was converted to, if any
+        """
+        rows = self.execute('SELECT output FROM converted WHERE fingerprint = ?', (fingerprint_,))
+        return rows[0][0] if rows else None
+
+    def converted_title(self, m):
+        """
+        :param m: (Media) probed media object
+        :return: (tuple or None) file a source of the same title and length (not ripped from the same disc) was
+        converted to, and the height of its video - or None, if there's none
+        """
+        rows = self.execute('SELECT output, duration, height, source FROM converted WHERE title = ?', (title_key(m),))
+        folder = os.path.dirname(m.filename)
+        for output, duration, height, source in rows:
+            same_disc = os.path.dirname(source) == folder and os.path.basename(source).split('_t')[0] == m.basename
+            if _same_length(m.duration, duration) and not same_disc:
+                return output, height
+        return None
+
+    def evict_missing(self):
+        """
+        Summary
+        ---
+        Forget fingerprints of files which no longer exist (sources already converted stay in the index).
+
+        :return: (int) number of entries removed
+        """
+        missing = [(p,) for (p,) in self.execute('SELECT path FROM fingerprints') if not os.path.exists(p)]
+        self.executemany('DELETE FROM fingerprints WHERE path = ?', missing)
+        return len(missing)
+
+
+def find_duplicates(media_list, index, stored_only=False) -> dict:
+    """
+    Summary
+    ---
+    Find the sources in media_list that duplicate another one in it, or one converted before.  Of the same file,
+    the first found is kept; of the same title, the one with the larger video (then the larger file).  Titles are
+    only compared between probed movies (lazy ones are only compared by fingerprint, so they aren't probed here), and
+    never between titles of the same disc.
+
+    :param media_list: (list) media objects found
+    :param index: (FingerprintIndex) fingerprints, and the sources converted so far
+    :param stored_only: (optional -> bool) only compare files by the fingerprints kept from before, without reading
+    them (for a quick, lazy search)
+    :return: (dict) Duplicate (values) for each media object (keys) that is one
+    """
+    duplicates = {}
+    fingerprints = index.fingerprint_all([m.filename for m in media_list], stored_only=stored_only)
+
+    # The same file
+    firsts = {}
+    for m in media_list:
+        fingerprint_ = fingerprints.get(m.filename)
+        if fingerprint_ is None:
+            continue
+        converted = index.converted_file(fingerprint_)
+        if converted:
+            duplicates[m] = Duplicate(m, converted, Duplicate.SAME_FILE, converted=True)
+        elif fingerprint_ in firsts:
+            duplicates[m] = Duplicate(m, firsts[fingerprint_].filename, Duplicate.SAME_FILE)
+        else:
+            firsts[fingerprint_] = m
+
+    # The same title, best source first
+    titles = {}
+    probed = [m for m in media_list if m.probed and isinstance(m, me.Movie) and m not in duplicates and m.duration]
+    for m in sorted(probed, key=lambda m: (_height(m), m.size), reverse=True):
+        key = title_key(m)
+        kept = next((k for k in titles.get(key, ())
+                     if _same_length(m.duration, k.duration) and not _same_disc(m, k)), None)
+        if kept:
+            duplicates[m] = Duplicate(m, kept.filename, Duplicate.SAME_TITLE)
+            continue
+        converted = index.converted_title(m)
+        if converted and _height(m) <= converted[1]:
+            duplicates[m] = Duplicate(m, converted[0], Duplicate.SAME_TITLE, converted=True)
+            continue
+        titles.setdefault(key, []).append(m)
+    return duplicates
@@ -38,6 +38,13 @@ class Hierarchy:
         """
         return self.process_paths[st.source_key]
 
+    def source_path_info(self) -> dict:
+        """
+        Return process folder for source, as keys, with the disc format and media category (values) it belongs to
+        """
+        return {os.path.join(dp, mc_val, st.process_dirs[st.source_key]): (df, mc_key)
+                for df, dp in self.disc_paths.items() for mc_key, mc_val in st.media_categories.items()}
+
     def output_paths(self):
         """
         Return process folder for output/converted (target path for new, compressed media file)
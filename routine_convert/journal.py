@@ -0,0 +1,270 @@
+"""
+Routine Convert - job journal
+
+
+Summary
+-------
+A Blu-Ray encode can take hours, so the state of every job is written to disk as it changes.  If the process dies
+partway through (a reboot, or a power cut), the next run knows which jobs were interrupted and queues them again,
+and failed jobs are retried a few times, waiting a little longer between each attempt.  A running job records the
+process running it, which keeps a heartbeat on it, so a run only takes over jobs whose process is gone - not those
+of another run (the watcher, or a run on another machine sharing the media root) still going.
+
+A job that has used up its attempts is left alone until its source changes (it's ripped again, or replaced) or it's
+converted differently (its command changes, e.g. after a preset is fixed).  Failed jobs can also be listed and
+queued again by hand:
+
+    python journal.py failed
+    python journal.py retry [source ...]
+
+
+Description
+--------
+JobJournal (SqliteStore):     state of every conversion job (queued, running, succeeded, failed), by source file
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import settings as st
+import store
+
+
+class JobJournal(store.SqliteStore):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            source TEXT PRIMARY KEY,
+            cli_str TEXT NOT NULL,
+            size INTEGER,
+            mtime_ns INTEGER,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            returncode INTEGER,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            started REAL,
+            finished REAL,
+            owner TEXT,
+            heartbeat REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+    '''
+
+    def __init__(self, path, max_attempts=None, backoff_secs=None):
+        """
+        :param path: (str) location of the journal file
+        :param max_attempts: (optional -> int) times a job is attempted before giving up, defaults to the settings value
+        :param backoff_secs: (optional -> float) wait before the first retry, doubling after each failed attempt.
+        Defaults to the settings value.
+        """
+        super().__init__(path)
+        self.max_attempts = max_attempts or st.job_max_attempts
+        self.backoff_secs = st.job_retry_backoff_secs if backoff_secs is None else backoff_secs
+        # Jobs started here are marked with this process (host and process id)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._beating = None
+        self._stopped = threading.Event()
+
+    def _owner_gone(self, owner, heartbeat, now):
+        """
+        :param owner: (str or None) host and process id of the process running a job
+        :param heartbeat: (float or None) last time that process was heard from
+        :param now: (float) current time
+        :return: (bool) whether the process is gone: it hasn't been heard from for settings.job_stale_secs, or it ran
+        on this host and has ended (a process can't be looked up on another host, or on Windows)
+        """
+        if owner is None or heartbeat is None or now - heartbeat > st.job_stale_secs:
+            return True
+        host, _, pid = owner.rpartition(':')
+        if host != socket.gethostname() or owner == self.owner or os.name == 'nt':
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def recover(self, now=None):
+        """
+        Summary
+        ---
+        Queue any job left running by a process that's gone (it died, or the machine rebooted).  Jobs still being run
+        by another process are left alone.
+
+        :param now: (optional -> float) current time, defaults to time.time()
+        :return: (list) sources of the interrupted jobs
+        """
+        now = now or time.time()
+        with self._lock:
+            running = self.execute('SELECT source, owner, heartbeat FROM jobs WHERE state = ?', (self.RUNNING,))
+            interrupted = [s for s, owner, heartbeat in running if self._owner_gone(owner, heartbeat, now)]
+            self.executemany('UPDATE jobs SET state = ?, owner = NULL WHERE source = ?',
+                             [(self.QUEUED, s) for s in interrupted])
+        return interrupted
+
+    def enqueue(self, source, cli_str):
+        """
+        Summary
+        ---
+        Add a job for source.  A job that already exists keeps its state and attempts (so a failing job isn't
+        retried straight away), unless it had succeeded - a source back in the queue is a new rip - or it failed and
+        has changed since: its source (size or modified time) or its command.
+
+        :param source: (str) source file
+        :param cli_str: (str) command to convert the source
+        :return: None
+        """
+        try:
+            stat = os.stat(source)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            size = mtime_ns = None
+        new = ('state = :succeeded OR (state = :failed AND (cli_str != excluded.cli_str '
+               'OR size IS NOT excluded.size OR mtime_ns IS NOT excluded.mtime_ns))')
+        self.execute('INSERT INTO jobs (source, cli_str, size, mtime_ns, state) '
+                     'VALUES (:source, :cli_str, :size, :mtime_ns, :queued) '
+                     'ON CONFLICT (source) DO UPDATE SET cli_str = excluded.cli_str, size = excluded.size, '
+                     f'mtime_ns = excluded.mtime_ns, state = CASE WHEN {new} THEN :queued ELSE state END, '
+                     f'attempts = CASE WHEN {new} THEN 0 ELSE attempts END',
+                     {'source': source, 'cli_str': cli_str, 'size': size, 'mtime_ns': mtime_ns,
+                      'queued': self.QUEUED, 'succeeded': self.SUCCEEDED, 'failed': self.FAILED})
+
+    def state(self, source):
+        """
+        :param source: (str) source file
+        :return: (tuple or None) (state, attempts, next_attempt) of the job, or None if there's no job for source
+        """
+        rows = self.execute('SELECT state, attempts, next_attempt FROM jobs WHERE source = ?', (source,))
+        return rows[0] if rows else None
+
+    def is_ready(self, source, now=None):
+        """
+        Summary
+        ---
+        Whether the job for source can be started: it's queued, or it failed and is due to be retried.
+
+        :param source: (str) source file
+        :param now: (optional -> float) current time, defaults to time.time()
+        :return: (bool)
+        """
+        job = self.state(source)
+        if job is None:
+            return True
+        state, attempts, next_attempt = job
+        if state == self.QUEUED:
+            return True
+        return state == self.FAILED and attempts < self.max_attempts and next_attempt <= (now or time.time())
+
+    def retry_at(self, source):
+        """
+        :param source: (str) source file
+        :return: (float or None) when the failed job for source may be retried, or None if it won't be
+        """
+        job = self.state(source)
+        if job and job[0] == self.FAILED and job[1] < self.max_attempts:
+            return job[2]
+        return None
+
+    def start(self, source):
+        """
+        Mark the job for source as running, by this process, and count the attempt.  The job's heartbeat is kept up
+        from then on, until it finishes.
+
+        :param source: (str) source file
+        :return: None
+        """
+        now = time.time()
+        self.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, started = ?, owner = ?, heartbeat = ? '
+                     'WHERE source = ?', (self.RUNNING, now, self.owner, now, source))
+        with self._lock:
+            if self._beating is None:
+                self._beating = threading.Thread(target=self._beat, args=(self._stopped,), daemon=True)
+                self._beating.start()
+
+    def _beat(self, stopped):
+        # Renews the heartbeat of the jobs this process is running, until the journal is closed
+        while not stopped.wait(st.job_heartbeat_secs):
+            with self._lock:
+                if stopped.is_set():
+                    break
+                self.execute('UPDATE jobs SET heartbeat = ? WHERE state = ? AND owner = ?',
+                             (time.time(), self.RUNNING, self.owner))
+
+    def close(self):
+        with self._lock:
+            self._stopped.set()
+            self._beating, self._stopped = None, threading.Event()
+        super().close()
+
+    def finish(self, source, returncode):
+        """
+        Mark the job for source as succeeded (returncode 0) or failed.  A failed job may be retried after
+        backoff_secs, doubling with each attempt.
+
+        :param source: (str) source file
+        :param returncode: (int) return code of the conversion
+        :return: None
+        """
+        now = time.time()
+        if returncode:
+            attempts = self.state(source)[1]
+            next_attempt = now + self.backoff_secs * 2 ** max(0, attempts - 1)
+            self.execute('UPDATE jobs SET state = ?, returncode = ?, finished = ?, next_attempt = ? '
+                         'WHERE source = ?', (self.FAILED, returncode, now, next_attempt, source))
+        else:
+            self.execute('UPDATE jobs SET state = ?, returncode = 0, finished = ? WHERE source = ?',
+                         (self.SUCCEEDED, now, source))
+
+    def counts(self):
+        """
+        :return: (dict) number of jobs (values) in each state (keys)
+        """
+        return dict(self.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def failed(self):
+        """
+        :return: (list) (source, attempts, returncode, finished) of every failed job, most recent first
+        """
+        return self.execute('SELECT source, attempts, returncode, finished FROM jobs WHERE state = ? '
+                            'ORDER BY finished DESC', (self.FAILED,))
+
+    def retry(self, sources=None):
+        """
+        Summary
+        ---
+        Queue failed jobs again, with their attempts reset, so the next run starts them straight away.
+
+        :param sources: (optional -> list) sources of the jobs, defaults to every failed job
+        :return: (int) number of jobs queued again
+        """
+        with self._lock:
+            failed = [s for s, *_ in self.failed()]
+            retried = [s for s in failed if sources is None or s in sources]
+            self.executemany('UPDATE jobs SET state = ?, attempts = 0, next_attempt = 0 WHERE source = ?',
+                             [(self.QUEUED, s) for s in retried])
+        return len(retried)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List failed conversion jobs, or queue them again.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('failed', help='failed jobs, and how many times they were attempted')
+    retry = commands.add_parser('retry', help='queue failed jobs again, with their attempts reset')
+    retry.add_argument('sources', nargs='*', help='source files of the jobs (every failed job, if none)')
+    args = parser.parse_args()
+
+    journal = JobJournal(st.JOURNAL_FILE)
+    if args.command == 'failed':
+        for source, attempts, returncode, finished in journal.failed():
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(finished)) if finished else '-'
+            print(f'{when}\t{attempts} attempt(s), returned {returncode}\t{source}')
+    else:
+        print(f'>>> {journal.retry([os.path.abspath(s) for s in args.sources] or None)} job(s) queued again')
@@ -11,16 +11,215 @@ in order for the correct conversion preset to be used (h265 codec with specific
 
 Description
 --------
+Stream (object):    a video, audio or subtitle stream of a media file, as probed
+ProbeField (object):    class attribute for a value that comes from probing; reading it probes the file, if needed,
+                        and setting it parses the value into its type
 Media (object):     base class for media; largely used for storing information from ffprobe and IMDb
 Movie (Media):      subclass for movies
 Show (Media):       subclass for TV shows
+MediaPart (ABC):    base class for a part of a media file that is encoded as a job of its own
 """
+import abc
+import concurrent.futures
 import datetime
 import json
+import re
 import subprocess
 import os
 
+import probe_cache as pc
 import settings as st
+import store
+
+
+# Unit prefixes, for sizes and bit rates reported by ffprobe
+_QUANTITY_PREFIXES = {
+    'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40,
+}
+
+
+def parse_seconds(value) -> float:
+    """
+    Parse a probed time value (either seconds, or the "pretty" H:MM:SS.ffffff format) into seconds.
+
+    :param value: (str/float) probed value
+    :return: (float) seconds
+    """
+    value = str(value)
+    if ':' in value:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return float(value)
+
+
+def parse_quantity(value) -> int:
+    """
+    Parse a probed size or bit rate into a plain number.  Cached "pretty" values (e.g. "1.2 GiB", "5.4 Mbit/s")
+    are understood too.
+
+    :param value: (str/int) probed value
+    :return: (int) bytes or bits per second
+    """
+    number, _, unit = str(value).partition(' ')
+    prefix = unit[:2] if unit[1:2] == 'i' else unit[:1]
+    return round(float(number) * _QUANTITY_PREFIXES.get(prefix, 1))
+
+
+def parse_rate(value) -> float:
+    """
+    Parse a probed frame rate (a fraction, e.g. "24000/1001") into frames per second.
+
+    :param value: (str) probed value
+    :return: (float) frames per second (0 if unknown)
+    """
+    numerator, _, denominator = str(value).partition('/')
+    return float(numerator) / float(denominator or 1) if float(denominator or 1) else 0.0
+
+
+def parse_datetime(value):
+    """
+    Parse a probed date (ISO 8601, as ffprobe reports creation_time) into a datetime.
+
+    :param value: (str) probed value
+    :return: (datetime.datetime) date and time
+    """
+    return datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+
+class Stream:
+    """
+    Summary
+    ---
+    A stream of a media file (video, audio, subtitle...), from ffprobe's -show_streams.  "number" counts streams of
+    the same type, from 1, which is how HandBrakeCLI picks audio and subtitle tracks.
+    """
+    __slots__ = (
+        'index', 'number', 'codec_type', 'codec_name', 'profile', 'language', 'title', 'channels', 'width', 'height',
+        'pix_fmt', 'frame_rate', 'field_order', 'color_transfer', 'bit_rate', 'default', 'forced', 'comment',
+    )
+
+    def __init__(self, index, number, codec_type, codec_name='', profile='', language='', title='', channels=0,
+                 width=0, height=0, pix_fmt='', frame_rate=0.0, field_order='', color_transfer='', bit_rate=0,
+                 default=False, forced=False, comment=False):
+        self.index = index
+        self.number = number
+        self.codec_type = codec_type
+        self.codec_name = codec_name
+        self.profile = profile
+        self.language = language
+        self.title = title
+        self.channels = channels
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.frame_rate = frame_rate
+        self.field_order = field_order
+        self.color_transfer = color_transfer
+        self.bit_rate = bit_rate
+        self.default = default
+        self.forced = forced
+        self.comment = comment
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.codec_type} {self.number}: {self.codec_name}' \
+               + (f', {self.language}' if self.language else '') + ')'
+
+    @classmethod
+    def from_probe(cls, probe, number):
+        """
+        :param probe: (dict) stream, as reported by ffprobe
+        :param number: (int) position of the stream among streams of the same type, from 1
+        :return: (Stream) stream record
+        """
+        tags = probe.get(st.FFPROBE_TAG_STR, {})
+        disposition = probe.get('disposition', {})
+        try:
+            bit_rate = parse_quantity(probe.get('bit_rate', 0))
+        except ValueError:
+            bit_rate = 0
+        try:
+            frame_rate = parse_rate(probe.get('avg_frame_rate') or probe.get('r_frame_rate') or 0)
+        except ValueError:
+            frame_rate = 0.0
+        return cls(
+            int(probe.get('index', 0)), number, probe.get('codec_type', ''),
+            codec_name=probe.get('codec_name', ''),
+            profile=probe.get('profile', ''),
+            language=tags.get('language', '').lower(),
+            title=tags.get('title', ''),
+            channels=int(probe.get('channels', 0)),
+            width=int(probe.get('width', 0)),
+            height=int(probe.get('height', 0)),
+            pix_fmt=probe.get('pix_fmt', ''),
+            frame_rate=frame_rate,
+            field_order=probe.get('field_order', ''),
+            color_transfer=probe.get('color_transfer', ''),
+            bit_rate=bit_rate,
+            default=bool(disposition.get('default')),
+            forced=bool(disposition.get('forced')),
+            comment=bool(disposition.get('comment')),
+        )
+
+
+def parse_streams(value) -> tuple:
+    """
+    Parse the probed streams into Stream records.
+
+    :param value: (list) streams, as reported by ffprobe
+    :return: (tuple) Stream records, in the order of the file
+    """
+    streams, numbers = [], {}
+    for probe in value:
+        codec_type = probe.get('codec_type', '')
+        numbers[codec_type] = numbers.get(codec_type, 0) + 1
+        streams.append(Stream.from_probe(probe, numbers[codec_type]))
+    return tuple(streams)
+
+
+class ProbeField:
+    """
+    Summary
+    ---
+    A media class attribute that is filled in by ffprobe.  Media objects can be made without probing their file
+    (lazy), so the first time one of these values is read, the file is probed.  Read from the class itself, the
+    default value is returned.
+
+    Values are parsed once, when set, so durations, sizes and dates can be compared/sorted without parsing them
+    again.  The value itself lives in a slot of the same name, prefixed with an underscore.
+    """
+    def __init__(self, default, parse=None):
+        """
+        :param default: value until the file is probed (or if the probe didn't report it)
+        :param parse: (optional -> callable) converts the probed value into its type
+        """
+        self.default = default
+        self.parse = parse
+        self.name = ''
+        self.slot = ''
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = '_' + name
+        # Keep track of every probed attribute on the class, so probe results can be set without searching the class
+        owner.probe_fields = getattr(owner, 'probe_fields', ()) + (name,)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.default
+        if not instance.probed:
+            instance.materialize()
+        return getattr(instance, self.slot, self.default)
+
+    def __set__(self, instance, value):
+        # Probed values come as strings (or, for streams, as a list of dicts)
+        if self.parse and isinstance(value, (str, list)):
+            try:
+                value = self.parse(value)
+            except ValueError:
+                # ffprobe reports "N/A" for values it couldn't find
+                value = self.default
+        setattr(instance, self.slot, value)
 
 
 class Media:
@@ -30,29 +229,54 @@ class Media:
     Media class that contains data about a movie file (preferably either an .mp4 or .mkv file).  Helpful metadata,
     such as title, year, disc format (DVD/blu-ray), duration, etc can be useful when converting the media and
     organizing it on a file system.
+
+    Media objects are slotted, since a library can hold tens of thousands of them.
     """
-    source_title = ''
-    year = ''
-    disc_format = ''
+    __slots__ = (
+        'filename', 'year', 'disc_format', 'preset', 'probed',
+        '_source_title', '_nb_streams', '_nb_programs', '_format_name', '_format_long_name', '_start_time',
+        '_duration', '_size', '_bit_rate', '_probe_score', '_encoder', '_creation_time', '_streams',
+    )
+
     media_category = ''
 
-    filename = ''
-    nb_streams = 0
-    nb_programs = 0
-    format_name = ''
-    format_long_name = ''
-    start_time = ''
-    duration = ''
-    size = ''
-    bit_rate = ''
-    probe_score = 0
-    encoder = ''
-    creation_time = ''
+    source_title = ProbeField('')
+    nb_streams = ProbeField(0, int)
+    nb_programs = ProbeField(0, int)
+    format_name = ProbeField('')
+    format_long_name = ProbeField('')
+    start_time = ProbeField(0.0, parse_seconds)  # seconds
+    duration = ProbeField(0.0, parse_seconds)  # seconds
+    size = ProbeField(0, parse_quantity)  # bytes
+    bit_rate = ProbeField(0, parse_quantity)  # bits per second
+    probe_score = ProbeField(0, int)
+    encoder = ProbeField('')
+    creation_time = ProbeField(None, parse_datetime)
+    streams = ProbeField((), parse_streams)  # Stream records
 
     # tags = {}   # for debugging
 
-    def __init__(self, media_file):
-        self.set_attrs_from_probe(self._probe_media_to_dict(media_file))
+    # Probe results kept between runs (see probe_cache.py), opened once they're needed
+    probe_cache = store.Lazy(lambda: pc.ProbeCache(st.PROBE_CACHE_FILE) if st.use_probe_cache else None)
+
+    def __init__(self, media_file, probe_dict=None, lazy=False):
+        """
+        :param media_file: (str) path to the media file
+        :param probe_dict: (optional -> dict) probe result already fetched for the file (see probe_many), so the
+        file isn't probed a second time
+        :param lazy: (optional -> bool) if True, don't probe the file until a probed value is read (see ProbeField)
+        """
+        self.filename = media_file
+        self.year = ''
+        self.disc_format = ''
+        # Preset picked for the media by its content, if any (see preset_rules.py)
+        self.preset = ''
+        self.probed = False
+
+        if probe_dict is None and not lazy:
+            probe_dict = self._probe_media_to_dict(media_file)
+        if probe_dict is not None:
+            self.set_attrs_from_probe(probe_dict)
 
     def __repr__(self):
         """
@@ -84,54 +308,155 @@ class Media:
     def basename(self):
         return str(os.path.basename(self.filename).split('_t')[0])
 
-    @staticmethod
-    def _probe_media_to_dict(file_):
+    @classmethod
+    def _cached_probe(cls, file_):
+        """
+        :param file_: (str) path to the media file
+        :return: (dict or None) cached probe result, or None if the file needs probing (results cached before
+        streams were probed count as missing)
         """
-        Use FFPROBE to retrieve metadata contained in file.
+        if cls.probe_cache:
+            cached = cls.probe_cache.get(file_)
+            if cached is not None and 'streams' in cached:
+                return cached
+        return None
+
+    @classmethod
+    def _probe_media_to_dict(cls, file_):
+        """
+        Use FFPROBE to retrieve metadata contained in file.  If the file hasn't changed since it was last probed,
+        the cached result is used instead.
 
         :return: (dict) output_dict (FFPROBE format data)
         """
+        cached = cls._cached_probe(file_)
+        if cached is not None:
+            return cached
+
         output_dict = {}
 
-        probe_args = str(st.SPC_SEP.join(
-            [st.FFPROBE,
-             '-i', f'"{file_}"',
-             '-print_format', 'json',
-             '-pretty', '-show_format'
-             ]
-        ))
+        probe_args = [st.FFPROBE,
+                      '-i', file_,
+                      '-print_format', 'json',
+                      '-show_format',
+                      '-show_streams'
+                      ]
         out = subprocess.check_output(probe_args, stderr=subprocess.PIPE)
         out_to_json = json.loads(out)
         if out_to_json:
             output_dict = out_to_json[st.FFPROBE_FMT_STR]
             nested_dicts = {k: v for k, v in output_dict.items() if isinstance(v, dict) for k, v in v.items()}
             output_dict.update(nested_dicts)
+            output_dict['streams'] = out_to_json.get('streams', [])
+
+        if cls.probe_cache:
+            cls.probe_cache.put(file_, output_dict)
         return output_dict
 
+    @classmethod
+    def probe_many(cls, files, workers=None):
+        """
+        Summary
+        ---
+        Probe several files at once.  Each probe is its own ffprobe process, so a thread pool is enough to keep
+        "workers" of them running.  A file that fails to probe doesn't stop the others; its error is collected.
+
+        :param files: (list) paths to media files
+        :param workers: (optional -> int) number of concurrent probes, defaults to the settings value
+        :return: (tuple) dict of {file: probe dict}, dict of {file: exception}
+        """
+        results, errors = {}, {}
+
+        # Files that haven't changed since the last run don't need a process at all
+        for f in files:
+            cached = cls._cached_probe(f)
+            if cached is not None:
+                results[f] = cached
+        files = [f for f in files if f not in results]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or st.probe_workers) as pool:
+            probes = {pool.submit(cls._probe_media_to_dict, f): f for f in files}
+            for probe in concurrent.futures.as_completed(probes):
+                try:
+                    results[probes[probe]] = probe.result()
+                except (OSError, subprocess.SubprocessError, ValueError) as e:
+                    errors[probes[probe]] = e
+        return results, errors
+
     def set_attrs_from_probe(self, probe_dict):
         """
         Summary
         ---
-        The result from the probe of the media file (JSON) will be used to set class attributes.  Check to
-        see if data in the JSON file matches a class variable.
+        The result from the probe of the media file (JSON) will be used to set class attributes.  Only the probed
+        attributes of the class (see ProbeField) are looked up in the JSON data.
+
+        :return: None
+        """
+        # Mark as probed first, so that setting attributes here doesn't kick off another probe
+        self.probed = True
+        for k in self.probe_fields:
+            if k in probe_dict:
+                setattr(self, k, probe_dict[k])
+
+        # The title tag goes through the title property, which can tidy it up (see Show)
+        if 'title' in probe_dict:
+            self.title = probe_dict['title']
+
+    def materialize(self):
+        """
+        Summary
+        ---
+        Probe the media file, if it hasn't been probed yet.
 
         :return: None
         """
-        for k, v in probe_dict.items():
-            if hasattr(self, k):
-                setattr(self, k, v)
+        if not self.probed:
+            self.set_attrs_from_probe(self._probe_media_to_dict(self.filename))
+
+    @classmethod
+    def materialize_all(cls, media_list, workers=None):
+        """
+        Summary
+        ---
+        Probe every media object in media_list that hasn't been probed yet, several at a time (see probe_many).
+        Much quicker than letting each object probe itself on first read.
+
+        :param media_list: (list) media objects
+        :param workers: (optional -> int) number of concurrent probes, defaults to the settings value
+        :return: (dict) {filename: exception} for any media that could not be probed
+        """
+        pending = [m for m in media_list if not m.probed]
+        probes, errors = cls.probe_many([m.filename for m in pending], workers=workers)
+        for m in pending:
+            if m.filename in probes:
+                m.set_attrs_from_probe(probes[m.filename])
+        return errors
+
+    def streams_of_type(self, codec_type):
+        """
+        :param codec_type: (str) "video", "audio", "subtitle"...
+        :return: (list) streams of that type, in order
+        """
+        return [s for s in self.streams if s.codec_type == codec_type]
+
+    @property
+    def video_stream(self):
+        """
+        :return: (Stream or None) main video stream (cover art doesn't count), or None if there's no video
+        """
+        videos = [s for s in self.streams_of_type('video') if s.codec_name not in ('mjpeg', 'png')]
+        return videos[0] if videos else None
 
     @property
     def duration_to_minutes(self):
         """
         Summary
         ---
-        Get the duration in minutes by converting the HH:MM:SS.FFF.. time format retrieved from probing media.
+        Get the duration in minutes, from the duration (seconds) retrieved from probing media.
 
         :return: (int) total length of media in minutes
         """
-        dur_to_time = datetime.datetime.strptime(self.duration, '%H:%M:%S.%f0') - datetime.datetime(1900, 1, 1)
-        return round(dur_to_time.total_seconds() / 60)
+        return round(self.duration / 60)
 
 
 class Movie(Media):
@@ -140,6 +465,8 @@ class Movie(Media):
     ---
     Movie type.  Contains all movie-specific class variables or methods to assist in converting a motion picture.
     """
+    __slots__ = ()
+
     media_category = st.movie_cat
 
 
@@ -149,15 +476,37 @@ class Show(Media):
     ---
     TV show type.  Contains all specific class variables or methods to assist in converting a TV show.
     """
+    __slots__ = ('_show_title', 'season', 'episode_title', 'episode_num')
+
     media_category = st.show_cat
 
-    show_title = ''
-    season = 0
-    episode_title = ''
-    episode_num = 0
+    show_title = ProbeField('')
+
+    def __init__(self, media_file, probe_dict=None, lazy=False):
+        self.season = self.season_from_filename(media_file)
+        self.episode_title = ''
+        self.episode_num = 0
+        super().__init__(media_file, probe_dict=probe_dict, lazy=lazy)
+
+    @staticmethod
+    def season_from_filename(filename) -> int:
+        """
+        Summary
+        ---
+        Find the season number in a filename (e.g. "Show Season 2 Disc 1.mkv" or "Show S02D1.mkv").  Assume the
+        first season if there's none.
+
+        :param filename: (str) path to the media file
+        :return: (int) season number
+        """
+        found = re.search(r'(?:season|\bs)[\s_.-]*(\d{1,2})', os.path.basename(filename).lower())
+        return int(found.group(1)) if found else 1
 
     @property
     def title(self):
+        # Without a title in the file, make one from the filename itself
+        if not self.show_title:
+            self.title = self.basename
         return self.show_title
 
     @title.setter
@@ -197,4 +546,48 @@ class Show(Media):
         if episode_titlename and type(episode_titlename) is str:
             episode = st.WIDE_DASH_SEP.join([episode, episode_titlename])
 
-        return episode
\ No newline at end of file
+        return episode
+
+
+class MediaPart(abc.ABC):
+    """
+    Summary
+    ---
+    Part of a media file that is encoded as a job of its own (a segment of a long title, or one episode of a file
+    holding several).  Once every part of the media is done, the media itself is done.  Subclasses say how the part
+    is picked out of the media (see cli_args).
+    """
+    __slots__ = ('media', 'index', 'count', 'start', 'length', 'output')
+
+    def __init__(self, media, index, count, start, length, output):
+        """
+        :param media: (Media) media object the part belongs to
+        :param index: (int) position of the part in the media (from 0)
+        :param count: (int) number of parts the media is split into
+        :param start: (float) where the part starts in the media, in seconds
+        :param length: (float) length of the part, in seconds
+        :param output: (str) file the part is encoded to
+        """
+        self.media = media
+        self.index = index
+        self.count = count
+        self.start = start
+        self.length = length
+        self.output = output
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.job_id})'
+
+    @property
+    def job_id(self):
+        return f'{self.media.filename} [{self.index + 1}/{self.count}]'
+
+    @property
+    def is_last(self):
+        return self.index == self.count - 1
+
+    @abc.abstractmethod
+    def cli_args(self) -> str:
+        """
+        :return: (str) HandBrakeCLI arguments to only encode this part of the media
+        """
@@ -0,0 +1,265 @@
+"""
+Routine Convert - IMDb metadata lookups
+
+
+Summary
+-------
+Looking up a title on IMDb takes a few round trips (a search, then fetching the movie or episode).  For a large
+library, that's thousands of requests, so lookups are run several at a time (without hammering IMDb - requests are
+rate limited), and what's used of everything fetched (see ImdbRecord) is cached on disk for a while, as JSON.
+Titles that can't be found are cached too, so they aren't searched for again on every run.  Expired entries are
+removed as a resolver starts.
+
+
+Description
+--------
+RateLimiter (object):           allows up to a number of calls per second, across threads
+ImdbRecord (dict):              the fields used of an IMDb movie, episode or search result
+ImdbCache (SqliteStore):        search results and fetched records, with an expiry time
+MetadataResolver (object):      looks up media on IMDb (or anything with the same interface), concurrently and cached
+"""
+import concurrent.futures
+import json
+import threading
+import time
+
+import media as me
+import settings as st
+import store
+
+
+class RateLimiter:
+    """
+    Summary
+    ---
+    Token bucket: calls to acquire() block so that no more than "rate" calls per second are let through, on
+    average, with up to "burst" at once.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ImdbRecord(dict):
+    """
+    Summary
+    ---
+    The fields routine convert uses of an IMDb movie, episode or search result (see FIELDS), as plain values - so
+    it can be cached as JSON, rather than the whole record.  Read like the record: get(field) and getID().
+    """
+    FIELDS = ('kind', 'title', 'year', 'genres', 'rating', 'runtimes', 'season', 'episode')
+
+    @classmethod
+    def of(cls, record):
+        """
+        :param record: IMDb movie, episode or search result (see imdb.Movie)
+        :return: (ImdbRecord) its ID and the fields it has
+        """
+        fields = {k: record.get(k) for k in cls.FIELDS if record.get(k) is not None}
+        series = record.get('episode of')
+        if series is not None:
+            fields['series'] = series.get('title') if hasattr(series, 'get') else str(series)
+        return cls(fields, id=str(record.getID()))
+
+    def getID(self):
+        return self.get('id')
+
+
+class ImdbCache(store.SqliteStore):
+    # Entries were pickled whole records before, in "entries"
+    schema = '''
+        DROP TABLE IF EXISTS entries;
+        CREATE TABLE IF NOT EXISTS lookups (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            expires REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        );
+    '''
+
+    # Returned by get() when there is nothing cached, since None is cached for titles that weren't found
+    MISSING = object()
+
+    def get(self, kind, key):
+        """
+        :param kind: (str) kind of lookup (e.g. "search_movie", "get_movie")
+        :param key: (str) what was looked up
+        :return: (ImdbRecord, list of them or None) cached value, or ImdbCache.MISSING if there's nothing cached (or it
+        has expired)
+        """
+        rows = self.execute('SELECT value FROM lookups WHERE kind = ? AND key = ? AND expires > ?',
+                            (kind, key, time.time()))
+        if not rows:
+            return self.MISSING
+        if rows[0][0] is None:
+            return None
+        value = json.loads(rows[0][0])
+        return [ImdbRecord(v) for v in value] if isinstance(value, list) else ImdbRecord(value)
+
+    def put(self, kind, key, value, ttl):
+        """
+        :param kind: (str) kind of lookup
+        :param key: (str) what was looked up
+        :param value: (ImdbRecord, list of them or None) result of the lookup (None if nothing was found)
+        :param ttl: (float) seconds to keep it for
+        :return: None
+        """
+        self.execute('INSERT OR REPLACE INTO lookups (kind, key, value, expires) VALUES (?, ?, ?, ?)',
+                     (kind, key, json.dumps(value) if value is not None else None, time.time() + ttl))
+
+    def purge_expired(self):
+        """
+        :return: None
+        """
+        self.execute('DELETE FROM lookups WHERE expires <= ?', (time.time(),))
+
+
+class MetadataResolver:
+    """
+    Summary
+    ---
+    Look up media on IMDb.  Searches and fetched records are cached (see ImdbCache, expired entries are removed as the
+    resolver is made) and every request to IMDb goes through a rate limiter.  Records are returned as ImdbRecord.  "ia" can be anything with the search_movie/get_movie/get_episode methods of
+    imdb.IMDb, such as a local fake for testing.  If not given, an imdb.IMDb is made for each thread when needed.
+    """
+    def __init__(self, ia=None, cache=None, workers=None, rate=None):
+        """
+        :param ia: (optional) IMDb access object, defaults to imdb.IMDb()
+        :param cache: (optional -> ImdbCache or False) cache to use, defaults to the settings location (False to
+        disable)
+        :param workers: (optional -> int) number of concurrent lookups, defaults to the settings value
+        :param rate: (optional -> float) requests per second to IMDb, defaults to the settings value
+        """
+        self._ia = ia
+        self._local = threading.local()
+        self.cache = ImdbCache(st.IMDB_CACHE_FILE) if cache is None else cache or None
+        if self.cache:
+            self.cache.purge_expired()
+        self.workers = workers or st.imdb_workers
+        self.limiter = RateLimiter(rate or st.imdb_requests_per_sec, burst=self.workers)
+
+    @property
+    def ia(self):
+        if self._ia is not None:
+            return self._ia
+        if not hasattr(self._local, 'ia'):
+            import imdb
+            self._local.ia = imdb.IMDb()
+        return self._local.ia
+
+    def _cached(self, kind, key, lookup):
+        """
+        Return the cached result of a lookup, or run it (rate limited) and cache what it returns.  Empty results are
+        cached for a shorter time.
+
+        :param kind: (str) kind of lookup
+        :param key: (str) what is looked up
+        :param lookup: (callable) runs the lookup
+        :return: result of the lookup
+        """
+        if self.cache:
+            cached = self.cache.get(kind, key)
+            if cached is not ImdbCache.MISSING:
+                return cached
+
+        self.limiter.acquire()
+        value = lookup() or None
+
+        if self.cache:
+            ttl = st.imdb_cache_ttl_days if value is not None else st.imdb_negative_ttl_days
+            self.cache.put(kind, key, value, ttl * 24 * 3600)
+        return value
+
+    def search(self, title):
+        """
+        :param title: (str) title to search for
+        :return: (list or None) search results, or None if nothing was found
+        """
+        return self._cached('search_movie', title.strip().lower(),
+                            lambda: [ImdbRecord.of(r) for r in self.ia.search_movie(title)])
+
+    def _get(self, kind, id_):
+        def lookup():
+            record = getattr(self.ia, kind)(id_)
+            return ImdbRecord.of(record) if record else None
+        return self._cached(kind, str(id_), lookup)
+
+    def get_movie(self, id_):
+        return self._get('get_movie', id_)
+
+    def get_episode(self, id_):
+        return self._get('get_episode', id_)
+
+    def resolve(self, media):
+        """
+        Summary
+        ---
+        Look up media on IMDb.  The first search result is taken as the best guess.  Based on the media instance,
+        the record is fetched as a movie or as an episode (TV show).
+
+        :param media: (Media) class object
+        :return: (ImdbRecord or None) IMDb movie/episode, or None if the title wasn't found
+        """
+        title_search = self.search(media.title)
+        if not title_search:
+            return None
+
+        id_ = title_search[0].getID()
+        if isinstance(media, me.Show):
+            return self.get_episode(id_)
+        return self.get_movie(id_)
+
+    def cached(self, media):
+        """
+        Summary
+        ---
+        The record resolve would return, if both its lookups are cached - without going out to IMDb.
+
+        :param media: (Media) class object
+        :return: (ImdbRecord or None) IMDb movie/episode, or None if it isn't cached (or the title wasn't found)
+        """
+        if not self.cache:
+            return None
+        title_search = self.cache.get('search_movie', media.title.strip().lower())
+        if title_search is ImdbCache.MISSING or not title_search:
+            return None
+
+        kind = 'get_episode' if isinstance(media, me.Show) else 'get_movie'
+        record = self.cache.get(kind, str(title_search[0].getID()))
+        return None if record is ImdbCache.MISSING else record
+
+    def resolve_all(self, media_list):
+        """
+        Summary
+        ---
+        Look up every media object in media_list, several at a time.  A lookup that fails doesn't stop the others.
+
+        :param media_list: (list) media objects
+        :return: (tuple) dict of {media: record or None}, dict of {media: exception}
+        """
+        records, errors = {}, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            lookups = {pool.submit(self.resolve, m): m for m in media_list}
+            for lookup in concurrent.futures.as_completed(lookups):
+                try:
+                    records[lookups[lookup]] = lookup.result()
+                except Exception as e:
+                    # IMDb lookups can fail in many ways (network, parsing); report them rather than stop
+                    errors[lookups[lookup]] = e
+        return records, errors
@@ -0,0 +1,197 @@
+"""
+Routine Convert - content-aware preset selection
+
+
+Summary
+-------
+Which preset a file is converted with used to depend only on the folder it was put in ("DVD" or "Blu-Ray").  A 1080p
+rip dropped in the DVD folder was shrunk to 480p, and an SD rip in the Blu-Ray folder spent hours on the slowest HD
+preset.  Instead, presets are picked by rules (see settings.preset_rules) on what the video actually is: its height,
+frame rate, HDR transfer, interlacing and bit depth.  The folder's preset is only used when no rule matches.
+
+Rules are evaluated on the whole queue at once: the properties of every file are gathered into columns first, and
+each rule is tested against a column at a time, rather than every rule being checked against every file in turn.
+
+
+Description
+--------
+load_pixel_formats (function):  components and bits per pixel of each pixel format (from pixel_formats.txt)
+bit_depth (function):           bits per component of a pixel format
+media_columns (function):       properties the rules test, for every media object, by column
+match_rule (function):          which media objects (rows) a rule matches
+assign_presets (function):      pick the preset of every media object
+preset_of (function):           preset a media object is converted with
+"""
+import operator
+import re
+
+import settings as st
+
+
+# Conditions a rule can have (keys): the column they test, and how the rule's value is compared with it (values)
+CONDITIONS = {
+    'min_height': ('height', operator.ge),
+    'max_height': ('height', operator.le),
+    'min_fps': ('fps', operator.ge),
+    'max_fps': ('fps', operator.le),
+    'min_bit_depth': ('bit_depth', operator.ge),
+    'max_bit_depth': ('bit_depth', operator.le),
+    'hdr': ('hdr', operator.eq),
+    'interlaced': ('interlaced', operator.eq),
+    'codec': ('codec', operator.eq),
+    'disc_format': ('disc_format', operator.eq),
+}
+
+# Transfer characteristics of HDR video (PQ and HLG)
+_HDR_TRANSFERS = ('smpte2084', 'arib-std-b67')
+
+# Field orders of interlaced video (anything but "progressive", or "unknown")
+_INTERLACED_ORDERS = ('tt', 'bb', 'tb', 'bt')
+
+# Chroma subsampling (keys) and the samples per pixel it works out to, for the 3 colour components (values)
+_SUBSAMPLING = {'444': 3.0, '440': 2.0, '422': 2.0, '420': 1.5, '411': 1.5, '410': 1.125}
+
+# Semi-planar formats, named by their layout rather than their subsampling (e.g. nv12 and p010 are 4:2:0)
+_SEMI_PLANAR = (
+    (re.compile(r'^(nv12|nv21|p0\d\d)'), '420'),
+    (re.compile(r'^(nv16|p2\d\d|y2\d\d)'), '422'),
+    (re.compile(r'^(nv24|nv42|p4\d\d)'), '444'),
+)
+
+# Pixel formats already read (values), by file (keys)
+_pixel_formats = {}
+
+
+def load_pixel_formats(path=None) -> dict:
+    """
+    Summary
+    ---
+    Read the pixel formats listed by "ffmpeg -pix_fmts" (see pixel_formats.txt).
+
+    :param path: (optional -> str) file to read, defaults to settings.PIXEL_FORMATS_FILE
+    :return: (dict) pixel format names (keys), with their number of components and bits per pixel (values)
+    """
+    path = path or st.PIXEL_FORMATS_FILE
+    if path not in _pixel_formats:
+        formats = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    # Ex:  IO... yuv420p10le            3            15
+                    if len(fields) == 4 and fields[2].isdigit() and fields[3].isdigit():
+                        formats[fields[1]] = (int(fields[2]), int(fields[3]))
+        except OSError:
+            pass
+        _pixel_formats[path] = formats
+    return _pixel_formats[path]
+
+
+def bit_depth(pix_fmt) -> int:
+    """
+    Summary
+    ---
+    Bits per component of a pixel format: its bits per pixel, spread over the samples each pixel has (which depends
+    on the chroma subsampling, e.g. 1.5 samples per pixel for 4:2:0).
+
+    :param pix_fmt: (str) pixel format name, as probed
+    :return: (int) bits per component, or 0 if the pixel format isn't known
+    """
+    components, bits_per_pixel = load_pixel_formats().get(pix_fmt, (0, 0))
+    if not bits_per_pixel:
+        return 0
+
+    subsampling = re.search(r'4[124][0124]', pix_fmt)
+    subsampling = subsampling.group() if subsampling else \
+        next((s for pattern, s in _SEMI_PLANAR if pattern.match(pix_fmt)), '')
+    if pix_fmt.startswith('bayer'):
+        samples = 1.0
+    elif subsampling in _SUBSAMPLING:
+        # An alpha component is a full sample per pixel, on top of the colour components
+        samples = _SUBSAMPLING[subsampling] + max(0, components - 3)
+    else:
+        samples = components
+    return round(bits_per_pixel / samples)
+
+
+def media_columns(media_list) -> dict:
+    """
+    Summary
+    ---
+    Gather the properties rules are tested on, for every media object, by column (same order as media_list).  Media
+    without a probed video stream has a height of 0.
+
+    :param media_list: (list) media objects
+    :return: (dict) column names (keys) and their values, one per media object (values)
+    """
+    videos = [m.video_stream for m in media_list]
+    return {
+        'height': [v.height if v else 0 for v in videos],
+        'fps': [v.frame_rate if v else 0.0 for v in videos],
+        'bit_depth': [bit_depth(v.pix_fmt) if v else 0 for v in videos],
+        'hdr': [bool(v) and v.color_transfer in _HDR_TRANSFERS for v in videos],
+        'interlaced': [bool(v) and v.field_order in _INTERLACED_ORDERS for v in videos],
+        'codec': [v.codec_name if v else '' for v in videos],
+        'disc_format': [m.disc_format for m in media_list],
+    }
+
+
+def match_rule(rule, columns) -> list:
+    """
+    :param rule: (dict) conditions (see CONDITIONS) and the preset to use
+    :param columns: (dict) columns of the media (see media_columns)
+    :return: (list) for each media object, whether the rule matches it (a rule never matches media without video)
+    """
+    mask = [bool(h) for h in columns['height']]
+    for condition, value in rule.items():
+        if condition == 'preset':
+            continue
+        column, compare = CONDITIONS[condition]
+        mask = [matched and compare(cell, value) for matched, cell in zip(mask, columns[column])]
+    return mask
+
+
+def check_rules(rules):
+    """
+    :param rules: (list) preset rules
+    :return: None (raises ValueError for a rule without a preset, or with an unknown condition)
+    """
+    for rule in rules:
+        unknown = [k for k in rule if k != 'preset' and k not in CONDITIONS]
+        if unknown or 'preset' not in rule:
+            raise ValueError(f'Invalid preset rule {rule}: conditions must be one of {", ".join(CONDITIONS)}, '
+                             f'and a "preset" is needed')
+
+
+def assign_presets(media_list, rules=None) -> list:
+    """
+    Summary
+    ---
+    Pick the preset of every media object: the preset of the first rule that matches it, otherwise the preset of
+    the folder (disc format) it was found in.  The preset is kept on the media object (see preset_of).
+
+    :param media_list: (list) media objects
+    :param rules: (optional -> list) preset rules, defaults to settings.preset_rules
+    :return: (list) preset of each media object, in order
+    """
+    rules = st.preset_rules if rules is None else rules
+    check_rules(rules)
+
+    columns = media_columns(media_list) if rules else {}
+    chosen = [''] * len(media_list)
+    for rule in rules:
+        for i, matched in enumerate(match_rule(rule, columns)):
+            if matched and not chosen[i]:
+                chosen[i] = rule['preset']
+
+    for i, m in enumerate(media_list):
+        m.preset = chosen[i] or st.presets[m.disc_format]
+    return [m.preset for m in media_list]
+
+
+def preset_of(m) -> str:
+    """
+    :param m: (Media) media object
+    :return: (str) preset it's converted with: the one picked by the rules, otherwise its folder's
+    """
+    return m.preset or st.presets[m.disc_format]
@@ -0,0 +1,268 @@
+"""
+Routine Convert - Handbrake presets
+
+
+Summary
+-------
+The presets used to convert media are made in the Handbrake GUI, and saved to its presets file (see
+settings.PRESET_FILE).  That file holds every built-in preset too, and is thousands of lines long - handing it to
+every HandBrakeCLI process means each one parses all of it, to use a single preset.  Instead, the file is read and
+indexed once.  The configured presets are checked to exist before anything runs, and each job is handed a small file
+holding only its own preset (written once per preset, and again only when the presets file changes).
+
+Presets also say how a job will be encoded (encoder, quality, encoder speed), which helps estimate how long it will
+take before it has ever been run.
+
+
+Description
+--------
+Preset (object):        a single preset, with its settings
+PresetIndex (object):   every preset in a presets file, by "<category>/<preset-name>"
+index (PresetIndex):    presets in settings.PRESET_FILE
+find_preset (function): a single preset in settings.PRESET_FILE
+"""
+import hashlib
+import json
+import os
+import threading
+
+import settings as st
+import store
+
+
+# Rough seconds of encoding per second of 1080p media, for x265 at each encoder speed (the "VideoPreset")
+_SPEED_FACTORS = {
+    'ultrafast': 0.15,
+    'superfast': 0.2,
+    'veryfast': 0.3,
+    'faster': 0.5,
+    'fast': 0.8,
+    'medium': 1.0,
+    'slow': 2.0,
+    'slower': 3.0,
+    'veryslow': 4.0,
+    'placebo': 10.0,
+}
+
+# How much quicker (or slower) other encoders are than x265, by the start of their name
+_ENCODER_FACTORS = {
+    'x264': 0.4,
+    'x265_10bit': 1.2,
+    'x265_12bit': 1.4,
+    'x265': 1.0,
+    'svt_av1': 1.0,
+    # Hardware encoders barely depend on the speed setting
+    'nvenc': 0.1,
+    'qsv': 0.1,
+    'vce': 0.1,
+    'vt': 0.1,
+    'mf': 0.1,
+}
+
+
+class Preset:
+    """
+    Summary
+    ---
+    A single Handbrake preset.  "settings" holds the preset as it is in the presets file; the properties pull out
+    what is needed before a job is run.
+    """
+    __slots__ = ('name', 'category', 'settings')
+
+    def __init__(self, name, category, settings):
+        """
+        :param name: (str) full preset name, "<category>/<preset-name>" (or just the preset name, if not in a folder)
+        :param category: (str) folder the preset is in ('' if none)
+        :param settings: (dict) the preset, as in the presets file
+        """
+        self.name = name
+        self.category = category
+        self.settings = settings
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}: {self.encoder} {self.speed} RF {self.rf})'
+
+    @property
+    def encoder(self) -> str:
+        return self.settings.get('VideoEncoder', '')
+
+    @property
+    def rf(self) -> float:
+        """
+        :return: (float) constant quality (RF) of the preset, or 0 if it encodes to a bit rate instead
+        """
+        return float(self.settings.get('VideoQualitySlider', 0)) if self.settings.get('VideoQualityType') == 2 else 0.0
+
+    @property
+    def speed(self) -> str:
+        return self.settings.get('VideoPreset', '')
+
+    @property
+    def max_height(self) -> int:
+        """
+        :return: (int) largest height the preset outputs, or 0 if it keeps the source's
+        """
+        return int(self.settings.get('PictureHeight') or 0)
+
+    @property
+    def audio_copy_mask(self) -> list:
+        return self.settings.get('AudioCopyMask', [])
+
+    @property
+    def subtitle_scan(self) -> bool:
+        """
+        :return: (bool) whether the preset adds a foreign audio scan track (forced subtitles for foreign dialogue)
+        """
+        return bool(self.settings.get('SubtitleAddForeignAudioSearch'))
+
+    @property
+    def subtitle_burn(self) -> str:
+        """
+        :return: (str) which subtitle track the preset burns in: "none", "foreign", "first" or "foreign_first"
+        """
+        return self.settings.get('SubtitleBurnBehavior') or 'none'
+
+    @property
+    def audio_encoder(self) -> str:
+        """
+        :return: (str) encoder for audio that isn't passed through
+        """
+        audio_list = self.settings.get('AudioList') or [{}]
+        return audio_list[0].get('AudioEncoder') or self.settings.get('AudioEncoderFallback') or 'av_aac'
+
+    @property
+    def speed_factor(self) -> float:
+        """
+        :return: (float) rough seconds of encoding per second of media, from the encoder and its speed setting
+        """
+        encoder = next((f for e, f in _ENCODER_FACTORS.items() if self.encoder.startswith(e)), 1.0)
+        return _SPEED_FACTORS.get(self.speed, _SPEED_FACTORS['medium']) * encoder
+
+    def as_file(self, version):
+        """
+        :param version: (dict) version keys of the presets file it came from
+        :return: (dict) presets file holding only this preset (in its folder, so its full name still finds it)
+        """
+        preset_list = [self.settings]
+        if self.category:
+            preset_list = [{'ChildrenArray': preset_list, 'Folder': True, 'PresetName': self.category,
+                            'Type': self.settings.get('Type', 1)}]
+        return dict(version, PresetList=preset_list)
+
+
+class PresetIndex:
+    """
+    Summary
+    ---
+    Every preset in a presets file, indexed by name.  The file is read the first time a preset is looked up, and
+    read again if it has changed since.
+    """
+    def __init__(self, path=None, cache_dir=None):
+        """
+        :param path: (optional -> str) presets file, defaults to settings.PRESET_FILE
+        :param cache_dir: (optional -> str) folder for single-preset files, defaults to settings.PRESET_CACHE_DIR
+        """
+        self.path = path or st.PRESET_FILE
+        self.cache_dir = cache_dir or st.PRESET_CACHE_DIR
+        self._presets = {}
+        self._version = {}
+        # Modified time of the presets file when it was read (-1 until then, None if it doesn't exist)
+        self._mtime_ns = -1
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Read the presets file, if it hasn't been read yet (or has changed).  A missing or unreadable file has no
+        presets.
+
+        :return: (dict) presets, by name
+        """
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+
+        with self._lock:
+            if mtime_ns == self._mtime_ns:
+                return self._presets
+
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+
+            presets = {}
+            for entry in data.get('PresetList', []):
+                if entry.get('Folder'):
+                    for child in entry.get('ChildrenArray', []):
+                        name = '/'.join([entry['PresetName'], child['PresetName']])
+                        presets[name] = Preset(name, entry['PresetName'], child)
+                else:
+                    presets[entry['PresetName']] = Preset(entry['PresetName'], '', entry)
+
+            self._presets = presets
+            self._version = {k: v for k, v in data.items() if k.startswith('Version')}
+            self._mtime_ns = mtime_ns
+            return presets
+
+    @property
+    def presets(self) -> dict:
+        return self._load()
+
+    def get(self, name):
+        """
+        :param name: (str) preset name, as in settings.presets
+        :return: (Preset or None) the preset, or None if it isn't in the file
+        """
+        return self._load().get(name)
+
+    def missing(self, names):
+        """
+        :param names: (iterable) preset names
+        :return: (list) names that aren't in the presets file
+        """
+        presets = self._load()
+        return sorted({n for n in names if n not in presets})
+
+    def import_file(self, name) -> str:
+        """
+        Summary
+        ---
+        Presets file to hand to HandBrakeCLI for a preset: a file holding only that preset.  It's written the first
+        time it's needed, and again if the presets file has changed since.  Falls back on the full presets file if
+        the preset isn't in it (HandBrakeCLI will report it).
+
+        :param name: (str) preset name
+        :return: (str) path to the file
+        """
+        preset = self.get(name)
+        if preset is None:
+            return self.path
+
+        file_ = os.path.join(self.cache_dir, hashlib.sha1(name.encode()).hexdigest()[:16] + '.json')
+        try:
+            fresh = os.stat(file_).st_mtime_ns >= self._mtime_ns
+        except OSError:
+            fresh = False
+
+        if not fresh:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written aside and renamed, so a job starting at the same time never reads half a file
+            partial = f'{file_}.{os.getpid()}.{threading.get_ident()}'
+            with open(partial, 'w') as f:
+                json.dump(preset.as_file(self._version), f, indent=1)
+            os.replace(partial, file_)
+        return file_
+
+
+# Presets in settings.PRESET_FILE, read once they're needed
+index = store.Lazy(PresetIndex)
+
+
+def find_preset(name):
+    """
+    :param name: (str) preset name, as in settings.presets
+    :return: (Preset or None) the preset, or None if it isn't in settings.PRESET_FILE
+    """
+    return index.get(name)
@@ -0,0 +1,75 @@
+"""
+Routine Convert - probe cache
+
+
+Summary
+-------
+Probing a file with ffprobe means starting a process for it.  Since the files waiting in "TO_CONVERT" rarely change
+between runs, the probe result of each file is kept on disk, and only probed again when its size or modified time
+has changed.
+
+
+Description
+--------
+ProbeCache (SqliteStore):     probe results, keyed on each file's path, size and modified time
+"""
+import json
+import os
+
+import store
+
+
+class ProbeCache(store.SqliteStore):
+    schema = '''
+        CREATE TABLE IF NOT EXISTS probes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            probe TEXT NOT NULL
+        );
+    '''
+
+    def get(self, file_):
+        """
+        Summary
+        ---
+        Return the cached probe result for file_, as long as the file hasn't changed since it was probed.
+
+        :param file_: (str) path to the media file
+        :return: (dict or None) probe result, or None if it needs to be probed (again)
+        """
+        try:
+            stat = os.stat(file_)
+        except OSError:
+            return None
+
+        rows = self.execute('SELECT size, mtime_ns, probe FROM probes WHERE path = ?', (file_,))
+        if rows and rows[0][:2] == (stat.st_size, stat.st_mtime_ns):
+            return json.loads(rows[0][2])
+        return None
+
+    def put(self, file_, probe_dict):
+        """
+        Summary
+        ---
+        Remember the probe result for file_, along with the size and modified time it had when probed.
+
+        :param file_: (str) path to the media file
+        :param probe_dict: (dict) probe result
+        :return: None
+        """
+        stat = os.stat(file_)
+        self.execute('INSERT OR REPLACE INTO probes (path, size, mtime_ns, probe) VALUES (?, ?, ?, ?)',
+                     (file_, stat.st_size, stat.st_mtime_ns, json.dumps(probe_dict)))
+
+    def evict_missing(self):
+        """
+        Summary
+        ---
+        Forget files which no longer exist (converted sources are moved out of "TO_CONVERT", for example).
+
+        :return: (int) number of entries removed
+        """
+        missing = [(p,) for (p,) in self.execute('SELECT path FROM probes') if not os.path.exists(p)]
+        self.executemany('DELETE FROM probes WHERE path = ?', missing)
+        return len(missing)
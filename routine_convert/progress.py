@@ -0,0 +1,351 @@
+"""
+Routine Convert - encode progress
+
+
+Summary
+-------
+HandBrakeCLI reports its progress as it goes (percent done, current and average fps, ETA), and the average speed of
+the job in its log once done.  This reads that output from a running process, line by line, and turns it into
+progress events.  Events are handed to "sinks", which show them in the console, log them, or serve them as metrics.
+
+
+Description
+--------
+ProgressEvent (object):     progress of an encode at one point in time
+parse_progress (function):  progress event from a line of HandBrakeCLI output, if it is a progress line
+parse_avg_fps (function):   average fps of the job, from HandBrakeCLI's log, if it is the summary line
+read_lines (function):      lines of output from a process, split on carriage returns as well as new lines
+
+ProgressSink (object):      base class for something that receives progress of running encodes
+ConsoleSink (ProgressSink): table of running encodes, printed every few seconds
+JsonLinesSink (ProgressSink):   every event, appended to a JSON-lines file
+MetricsSink (ProgressSink): Prometheus-style metrics, served over HTTP
+ProgressSinks (ProgressSink):   hands events to several sinks
+make_sinks (function):      sinks named in settings.progress_sinks
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import settings as st
+
+
+# Ex:  Encoding: task 1 of 1, 45.67 % (23.45 fps, avg 21.12 fps, ETA 01h02m03s)
+_PROGRESS_RE = re.compile(r'Encoding: task (\d+) of (\d+), ([\d.]+) %'
+                          r'(?: \(([\d.]+) fps, avg ([\d.]+) fps, ETA (\d+)h(\d+)m(\d+)s\))?')
+
+# Ex:  [21:10:32] work: average encoding speed for job is 22.123456 fps
+_AVG_FPS_RE = re.compile(r'average encoding speed for job is ([\d.]+) fps')
+
+_LINE_SPLIT_RE = re.compile(rb'[\r\n]+')
+
+
+class ProgressEvent:
+    """
+    Summary
+    ---
+    Progress of an encode.  HandBrakeCLI only reports fps and ETA once it has been running for a moment, so
+    those are 0 until then.
+    """
+    __slots__ = ('task', 'tasks', 'percent', 'fps', 'avg_fps', 'eta_secs')
+
+    def __init__(self, task=1, tasks=1, percent=0.0, fps=0.0, avg_fps=0.0, eta_secs=0):
+        self.task = task
+        self.tasks = tasks
+        self.percent = percent
+        self.fps = fps
+        self.avg_fps = avg_fps
+        self.eta_secs = eta_secs
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.percent:.2f} %, {self.fps:.2f} fps, avg {self.avg_fps:.2f} fps, ' \
+               f'ETA {self.eta_secs}s)'
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def parse_progress(line):
+    """
+    :param line: (str) line of HandBrakeCLI output
+    :return: (ProgressEvent or None) progress, or None if line isn't a progress line
+    """
+    match = _PROGRESS_RE.search(line)
+    if not match:
+        return None
+
+    task, tasks, percent, fps, avg_fps, hours, minutes, seconds = match.groups()
+    event = ProgressEvent(int(task), int(tasks), float(percent))
+    if fps:
+        event.fps = float(fps)
+        event.avg_fps = float(avg_fps)
+        event.eta_secs = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    return event
+
+
+def parse_avg_fps(line):
+    """
+    :param line: (str) line of HandBrakeCLI output
+    :return: (float or None) average fps of the job, or None if line isn't the summary line
+    """
+    match = _AVG_FPS_RE.search(line)
+    return float(match.group(1)) if match else None
+
+
+def read_lines(stream):
+    """
+    Summary
+    ---
+    Yield lines of output from stream as they arrive.  Progress is written over itself with carriage returns, so
+    those count as line breaks too.
+
+    :param stream: (binary file) output of a process
+    :return: (generator) lines, as str
+    """
+    pending = b''
+    for chunk in iter(lambda: stream.read1(4096), b''):
+        lines = _LINE_SPLIT_RE.split(pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line.decode(errors='replace')
+    if pending:
+        yield pending.decode(errors='replace')
+
+
+class ProgressSink:
+    """
+    Summary
+    ---
+    Receives progress of running encodes.  Jobs are identified by their source file.  Sinks are called from the
+    worker threads, so they must be safe to call from several threads at once.
+    """
+    def open(self, workers):
+        """
+        Called before a batch of encodes starts.
+
+        :param workers: (int) number of concurrent encodes
+        """
+
+    def start(self, job):
+        """
+        :param job: (str) source file of the encode that started
+        """
+
+    def update(self, job, event):
+        """
+        :param job: (str) source file of the encode
+        :param event: (ProgressEvent) progress of the encode
+        """
+
+    def finish(self, job, returncode):
+        """
+        :param job: (str) source file of the encode that finished
+        :param returncode: (int) return code of the encode
+        """
+
+    def close(self):
+        """
+        Called once the batch of encodes is done.
+        """
+
+
+class ConsoleSink(ProgressSink):
+    """
+    Summary
+    ---
+    Print a table of the running encodes, at most every "interval" seconds.
+    """
+    def __init__(self, interval=None):
+        self.interval = st.progress_console_secs if interval is None else interval
+        self._running = {}
+        self._printed = 0.0
+        self._lock = threading.Lock()
+
+    def start(self, job):
+        with self._lock:
+            self._running[job] = ProgressEvent()
+
+    def update(self, job, event):
+        with self._lock:
+            self._running[job] = event
+            now = time.monotonic()
+            if now - self._printed < self.interval:
+                return
+            self._printed = now
+            rows = [f'\t{e.percent:6.2f} %\t{e.fps:7.2f} fps\tavg {e.avg_fps:7.2f} fps\t'
+                    f'ETA {e.eta_secs // 3600}h{e.eta_secs % 3600 // 60:02d}m\t{os.path.basename(j)}'
+                    for j, e in self._running.items()]
+        print('\n'.join([f'>>> {len(rows)} encode(s) running:'] + rows))
+
+    def finish(self, job, returncode):
+        with self._lock:
+            self._running.pop(job, None)
+
+
+class JsonLinesSink(ProgressSink):
+    """
+    Summary
+    ---
+    Append every event to a JSON-lines file (one JSON object per line), for later review.
+    """
+    def __init__(self, path=None):
+        self.path = path or st.PROGRESS_LOG_FILE
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        record['time'] = time.time()
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def open(self, workers):
+        self._write({'event': 'open', 'workers': workers})
+
+    def start(self, job):
+        self._write({'event': 'start', 'job': job})
+
+    def update(self, job, event):
+        self._write(dict(event.as_dict(), event='progress', job=job))
+
+    def finish(self, job, returncode):
+        self._write({'event': 'finish', 'job': job, 'returncode': returncode})
+
+    def close(self):
+        self._write({'event': 'close'})
+
+
+class MetricsSink(ProgressSink):
+    """
+    Summary
+    ---
+    Serve the progress of running encodes as Prometheus-style metrics (plain text) at http://<host>:<port>/metrics.
+    "last_update_seconds" shows how long ago each encode last reported progress, so stalled encodes stand out.
+    """
+    def __init__(self, port=None, host='127.0.0.1'):
+        self.address = (host, st.metrics_port if port is None else port)
+        self.workers = 0
+        self.finished = {'succeeded': 0, 'failed': 0}
+        self._running = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def open(self, workers):
+        self.workers = workers
+        if self._server is None:
+            # Only needed when metrics are served, and slow to import
+            import http.server
+            sink = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = sink.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = http.server.ThreadingHTTPServer(self.address, Handler)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def start(self, job):
+        with self._lock:
+            self._running[job] = (ProgressEvent(), time.monotonic())
+
+    def update(self, job, event):
+        with self._lock:
+            self._running[job] = (event, time.monotonic())
+
+    def finish(self, job, returncode):
+        with self._lock:
+            self._running.pop(job, None)
+            self.finished['failed' if returncode else 'succeeded'] += 1
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def render(self):
+        """
+        :return: (str) metrics, in the Prometheus text format
+        """
+        now = time.monotonic()
+        with self._lock:
+            lines = [
+                f'routine_convert_workers {self.workers}',
+                f'routine_convert_jobs_running {len(self._running)}',
+                f'routine_convert_worker_utilization {len(self._running) / self.workers if self.workers else 0}',
+            ]
+            lines += [f'routine_convert_jobs_finished_total{{result="{k}"}} {v}' for k, v in self.finished.items()]
+            for job, (event, updated) in self._running.items():
+                label = '{job="%s"}' % job.replace('\\', '\\\\').replace('"', '\\"')
+                lines += [
+                    f'routine_convert_job_percent{label} {event.percent}',
+                    f'routine_convert_job_fps{label} {event.fps}',
+                    f'routine_convert_job_avg_fps{label} {event.avg_fps}',
+                    f'routine_convert_job_eta_seconds{label} {event.eta_secs}',
+                    f'routine_convert_job_last_update_seconds{label} {now - updated:.1f}',
+                ]
+        return '\n'.join(lines) + '\n'
+
+
+class ProgressSinks(ProgressSink):
+    """
+    Summary
+    ---
+    Hand every call over to each of the sinks given.
+    """
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def open(self, workers):
+        for sink in self.sinks:
+            sink.open(workers)
+
+    def start(self, job):
+        for sink in self.sinks:
+            sink.start(job)
+
+    def update(self, job, event):
+        for sink in self.sinks:
+            sink.update(job, event)
+
+    def finish(self, job, returncode):
+        for sink in self.sinks:
+            sink.finish(job, returncode)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+# Sinks that can be named in settings.progress_sinks
+sink_types = {
+    'console': ConsoleSink,
+    'jsonl': JsonLinesSink,
+    'metrics': MetricsSink,
+}
+
+
+def make_sinks(names=None):
+    """
+    :param names: (optional -> list) names of sinks (see sink_types), defaults to settings.progress_sinks
+    :return: (ProgressSinks) the sinks, as one
+    """
+    names = st.progress_sinks if names is None else names
+    unknown = [n for n in names if n not in sink_types]
+    if unknown:
+        raise ValueError(f'Unknown progress sink(s): {", ".join(unknown)}, expected one of: {", ".join(sink_types)}')
+    return ProgressSinks(sink_types[n]() for n in names)
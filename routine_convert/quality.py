@@ -0,0 +1,258 @@
+"""
+Routine Convert - quality-targeted encoding
+
+
+Summary
+-------
+Every title used to be encoded at the RF (constant quality) of its preset.  Easy content (animation, clean digital
+sources) looks just as good at a higher RF, and comes out much smaller.  Instead of guessing, a few short clips of
+each source are encoded at candidate RFs, and each clip is compared with the source by ffmpeg (SSIM, PSNR or VMAF).
+The highest RF whose clips all still meet the target score is used for the full encode.
+
+Quality only goes down as RF goes up, so the candidates are searched by halving (a handful of rounds, rather than
+one per candidate), and the clips of each round are encoded and measured side by side.  Results are kept on disk
+until the source changes.
+
+
+Description
+--------
+QualityResult (object):     RF picked for a source, and the score it measured
+QualityCache (SqliteStore): results of past searches, by source (and search settings)
+sample_points (function):   start times and length of the clips taken from a source
+measure (function):         score of an encoded clip, compared with the source
+search_rf (function):       highest RF that meets the target score
+"""
+import concurrent.futures
+import json
+import os
+import re
+import subprocess
+
+import settings as st
+import store
+
+
+# Filter (values) that measures each metric (keys) in ffmpeg
+_METRIC_FILTERS = {
+    'ssim': 'ssim',
+    'psnr': 'psnr',
+    'vmaf': 'libvmaf',
+}
+
+# Score of the whole clip, in ffmpeg's output for each metric
+# Ex:  [Parsed_ssim_1 @ 0x...] SSIM Y:0.995 (23.1) U:0.997 (25.6) V:0.997 (25.3) All:0.996 (23.9)
+# Ex:  [Parsed_psnr_1 @ 0x...] PSNR y:45.1 u:48.2 v:48.6 average:46.0 min:40.2 max:52.7
+# Ex:  [Parsed_libvmaf_1 @ 0x...] VMAF score: 95.301
+_METRIC_RES = {
+    'ssim': re.compile(r'All:([\d.]+|inf)'),
+    'psnr': re.compile(r'average:([\d.]+|inf)'),
+    'vmaf': re.compile(r'VMAF score[:=]\s*([\d.]+)'),
+}
+
+
+class QualityResult:
+    """
+    Summary
+    ---
+    RF picked for a source by search_rf, with the worst score its clips measured.  "met" is False when even the
+    lowest candidate RF fell short of the target (that RF is used anyway).
+    """
+    __slots__ = ('rf', 'score', 'metric', 'met')
+
+    def __init__(self, rf, score, metric, met=True):
+        self.rf = rf
+        self.score = score
+        self.metric = metric
+        self.met = met
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(RF {self.rf}: {self.metric} {self.score:.4f}' \
+               + ('' if self.met else ', below target') + ')'
+
+
+class QualityCache(store.SqliteStore):
+    """
+    Summary
+    ---
+    Results of past searches.  A result is used as long as the source hasn't changed (size and modified time) and
+    it was searched for with the same preset, metric, target and candidates.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS results (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            params TEXT NOT NULL,
+            rf REAL NOT NULL,
+            score REAL NOT NULL,
+            met INTEGER NOT NULL
+        );
+    '''
+
+    @staticmethod
+    def _key(file_, preset):
+        stat = os.stat(file_)
+        params = json.dumps([preset, st.quality_metric, st.quality_target, sorted(st.quality_rf_candidates),
+                             st.quality_samples, st.quality_sample_secs])
+        return stat.st_size, stat.st_mtime_ns, params
+
+    def get(self, file_, preset):
+        """
+        :param file_: (str) path to the source
+        :param preset: (str) preset the source is encoded with
+        :return: (QualityResult or None) result of the last search, or None if it needs searching (again)
+        """
+        rows = self.execute('SELECT size, mtime_ns, params, rf, score, met FROM results WHERE path = ?', (file_,))
+        if rows and rows[0][:3] == self._key(file_, preset):
+            return QualityResult(rows[0][3], rows[0][4], st.quality_metric, bool(rows[0][5]))
+        return None
+
+    def put(self, file_, preset, result):
+        """
+        :param file_: (str) path to the source
+        :param preset: (str) preset the source is encoded with
+        :param result: (QualityResult) result of the search
+        :return: None
+        """
+        self.execute('INSERT OR REPLACE INTO results (path, size, mtime_ns, params, rf, score, met) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (file_,) + self._key(file_, preset) + (result.rf, result.score, int(result.met)))
+
+
+# Results of past searches (see QualityCache), opened once they're needed
+cache = store.Lazy(lambda: QualityCache(st.QUALITY_CACHE_FILE))
+
+
+def sample_points(duration, count=None, secs=None):
+    """
+    Summary
+    ---
+    Spread "count" clips evenly through the source, leaving out the very start and end (logos, credits).
+
+    :param duration: (float) length of the source, in seconds
+    :param count: (optional -> int) number of clips, defaults to settings.quality_samples
+    :param secs: (optional -> float) length of each clip, defaults to settings.quality_sample_secs
+    :return: (list) start times, in seconds, and (float) length of the clips
+    """
+    count = count or st.quality_samples
+    length = min(secs or st.quality_sample_secs, duration / (count + 1))
+    return [duration * (i + 1) / (count + 1) - length / 2 for i in range(count)], length
+
+
+def measure(source, start, length, clip, metric=None) -> float:
+    """
+    Summary
+    ---
+    Compare an encoded clip with the same stretch of the source, using ffmpeg.  The source is scaled to the size of
+    the clip first, since presets can scale the video down (clips aren't cropped, see clip_args), and both start
+    their timestamps at 0, so each frame of the clip is compared with the frame of the source it was encoded from.
+
+    :param source: (str) path to the source
+    :param start: (float) where the clip starts in the source, in seconds
+    :param length: (float) length of the clip, in seconds
+    :param clip: (str) path to the encoded clip
+    :param metric: (optional -> str) "ssim", "psnr" or "vmaf", defaults to settings.quality_metric
+    :return: (float) score (higher is better)
+    """
+    metric = metric or st.quality_metric
+    lavfi = f'[0:v]setpts=PTS-STARTPTS[src];[1:v]setpts=PTS-STARTPTS[enc];[src][enc]scale2ref[ref][dist];' \
+            f'[dist][ref]{_METRIC_FILTERS[metric]}'
+    process = subprocess.run([st.FFMPEG, '-hide_banner', '-nostats', '-ss', f'{start:.3f}', '-t', f'{length:.3f}',
+                              '-i', source, '-i', clip, '-lavfi', lavfi, '-f', 'null', '-'],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    found = _METRIC_RES[metric].findall(process.stderr.decode(errors='replace'))
+    if process.returncode or not found:
+        raise ValueError(f'Could not measure {metric} of {clip} (ffmpeg returned {process.returncode})')
+    # A clip identical to the source has infinite PSNR
+    return float(found[-1]) if found[-1] != 'inf' else float('inf')
+
+
+def clip_args(m, start, length, rf):
+    """
+    Summary
+    ---
+    HandBrakeCLI arguments to encode a clip of m at rf, without audio or subtitles, and left uncropped so it can be
+    compared with the source frame for frame.  Where the frame rate is known the clip is cut on frame numbers, and its
+    start and length are moved onto frames, for measure to cut the source on the same frames.
+
+    :param m: (Media) media object
+    :param start: (float) where the clip starts, in seconds
+    :param length: (float) length of the clip, in seconds
+    :param rf: (float) RF to encode at
+    :return: (str) arguments, and (float) start and (float) length of the clip, in seconds
+    """
+    video = m.video_stream
+    fps = video.frame_rate if video else 0.0
+    args = f'--quality {rf:g} --crop 0:0:0:0 --audio none --subtitle none'
+    if not fps:
+        return f'--start-at seconds:{start:.3f} --stop-at seconds:{length:.3f} {args}', start, length
+    first, frames = round(start * fps), max(1, round(length * fps))
+    return f'--start-at frames:{first} --stop-at frames:{frames} {args}', first / fps, frames / fps
+
+
+def _score_rf(m, rf, points, length, encode_clip, pool, folder):
+    """
+    Encode and measure every clip of m at rf, side by side.
+
+    :return: (float) worst score of the clips
+    """
+    def clip_score(i, start):
+        clip = os.path.join(folder, f'rf{rf:g}_clip{i}.{st.ext}')
+        args, clip_start, clip_length = clip_args(m, start, length, rf)
+        try:
+            returncode = encode_clip(clip, args)
+            if returncode:
+                raise ValueError(f'Encoding a clip at RF {rf:g} failed (returned {returncode})')
+            return measure(m.filename, clip_start, clip_length, clip)
+        finally:
+            if os.path.exists(clip):
+                os.remove(clip)
+
+    return min(pool.map(lambda p: clip_score(*p), enumerate(points)))
+
+
+def search_rf(m, preset, encode_clip, workers=None):
+    """
+    Summary
+    ---
+    Find the highest RF (smallest file, quickest encode) in settings.quality_rf_candidates whose clips all meet
+    settings.quality_target.  If none do, the lowest candidate is picked.  Results are cached (see QualityCache).
+
+    :param m: (Media) media object
+    :param preset: (str) preset it's encoded with
+    :param encode_clip: (callable) encodes a clip of m; called with the output file and the extra HandBrakeCLI
+    arguments (see clip_args, to be added to a command without track selection), returns the return code
+    :param workers: (optional -> int) clips encoded at once, defaults to settings.quality_workers
+    :return: (QualityResult) RF to use
+    """
+    cached = cache.get(m.filename, preset)
+    if cached is not None:
+        return cached
+
+    points, length = sample_points(m.duration)
+    candidates = sorted(st.quality_rf_candidates)
+    folder = os.path.join(st.QUALITY_DIR, os.path.splitext(os.path.basename(m.filename))[0])
+    os.makedirs(folder, exist_ok=True)
+
+    best = None
+    low, high = 0, len(candidates) - 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or st.quality_workers) as pool:
+        while low <= high:
+            middle = (low + high) // 2
+            score = _score_rf(m, candidates[middle], points, length, encode_clip, pool, folder)
+            if score >= st.quality_target:
+                best = QualityResult(candidates[middle], score, st.quality_metric)
+                low = middle + 1
+            else:
+                high = middle - 1
+
+    if best is None:
+        # Every round fell short, the last one being the lowest RF
+        best = QualityResult(candidates[0], score, st.quality_metric, met=False)
+
+    try:
+        os.rmdir(folder)
+    except OSError:
+        pass
+    cache.put(m.filename, preset, best)
+    return best
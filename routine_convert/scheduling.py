@@ -0,0 +1,171 @@
+"""
+Routine Convert - job ordering
+
+
+Summary
+-------
+Decide in which order queued media is converted.  Left to itself, media is converted in whatever order it was found
+on disk, but with a limited overnight window, it's better to get as many titles done as possible before morning.
+Policies use what is already known about each media object (duration, size and disc format/preset) to estimate how
+long it will take to convert.
+
+
+Description
+--------
+estimate_encode_secs (function):    estimated time to convert a media object
+plan_etas (function):               estimated time each queued job, and the whole batch, will be done
+order_jobs (function):              order media by a policy (by name from "policies", or any callable)
+policies (dict):                    available policies, by name
+"""
+import heapq
+
+import decisions as dc
+import preset_rules as pr
+import presets as ps
+import settings as st
+import speed_history as sh
+import store
+
+
+# Speed of past encodes, used to estimate how long a job will take (see speed_history.py), opened once it's needed
+history = store.Lazy(lambda: sh.SpeedHistory(st.SPEED_HISTORY_FILE) if st.use_speed_history else None)
+
+
+def estimate_encode_secs(m, decision=None) -> float:
+    """
+    Summary
+    ---
+    Estimate how long converting m will take: its duration, scaled by how slow its preset is.  How slow a preset is
+    comes from past encodes with the preset (at the same resolution, if there are any), otherwise from
+    settings.preset_speed_factors, or from the preset's encoder and speed setting (see presets.Preset).  Media that
+    is only remuxed (see decisions.py) takes about as long as copying it.
+
+    :param m: Media - media object
+    :param decision: (optional -> decisions.Decision) what's done with m, if already decided (otherwise decided here)
+    :return: (float) seconds
+    """
+    if (decision or dc.decide(m)).action != dc.ENCODE:
+        return m.duration * st.remux_speed_factor
+
+    preset = pr.preset_of(m)
+    ratio = history.ratio(preset, sh.resolution_of(m)) if history else None
+    if ratio is None:
+        ratio = st.preset_speed_factors.get(preset)
+    if ratio is None:
+        found = ps.find_preset(preset)
+        ratio = found.speed_factor if found else st.default_speed_factor
+    return m.duration * ratio
+
+
+def _estimates(media_list, decisions=None) -> dict:
+    """
+    :param media_list: (list) media objects
+    :param decisions: (optional -> dict) decisions.Decision (values) already made for media objects (keys)
+    :return: (dict) estimated seconds (values) to convert each media object (keys)
+    """
+    decisions = decisions or {}
+    return {m: estimate_encode_secs(m, decisions.get(m)) for m in media_list}
+
+
+def plan_etas(media_list, workers=1, decisions=None):
+    """
+    Summary
+    ---
+    Estimate when each job in media_list will be done, converting them in order with "workers" at a time (each
+    job starts as soon as a worker is free).
+
+    :param media_list: (list) ordered media objects
+    :param workers: (int) number of concurrent encodes
+    :param decisions: (optional -> dict) decisions.Decision (values) already made for media objects (keys)
+    :return: (tuple) list of (media object, seconds until it's done), seconds until the whole batch is done
+    """
+    estimates = _estimates(media_list, decisions)
+    free_at = [0.0] * max(1, workers)
+    etas = []
+    for m in media_list:
+        start = heapq.heappop(free_at)
+        done = start + estimates[m]
+        heapq.heappush(free_at, done)
+        etas.append((m, done))
+    return etas, max(free_at)
+
+
+def format_secs(secs) -> str:
+    """
+    :param secs: (float) seconds
+    :return: (str) e.g. "2h05m"
+    """
+    minutes = round(secs / 60)
+    return f'{minutes // 60}h{minutes % 60:02d}m'
+
+
+def fifo(media_list, workers=1, decisions=None):
+    """
+    Convert media in the order it was found.
+    """
+    return list(media_list)
+
+
+def shortest_first(media_list, workers=1, decisions=None):
+    """
+    Convert the quickest media first, so the most titles are done soonest.
+    """
+    return sorted(media_list, key=_estimates(media_list, decisions).get)
+
+
+def largest_first(media_list, workers=1, decisions=None):
+    """
+    Convert the largest files first, to free up the most disk space soonest.
+    """
+    return sorted(media_list, key=lambda m: m.size, reverse=True)
+
+
+def overnight(media_list, workers=1, decisions=None):
+    """
+    Pack as many titles as possible into the overnight window (settings.overnight_window_hours).  The quickest
+    titles are picked until the window (shared by all workers) is full.  These are started longest first, so the
+    workers finish at about the same time, and everything else is queued after them in case there's time left.
+    """
+    budget = st.overnight_window_hours * 3600 * workers
+    estimates = _estimates(media_list, decisions)
+    picked, rest = [], []
+
+    for m in sorted(media_list, key=estimates.get):
+        secs = estimates[m]
+        if secs <= budget:
+            budget -= secs
+            picked.append(m)
+        else:
+            rest.append(m)
+
+    return sorted(picked, key=estimates.get, reverse=True) + rest
+
+
+policies = {
+    'fifo': fifo,
+    'shortest_first': shortest_first,
+    'largest_first': largest_first,
+    'overnight': overnight,
+}
+
+
+def order_jobs(media_list, policy=None, workers=1, decisions=None):
+    """
+    Summary
+    ---
+    Order media_list to be converted.
+
+    :param media_list: (list) media objects
+    :param policy: (optional -> str or callable) name of a policy, or a function taking (media_list, workers,
+    decisions) and returning the ordered list.  Defaults to settings.job_order.
+    :param workers: (int) number of concurrent encodes
+    :param decisions: (optional -> dict) decisions.Decision (values) already made for media objects (keys), so
+    they aren't decided again for every estimate
+    :return: (list) ordered media objects
+    """
+    policy = policy or st.job_order
+    if not callable(policy):
+        if policy not in policies:
+            raise ValueError(f'Unknown job order "{policy}", expected one of: {", ".join(policies)}')
+        policy = policies[policy]
+    return policy(media_list, workers=workers, decisions=decisions)
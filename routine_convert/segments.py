@@ -0,0 +1,228 @@
+"""
+Routine Convert - segmented encodes
+
+
+Summary
+-------
+A long Blu-Ray title on a single HandBrakeCLI process can take longer than everything else in the queue put
+together.  Instead, the title can be split into time ranges (using the duration from probing it), each range
+encoded on a different worker, and the encoded pieces joined back together with ffmpeg - without encoding them a
+second time.  Before the joined file is accepted, the pieces are checked to have the same streams (audio, subtitles)
+as each other, each to be as long as the range it was planned for (a piece that ran short, or past its end, leaves a
+gap or an overlap in the joined file), with its audio starting and ending with its video (or the sound drifts out of
+sync from that piece on), and together to add up to the length of the source.  The pieces are removed
+once the title is done, whether it was joined or a piece failed, and any left over from an interrupted run are
+removed before it's split again.
+
+
+Description
+--------
+Segment (MediaPart):            a time range of a media object, encoded to its own file
+should_segment (function):      whether a media object is long enough to be split up
+segment_folder (function):      folder the segments of a media object are encoded into
+plan_segments (function):       split a media object into segments
+remove_segments (function):     remove the segments of a media object
+join_segments (function):       check the encoded segments and join them into one file
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+import media as me
+import settings as st
+
+
+class Segment(me.MediaPart):
+    """
+    Summary
+    ---
+    A time range of a media object.  The segment is encoded to "output" (in the segment folder, see settings).
+    """
+    __slots__ = ()
+
+    def cli_args(self) -> str:
+        """
+        Summary
+        ---
+        HandBrakeCLI arguments to only encode the segment.  The last segment runs to the end of the source, so
+        nothing is lost to rounding in the probed duration.
+
+        :return: (str) arguments
+        """
+        args = f'--start-at seconds:{self.start:.3f}'
+        if not self.is_last:
+            args += f' --stop-at seconds:{self.length:.3f}'
+        return args
+
+
+def should_segment(m, workers) -> bool:
+    """
+    :param m: Media - media object
+    :param workers: int - number of concurrent encodes
+    :return: (bool) whether m should be split up (segmented encodes are on, and m is long enough)
+    """
+    return st.segment_encodes and workers > 1 and m.duration >= st.segment_min_minutes * 60
+
+
+def segment_folder(m) -> str:
+    """
+    :param m: Media - media object
+    :return: (str) folder its segments are encoded into, named after the full path of its source (the DVD and the
+    Blu-Ray of a title share a filename)
+    """
+    return os.path.join(st.SEGMENT_DIR, hashlib.sha1(m.filename.encode()).hexdigest()[:16])
+
+
+def plan_segments(m, count):
+    """
+    Summary
+    ---
+    Split m into "count" segments of (about) equal length.  Segments left over from an interrupted run are removed
+    (they may have been split differently).
+
+    :param m: Media - media object
+    :param count: int - number of segments
+    :return: (list) segments, in order
+    """
+    folder = segment_folder(m)
+    remove_segments(m)
+    os.makedirs(folder, exist_ok=True)
+    length = m.duration / count
+    return [Segment(m, i, count, i * length, length, os.path.join(folder, f'part{i:03d}.{st.ext}'))
+            for i in range(count)]
+
+
+def remove_segments(m):
+    """
+    Summary
+    ---
+    Remove the segments of m (see segment_folder), once it's done: joined, or given up on because one failed.
+
+    :param m: Media - media object
+    :return: None
+    """
+    shutil.rmtree(segment_folder(m), ignore_errors=True)
+
+
+def _stream_duration(stream):
+    """
+    :param stream: (dict) probed stream
+    :return: (float or None) its duration in seconds (Matroska only tags it), or None if it isn't known
+    """
+    tags = stream.get('tags', {})
+    duration = stream.get('duration') or tags.get('DURATION') or next(
+        (v for k, v in tags.items() if k.startswith('DURATION-')), None)
+    return me.parse_seconds(duration) if duration else None
+
+
+def _probe_streams(file_):
+    """
+    :param file_: (str) path to a media file
+    :return: (tuple) dict of {codec type: number of streams}, duration in seconds, and list of (codec type, start,
+    duration) of its video and audio streams, in order (duration None where it isn't known)
+    """
+    out = subprocess.check_output([st.FFPROBE, '-i', file_, '-print_format', 'json', '-show_streams',
+                                   '-show_format'], stderr=subprocess.PIPE)
+    probe = json.loads(out)
+    counts, timing = {}, []
+    for stream in probe.get('streams', []):
+        counts[stream.get('codec_type')] = counts.get(stream.get('codec_type'), 0) + 1
+        if stream.get('codec_type') in ('video', 'audio'):
+            timing.append((stream['codec_type'], float(stream.get('start_time') or 0), _stream_duration(stream)))
+    return counts, float(probe.get(st.FFPROBE_FMT_STR, {}).get('duration', 0)), timing
+
+
+def _sync_problems(segment, timing):
+    """
+    :param segment: (Segment) an encoded segment
+    :param timing: (list) its streams' timing, see _probe_streams
+    :return: (list) audio streams that don't start, or aren't as long, as the video (give or take
+    settings.segment_sync_tolerance_secs)
+    """
+    videos = [(start, duration) for codec_type, start, duration in timing if codec_type == 'video']
+    if not videos:
+        return []
+    video_start, video_duration = videos[0]
+    problems = []
+    audio = [(start, duration) for codec_type, start, duration in timing if codec_type == 'audio']
+    for i, (start, duration) in enumerate(audio, 1):
+        if abs(start - video_start) > st.segment_sync_tolerance_secs:
+            problems.append(f'{segment.job_id} audio {i} starts {start - video_start:+.3f}s from the video')
+        if duration is not None and video_duration is not None \
+                and abs(duration - video_duration) > st.segment_sync_tolerance_secs:
+            problems.append(f'{segment.job_id} audio {i} is {duration:.3f}s long, the video {video_duration:.3f}s')
+    return problems
+
+
+def check_segments(segments):
+    """
+    Summary
+    ---
+    Check the encoded segments can be joined: each one has the same number of video, audio and subtitle streams,
+    is as long as its time range (give or take settings.segment_tolerance_secs), has its audio start and end with its
+    video (see _sync_problems), and together they are as long as the source.
+
+    :param segments: (list) encoded segments of one media object, in order
+    :return: (list) problems found (empty if none)
+    """
+    problems = []
+    streams, total = None, 0.0
+
+    for segment in segments:
+        counts, duration, timing = _probe_streams(segment.output)
+        total += duration
+        # The last segment runs to the end of the source (see Segment.cli_args)
+        planned = segment.media.duration - segment.start if segment.is_last else segment.length
+        if abs(duration - planned) > st.segment_tolerance_secs:
+            problems.append(f'{segment.job_id} is {duration:.1f}s long, expected {planned:.1f}s')
+        problems += _sync_problems(segment, timing)
+        if streams is None:
+            streams = counts
+        elif counts != streams:
+            problems.append(f'{segment.job_id} has streams {counts}, expected {streams}')
+
+    source_duration = segments[0].media.duration
+    if abs(total - source_duration) > st.segment_tolerance_secs * len(segments):
+        problems.append(f'Segments add up to {total:.1f}s, the source is {source_duration:.1f}s')
+    return problems
+
+
+def join_segments(segments, output):
+    """
+    Summary
+    ---
+    Check the encoded segments (see check_segments), then join them into "output" with ffmpeg, copying the streams
+    as they are.  The segments are removed afterwards, either way (see remove_segments).
+
+    :param segments: (list) encoded segments of one media object, in order
+    :param output: (str) path of the joined file
+    :return: (int) 0 if joined, otherwise non-zero
+    """
+    folder = os.path.dirname(segments[0].output)
+    list_file = os.path.join(folder, 'segments.txt')
+    try:
+        problems = check_segments(segments)
+        for problem in problems:
+            print(f'>>> Segments can not be joined:\t{problem}')
+        if problems:
+            return 1
+
+        with open(list_file, 'w') as f:
+            for segment in segments:
+                escaped = segment.output.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+
+        process = subprocess.run([st.FFMPEG, '-y', '-hide_banner', '-loglevel', 'error', '-f', 'concat',
+                                  '-safe', '0', '-i', list_file, '-map', '0', '-c', 'copy', output])
+        if process.returncode:
+            return process.returncode
+
+        # The joined file should have the same streams as its pieces
+        return 0 if _probe_streams(output)[0] == _probe_streams(segments[0].output)[0] else 1
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        print(f'>>> Segments can not be joined:\t{e}')
+        return 1
+    finally:
+        remove_segments(segments[0].media)
@@ -39,12 +39,39 @@ FFPROBE = os.path.join(BIN_DIR, 'ffprobe.exe')  # Ex:  C:\site-packages\routine_
 FFPROBE_FMT_STR = 'format'
 FFPROBE_TAG_STR = 'tags'
 
+# Path to ffmpeg (also part of ffmpeg, only needed to join segmented encodes)
+FFMPEG = os.path.join(BIN_DIR, 'ffmpeg.exe')  # Ex:  C:\site-packages\routine_convert\bin\ffmpeg.exe
+
+# Number of ffprobe processes to run at the same time, when looking for media to convert
+probe_workers = 8
+
+# If True, media found on disk isn't probed until its probe data (duration, bit rate...) is actually read
+lazy_probe = False
+
 
 # MEDIA SETTINGS
 # =================================
 # Media directories
 root_dir = r'C:\media'
 
+# Routine convert keeps a few files of its own (probe results, for example) in a hidden folder in the media root
+DATA_DIR = os.path.join(root_dir, '.routine_convert')
+
+# Keep probe results on disk, so unchanged files don't need to be probed again on the next run
+use_probe_cache = True
+PROBE_CACHE_FILE = os.path.join(DATA_DIR, 'probe_cache.sqlite')
+
+# Look for sources that duplicate another (see fingerprint.py): the same file (by its size, and fingerprint_samples
+# blocks of fingerprint_block_kb read across it), or the same title within duplicate_length_tolerance (a share) of the
+# same length.  Sources converted before are kept in FINGERPRINT_FILE, and count too.  duplicate_action is 'skip'
+# (left in "TO_CONVERT", and reported) or 'flag' (only reported).
+find_duplicates = True
+duplicate_action = 'skip'
+fingerprint_samples = 16
+fingerprint_block_kb = 64
+duplicate_length_tolerance = 0.01
+FINGERPRINT_FILE = os.path.join(DATA_DIR, 'fingerprints.sqlite')
+
 # Output ile format
 container = 'av_mkv'
 ext = 'mkv'
@@ -85,7 +112,11 @@ process_dirs = {
 # =================================
 # Handbrake setting location (this is made by loading up the GUI version of the program)
 # Ex:   C:\users\yourname\AppData\HandBrake\presets.json
-PRESET_FILE = os.path.join(os.environ['AppData'], r'HandBrake\presets.json')
+PRESET_FILE = os.path.join(os.environ.get('AppData', os.path.expanduser('~')), r'HandBrake\presets.json')
+
+# Each job is handed a file holding only its own preset, rather than the whole presets file (see presets.py).  These
+# are kept here, and written again whenever PRESET_FILE changes.
+PRESET_CACHE_DIR = os.path.join(DATA_DIR, 'presets')
 
 # Handbrake presets. The JSON preset file for Handbrake follows a convention of <category>/<preset-name>
 # - Category (e.g.  General, Web, Devices, Matroska...)
@@ -101,6 +132,243 @@ presets = {
     ]),
 }
 
+# Rules picking the preset from what the video actually is, rather than the folder it was put in (see
+# preset_rules.py).  The first rule that matches a file gives its preset; files no rule matches (or that have no
+# probed video) use the preset of their folder, above.  A rule is a dict of conditions, all of which must hold, and
+# the "preset" to use.  Conditions:
+# - min_height/max_height:          height of the video, in pixels
+# - min_fps/max_fps:                frame rate
+# - min_bit_depth/max_bit_depth:    bits per colour component (8, 10, 12...), from the pixel format
+# - hdr:                            True for HDR (PQ or HLG) video, False for SDR
+# - interlaced:                     True for interlaced video
+# - codec:                          codec of the video, as ffprobe names it (e.g. "h264", "hevc", "mpeg2video")
+# - disc_format:                    folder the file was found in (e.g. dvd_name)
+# Ex:   {'hdr': True, 'preset': 'Ryan/(Ryan) 2160p - HDR - 265 10-bit (Slow)'}
+preset_rules = [
+    # SD video, even if it was put in the Blu-Ray folder
+    {'max_height': 576, 'preset': presets[dvd_name]},
+    # HD video, even if it was put in the DVD folder
+    {'min_height': 577, 'preset': presets[blu_name]},
+]
+
+# Pixel formats known to ffmpeg ("ffmpeg -pix_fmts"), used to tell the bit depth of a video
+PIXEL_FORMATS_FILE = os.path.join(os.path.dirname(__file__), 'pixel_formats.txt')
+
+
+# ENCODING
+# =================================
+# Number of HandBrakeCLI processes to run at the same time.  One worker keeps the original behaviour (one encode
+# after another); on a many-core machine, a few workers keep the cores busy through the night.
+encode_workers = 1
+
+# Threads handed to each HandBrakeCLI worker, so concurrent encodes don't oversubscribe the CPU.  When 0, the
+# machine's cores are split evenly between workers.  Only applied when more than one worker is running.
+encode_threads_per_job = 0
+
+# Encoder option used to pass the thread budget (x265 uses "pools", x264 uses "threads").  This is handed to
+# HandBrakeCLI as --encopts, which replaces the preset's "VideoOptionExtra" - so keep this in mind if a preset
+# relies on extra options!
+encode_thread_opt = 'pools={threads}'
+
+# Split long titles into segments, encoded side by side on separate workers and then joined together (see
+# segments.py).  Only titles longer than segment_min_minutes are split, into segment_count pieces (when 0, one per
+# worker).  Segments are encoded into SEGMENT_DIR, and must each be as long as planned (give or take
+# segment_tolerance_secs) and add up to the length of the source.  The audio of each segment must start and end with
+# its video, give or take segment_sync_tolerance_secs.  Joining the segments needs ffmpeg (FFMPEG).
+segment_encodes = False
+segment_min_minutes = 90
+segment_count = 0
+segment_tolerance_secs = 1.0
+segment_sync_tolerance_secs = 0.1
+SEGMENT_DIR = os.path.join(DATA_DIR, 'segments')
+
+# TV show files can hold several episodes.  Their chapters are grouped into episodes of at least episode_min_minutes
+# (see episodes.py), each encoded as a job of its own.  Files no longer than episode_max_minutes are taken to be a
+# single episode.  The episodes found in each file are kept in EPISODE_INDEX_FILE, until the file changes.
+episode_min_minutes = 18
+episode_max_minutes = 65
+EPISODE_INDEX_FILE = os.path.join(DATA_DIR, 'episodes.sqlite')
+
+# Every job writes to a partial file, only moved into the "CONVERTED" folder once the job has succeeded (see
+# staging.py).  Partial files are written to SCRATCH_DIR (a fast local disk), or next to the output if it's empty.
+# A file moved to another disk is copied staging_chunk_mb at a time, and checked (size and checksum) before the
+# original is removed.
+SCRATCH_DIR = ''
+staging_chunk_mb = 8
+
+# While a job encodes, the source of the next one is copied to PREFETCH_DIR (a local SSD) and encoded from there, so
+# sources on a slow disk (a NAS) don't hold up the encoder.  Off if empty.  Sources are only copied if they leave
+# prefetch_min_free_gb free.
+PREFETCH_DIR = ''
+prefetch_min_free_gb = 20
+
+# Only start a job once it fits (see admission.py): its estimated memory in the memory available, keeping
+# admission_reserve_mb free, and its estimated output on the disks it writes to, keeping admission_reserve_gb free.
+# Its threads must fit in admission_cores too (when 0, every core).  Memory is estimated as admission_base_mb plus an
+# amount per pixel of output frame (more for slower presets); output size from target_bit_rates (below), padded by
+# admission_size_margin.  A job that doesn't fit waits for running jobs to finish, checking again every
+# admission_poll_secs; one is always started when nothing else is running.
+use_admission_control = True
+admission_cores = 0
+admission_base_mb = 300
+admission_reserve_mb = 1024
+admission_reserve_gb = 5
+admission_size_margin = 1.25
+admission_poll_secs = 30
+
+# Niceness of HandBrakeCLI processes (0 leaves them be, up to 19 lets everything else on the machine go first).  Not
+# used on Windows.  With more than one worker, pin_encode_cores gives each encode its own share of the cores (Linux
+# only), so they don't trade places on them.
+encode_nice = 0
+pin_encode_cores = False
+
+# Keep a journal of every job on disk.  Jobs interrupted by a crash or reboot are queued again on the next run, and
+# failed jobs are retried (up to job_max_attempts times), waiting job_retry_backoff_secs before the first retry and
+# twice as long after each failed attempt.  A running job gets a heartbeat every job_heartbeat_secs; a job that has
+# gone job_stale_secs without one (its process died, here or on another machine) is queued again by the next run.
+use_journal = True
+JOURNAL_FILE = os.path.join(DATA_DIR, 'journal.sqlite')
+job_max_attempts = 3
+job_retry_backoff_secs = 300
+job_heartbeat_secs = 30
+job_stale_secs = 180
+
+# Keep a catalogue of every source queued and converted (see catalogue.py): what was probed from it, its preset, how
+# long it took to encode, the space it saved and its IMDb details (if it has been looked up).  Query it with
+# "python catalogue.py left", "savings" or "find".
+use_catalogue = True
+CATALOGUE_FILE = os.path.join(DATA_DIR, 'catalogue.sqlite')
+
+# Sources whose video is already in one of target_codecs, at or under the bit rate for its height, aren't encoded
+# again (see decisions.py).  They're remuxed into the output container (with ffmpeg, FFMPEG), or - if already in
+# it - moved straight to the "CONVERTED" folder.  target_bit_rates are in bits per second, by video height: a video
+# uses the entry for the smallest height it fits in.
+use_fast_path = True
+target_codecs = ['hevc']
+target_bit_rates = {
+    480: 2500000,
+    720: 5000000,
+    1080: 10000000,
+    2160: 30000000,
+}
+
+
+# TRACKS
+# =================================
+# Pick the audio and subtitle tracks to keep from each file's probed streams (see tracks.py), instead of leaving it
+# to the preset.  Only tracks in these languages (ISO 639-2 codes, as tagged in the file) are kept, along with tracks
+# that aren't tagged with a language; an empty list keeps every language.  Audio the preset can pass through (its
+# "AudioCopyMask") is copied as it is.  Forced subtitles are kept in any language, and the preset's foreign audio scan
+# and burned in subtitles still apply.
+select_tracks = True
+audio_languages = ['eng']
+subtitle_languages = ['eng']
+
+# Leave out commentary tracks (flagged as such, or with "commentary" in their name)
+drop_commentary = True
+
+
+# QUALITY
+# =================================
+# Instead of the preset's RF, encode each source at the highest RF that still looks good enough (see quality.py).
+# quality_samples clips of quality_sample_secs are taken from the source, encoded at candidate RFs
+# (quality_rf_candidates), and compared with the source by ffmpeg (FFMPEG) using quality_metric: 'ssim', 'psnr' or
+# 'vmaf' (needs ffmpeg built with libvmaf).  Every clip must score at least quality_target; typical targets are 0.98
+# for SSIM, 42 for PSNR (dB) and 93 for VMAF.  quality_workers clips are encoded at once.
+quality_search = False
+quality_metric = 'ssim'
+quality_target = 0.98
+quality_rf_candidates = [16, 18, 20, 22, 24, 26, 28]
+quality_samples = 4
+quality_sample_secs = 20
+quality_workers = 4
+QUALITY_DIR = os.path.join(DATA_DIR, 'quality')
+QUALITY_CACHE_FILE = os.path.join(DATA_DIR, 'quality.sqlite')
+
+
+# IMDB
+# =================================
+# Lookups on IMDb run imdb_workers at a time, but no more than imdb_requests_per_sec requests go out per second.
+# Results are cached for imdb_cache_ttl_days; titles that weren't found are searched again after imdb_negative_ttl_days
+imdb_workers = 4
+imdb_requests_per_sec = 2
+imdb_cache_ttl_days = 30
+imdb_negative_ttl_days = 7
+IMDB_CACHE_FILE = os.path.join(DATA_DIR, 'imdb_cache.sqlite')
+
+
+# PROGRESS
+# =================================
+# Where progress of running encodes is reported (see progress.py):
+# - 'console':  a table of running encodes, printed every progress_console_secs
+# - 'jsonl':    every progress event, appended to PROGRESS_LOG_FILE
+# - 'metrics':  Prometheus-style metrics, at http://127.0.0.1:<metrics_port>/metrics
+progress_sinks = ['console']
+progress_console_secs = 60
+PROGRESS_LOG_FILE = os.path.join(DATA_DIR, 'progress.jsonl')
+metrics_port = 9393
+
+
+# WATCHER
+# =================================
+# When running as a watcher (see watcher.py), a new file is only queued once its size has stopped changing for this
+# many seconds (a rip that is still being written shouldn't be converted!)
+watch_settle_secs = 30
+
+# How often to look for changes.  Without inotify (Linux only), the source folders are polled at this interval
+watch_poll_secs = 5
+
+
+# ENCODE FARM
+# =================================
+# Several machines can share the queue (see farm.py): the coordinator finds and plans the jobs, and listens on
+# farm_host:farm_port for workers, which find it at farm_url.  It only listens on this machine until farm_host is
+# set to an address other machines can reach (e.g. '0.0.0.0'), which also takes a farm_token: every machine must
+# have the same one, as anyone who can reach the coordinator could lease its jobs or report them done.
+farm_host = '127.0.0.1'
+farm_port = 9494
+farm_url = 'http://127.0.0.1:9494'
+farm_token = ''
+
+# A leased job goes back in the queue if its worker hasn't been heard from for farm_lease_secs.  Workers renew their
+# leases every farm_heartbeat_secs (keep this well under farm_lease_secs), and ask again every farm_poll_secs when
+# there's nothing to lease yet.
+farm_lease_secs = 120
+farm_heartbeat_secs = 20
+farm_poll_secs = 10
+
+# Paths in the coordinator's commands (keys) and where this machine sees them (values), when the media root isn't
+# mounted at the same path everywhere
+# Ex:   {r'C:\media': r'M:\media'}
+farm_path_map = {}
+
+
+# JOB ORDER
+# =================================
+# Order in which queued media is converted (see scheduling.py):
+# - 'fifo':             in the order it was found
+# - 'shortest_first':   quickest to convert first
+# - 'largest_first':    largest files first
+# - 'overnight':        as many titles as will fit in overnight_window_hours
+job_order = 'fifo'
+overnight_window_hours = 8
+
+# Rough time it takes to convert one minute of media, in minutes, for each preset.  Used to estimate how long a job
+# will take, when ordering jobs.  Presets not listed are estimated from their encoder and its speed setting (see
+# presets.py), and default_speed_factor is used for presets that aren't in the presets file at all.
+preset_speed_factors = {
+    presets[dvd_name]: 1.0,
+    presets[blu_name]: 4.0,
+}
+default_speed_factor = 2.0
+
+# Same, for media that is only remuxed (streams copied, not encoded)
+remux_speed_factor = 0.01
+
+# Record the speed of each finished encode, so estimates are based on how fast presets actually run on this machine
+# (the factors above are only used for presets that haven't been used yet)
+use_speed_history = True
+SPEED_HISTORY_FILE = os.path.join(DATA_DIR, 'speed_history.sqlite')
 
 # SEPARATORS
 # =================================
@@ -17,29 +17,65 @@ a poster URL, so we can download a poster as a JPG and include that in a movie d
 import os
 import re
 
-import imdb
-
+import catalogue as cg
 import media as me
 import settings as st
+import store
 import folder_hierarchy as fh
 
 
+def _fingerprint_index():
+    import fingerprint as fp
+    return fp.FingerprintIndex(st.FINGERPRINT_FILE) if st.find_duplicates else None
+
+
+def _metadata_resolver():
+    import metadata as md
+    return md.MetadataResolver()
+
+
 class SourceFiles:
     media_on_disk = []
 
+    # Files (keys) that failed to probe during the last search, and the error (values) they failed with
+    probe_errors = {}
+
+    # Media (keys) found during the last search that duplicate another source (values, see fingerprint.py)
+    duplicates = {}
+
+    # Fingerprints of sources, and the sources converted so far (see fingerprint.py), opened once they're needed
+    fingerprints = store.Lazy(_fingerprint_index)
+
     # Media (objects) to identify when walking through folders
     media_types = [
         me.Movie,
         me.Show,
     ]
 
-    # Instance IMDb package (to grab movie or TV show info)
+    # Concurrent, cached and rate limited lookups on IMDb (see metadata.py).  The resolver is only made, and the IMDb
+    # package imported, once a lookup is made, so importing this module stays quick.
     # (http://www.imdb.com)
-    ia = imdb.IMDb()
+    metadata = store.Lazy(_metadata_resolver)
 
     # Instance (folder) hierarchy, based off settings, to determine where to seek media
     folders = fh.Hierarchy()
 
+    # Whether media objects are made without probing their files (see media.ProbeField)
+    lazy = st.lazy_probe
+
+    def __init__(self, lazy=None):
+        """
+        :param lazy: (optional -> bool) if True, files found are only probed once their probe data is needed.
+        Defaults to the settings value.
+        """
+        if lazy is not None:
+            self.lazy = lazy
+
+    @property
+    def ia(self):
+        # Instance IMDb package (to grab movie or TV show info)
+        return self.metadata.ia
+
     @staticmethod
     def make_title(sentence):
         """
@@ -62,7 +98,7 @@ class SourceFiles:
 
         :return: (list) media_objects
         """
-        media_objects = []
+        found_files = []
 
         for df, df_path in self.folders.disc_paths.items():
             # Initial sub-folder (disc format) off of the "media root" folder
@@ -73,22 +109,31 @@ class SourceFiles:
             #           \Blu-Ray    <-
             #
             if os.path.exists(df_path):
-                media_objects += self._get_media_objects_from_directory(df_path, disc_format=df)
+                found_files += self._find_media_files(df_path, disc_format=df)
             else:
                 raise FileExistsError('Media directory does not exist for in directory: {}'.format(df_path))
 
-        return media_objects
+        # Cached probe results for files that have since been moved or deleted are no longer needed
+        if me.Media.probe_cache:
+            me.Media.probe_cache.evict_missing()
+        if self.fingerprints:
+            self.fingerprints.evict_missing()
+        if cg.library:
+            cg.library.evict_missing()
 
-    def _get_media_objects_from_directory(self, dir_, disc_format=''):
+        # Probe everything found in one go, rather than one disc format folder at a time
+        return self._make_media_objects(found_files)
+
+    def _find_media_files(self, dir_, disc_format=''):
         """
-        Given the dir arg, perform an os.walk operation on the path.  Return any media objects found, by their subclass,
-        if the last index exists (the last index only exists when a file is found from the walk method).
+        Given the dir arg, perform an os.walk operation on the path.  Return the files found, along with the media
+        subclass they belong to (the last index of the walk only exists when a file is found).
 
         :param dir_: (str) directory to begin search
-        :param disc_format: (optional -> str) if supplied, add disc format to class property
-        :return: found_media
+        :param disc_format: (optional -> str) disc format to associate with the files found
+        :return: (list) tuples of (media subclass, filepath, disc format)
         """
-        found_media = []
+        found_files = []
 
         for media_obj in self.media_types:
             # Look in media sub-folder, which will be underneath a disc format folder
@@ -108,16 +153,98 @@ class SourceFiles:
             for fm in os.walk(source_path):
                 for base_m in fm[-1]:
                     found_file = os.path.normpath(os.path.join(fm[0], base_m))
+                    found_files.append((media_obj, found_file, disc_format))
+
+        return found_files
 
-                    # Use associated class, for the sub-folder name (Movies -> Movie class, TV Shows -> Show class...)
-                    media = media_obj(found_file)
-                    if disc_format:
-                        # Associate the disc format, so we can use an ideal compression for the media type
-                        media.disc_format = disc_format
-                    found_media.append(media)
+    def _make_media_objects(self, found_files):
+        """
+        Build a media object for each of the found files.  Unless lazy, the files are then probed concurrently.  Files
+        that fail to probe are left out and reported, instead of stopping the whole search.  Duplicate sources are
+        reported, and left out too unless settings.duplicate_action is 'flag'.
+
+        :param found_files: (list) tuples of (media subclass, filepath, disc format), see _find_media_files
+        :return: (list) found_media
+        """
+        found_media = []
+
+        for media_obj, found_file, disc_format in found_files:
+            # Use associated class, for the sub-folder name (Movies -> Movie class, TV Shows -> Show class...)
+            media = media_obj(found_file, lazy=True)
+            if disc_format:
+                # Associate the disc format, so we can use an ideal compression for the media type
+                media.disc_format = disc_format
+            found_media.append(media)
+
+        if not self.lazy:
+            self.probe_errors = me.Media.materialize_all(found_media)
+            found_media = [m for m in found_media if m.filename not in self.probe_errors]
+            self.report_probe_errors()
+
+        if self.fingerprints:
+            import fingerprint as fp
+            # A lazy search reads no file, so only fingerprints kept from before are compared
+            self.duplicates = fp.find_duplicates(found_media, self.fingerprints, stored_only=self.lazy)
+            self.report_duplicates()
+            if st.duplicate_action == 'skip':
+                found_media = [m for m in found_media if m not in self.duplicates]
 
         return found_media
 
+    def _get_media_objects_from_directory(self, dir_, disc_format=''):
+        """
+        Given the dir arg, perform an os.walk operation on the path.  Return any media objects found, by their subclass.
+
+        :param dir_: (str) directory to begin search
+        :param disc_format: (optional -> str) if supplied, add disc format to class property
+        :return: found_media
+        """
+        return self._make_media_objects(self._find_media_files(dir_, disc_format=disc_format))
+
+    def media_from_path(self, file_):
+        """
+        Make a media object for a single file, found somewhere under one of the source folders.  The media subclass
+        and disc format are worked out from the folder the file is in.
+
+        :param file_: (str) path to the media file
+        :return: (Media or None) media object, or None if the file is not in a source folder or could not be probed
+        """
+        file_ = os.path.normpath(file_)
+        categories = {m.media_category: m for m in self.media_types}
+
+        for source_path, (df, cat) in self.folders.source_path_info().items():
+            if cat in categories and file_.startswith(os.path.join(source_path, '')):
+                found_media = self._make_media_objects([(categories[cat], file_, df)])
+                return found_media[0] if found_media else None
+        return None
+
+    def report_probe_errors(self):
+        """
+        Summary
+        ---
+        Print any files that could not be probed during the last search.
+
+        :return: None
+        """
+        if self.probe_errors:
+            print(f'>>> {len(self.probe_errors)} file(s) could not be probed, and will be skipped:')
+            for f, e in sorted(self.probe_errors.items()):
+                print(f'\t{f}\n\t\t{e}')
+
+    def report_duplicates(self):
+        """
+        Summary
+        ---
+        Print any duplicate sources found during the last search.
+
+        :return: None
+        """
+        if self.duplicates:
+            action = 'will be skipped' if st.duplicate_action == 'skip' else 'will still be converted'
+            print(f'>>> {len(self.duplicates)} file(s) duplicate another source, and {action}:')
+            for d in sorted(self.duplicates.values(), key=lambda d: d.media.filename):
+                print(f'\t{d}')
+
     def get_media_wrapper(self, *args, **kwargs):
         """
         Summary
@@ -156,6 +283,23 @@ class SourceFiles:
     def shows(self):
         return [m for m in self.media if isinstance(m, me.Show)]
 
+    def _show_imdb_record(self, media, record):
+        """
+        Given Media class arg and the record found for it on IMDb, fill in metadata found from the IMDb title.
+
+        :param media: (Media) class object
+        :param record: IMDb movie/episode (or None, if the title wasn't found)
+        :return: (Media instance)
+        """
+        # TODO: Identify movie with year.  First result is best guess, based on popularity (usually).  That
+        #  can get subjective with remakes/reboots.
+        # TODO: TV show titles can be tricky, when organized on the hard drive straight from
+        #  disc. Seems like there's not really a standard way to do it.  May have to instruct user
+        #  on how to organize shows so they are identified right.
+        if record and cg.library:
+            cg.library.add_imdb(media, record)
+        return media
+
     def _set_metadata_from_imdb(self, media):
         """
         Given Media class arg, lookup title on IMDb.  Determine if the titles given in the title can be
@@ -168,39 +312,20 @@ class SourceFiles:
         :return: (Media instance)
         """
         if media:
-            # TODO: Identify movie with year.  First result is best guess, based on popularity (usually).  That
-            #  can get subjective with remakes/reboots.
-            if isinstance(media, me.Movie):
-                title_search = self.ia.search_movie(media.title)
-                if title_search:
-                    id = title_search[0].getID()
-                    movie = self.ia.get_movie(id)
-                    # print(movie.infoset2keys)
-                    print(movie.current_info)
-                    print(movie.get('runtimes'))
-
-            # TODO: TV show titles can be tricky, when organized on the hard drive straight from
-            #  disc. Seems like there's not really a standard way to do it.  May have to instruct user
-            #  on how to organize shows so they are identified right.
-            if isinstance(media, me.Show):
-                title_search = self.ia.search_movie(media.title)
-                if title_search:
-                    id = title_search[0].getID()
-                    show = self.ia.get_episode(id)
-                    # print(show.infoset2keys)
-                    print(show.current_info)
-                    # print(show.get('runtimes'))
-
+            self._show_imdb_record(media, self.metadata.resolve(media))
         return media
 
     def lookup_all_media_on_imdb(self):
         """
         Summary
         ---
-        Go through all media in class and set all metadata.
+        Go through all media in class and set all metadata.  Lookups run concurrently and are cached (see
+        metadata.py), so only titles not looked up recently go out to IMDb.
 
         :return: None
         """
-        for m in self.media:
-            self._set_metadata_from_imdb(m)
-
+        records, errors = self.metadata.resolve_all(self.media)
+        for m, record in records.items():
+            self._show_imdb_record(m, record)
+        for m, e in errors.items():
+            print(f'>>> IMDb lookup failed for {m}:\t{e}')
@@ -0,0 +1,107 @@
+"""
+Routine Convert - encode speed history
+
+
+Summary
+-------
+How long a conversion takes depends mostly on the preset and the resolution of the source.  Every finished encode
+is recorded, so the time a job will take can be predicted from the ones before it, rather than guessed.
+
+
+Description
+--------
+SpeedHistory (SqliteStore):     wall time vs. media time (and average fps) of past encodes, by preset and resolution
+"""
+import time
+
+import store
+
+
+class SpeedHistory(store.SqliteStore):
+    schema = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            preset TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            avg_fps REAL,
+            wall_secs REAL NOT NULL,
+            media_secs REAL NOT NULL,
+            finished REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS runs_preset ON runs (preset, resolution);
+    '''
+
+    def __init__(self, path):
+        super().__init__(path)
+        # Ratios are looked up for every queued job, so they're loaded once and refreshed after each record
+        self._ratios = None
+
+    def record(self, preset, resolution, wall_secs, media_secs, avg_fps=None):
+        """
+        Summary
+        ---
+        Record a finished encode.
+
+        :param preset: (str) preset name
+        :param resolution: (str) resolution of the source (see resolution_of)
+        :param wall_secs: (float) time the encode took
+        :param media_secs: (float) duration of the media encoded
+        :param avg_fps: (optional -> float) average fps reported by HandBrakeCLI
+        :return: None
+        """
+        if media_secs <= 0:
+            return
+        self.execute('INSERT INTO runs (preset, resolution, avg_fps, wall_secs, media_secs, finished) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (preset, resolution, avg_fps, wall_secs, media_secs, time.time()))
+        self._ratios = None
+
+    def _load_ratios(self):
+        ratios = {}
+        for preset, resolution, wall, media in self.execute(
+                'SELECT preset, resolution, SUM(wall_secs), SUM(media_secs) FROM runs GROUP BY preset, resolution'):
+            ratios[(preset, resolution)] = wall / media
+        for preset, wall, media in self.execute(
+                'SELECT preset, SUM(wall_secs), SUM(media_secs) FROM runs GROUP BY preset'):
+            ratios[(preset, None)] = wall / media
+        return ratios
+
+    def ratio(self, preset, resolution=None):
+        """
+        Summary
+        ---
+        Seconds of encoding per second of media, for preset at resolution.  Falls back on every resolution
+        encoded with the preset, if that resolution hasn't been encoded with it before.
+
+        :param preset: (str) preset name
+        :param resolution: (optional -> str) resolution of the source
+        :return: (float or None) ratio, or None if the preset hasn't been used before
+        """
+        if self._ratios is None:
+            self._ratios = self._load_ratios()
+        return self._ratios.get((preset, resolution), self._ratios.get((preset, None)))
+
+    def avg_fps(self, preset, resolution=None):
+        """
+        :param preset: (str) preset name
+        :param resolution: (optional -> str) resolution of the source, or None for all resolutions
+        :return: (float or None) average fps of past encodes, or None if there are none
+        """
+        sql = 'SELECT AVG(avg_fps) FROM runs WHERE preset = ? AND avg_fps IS NOT NULL'
+        params = (preset,)
+        if resolution is not None:
+            sql += ' AND resolution = ?'
+            params += (resolution,)
+        return self.execute(sql, params)[0][0]
+
+
+def resolution_of(m) -> str:
+    """
+    Summary
+    ---
+    Resolution of the media, used to group its encodes in the history (e.g. "1080p").  If the video stream wasn't
+    probed, the disc format stands in for it (DVDs are SD, Blu-Rays are HD).
+
+    :param m: Media - media object
+    :return: (str) resolution
+    """
+    video = m.video_stream
+    return f'{video.height}p' if video and video.height else m.disc_format
@@ -0,0 +1,221 @@
+"""
+Routine Convert - file staging
+
+
+Summary
+-------
+HandBrakeCLI used to write straight into "CONVERTED", so a half-written file (from an encode still running, or one
+that died) looked just like a finished one.  And sources were moved with os.rename, which fails when "TO_CONVERT"
+and "SOURCE_PROCESSED" are on different disks.
+
+Instead, every job writes to a partial file - on a fast scratch disk, if there is one (see settings.SCRATCH_DIR) -
+which is only moved into place once the job has succeeded.  Moves are a rename when they can be (instant, and
+atomic: the file is either there whole or not at all).  Across disks, the file is copied in chunks, and the copy is
+checked against the original (size and checksum) before the original is removed.
+
+Sources on a slow disk (a NAS) can be copied ahead of time to a local disk (see settings.PREFETCH_DIR): while one job
+encodes, the source of the next one is copied, and encoded from there.
+
+
+Description
+--------
+partial_path (function):    file a job writes to, before it's moved into place
+checksum (function):        checksum of a file
+copy_file (function):       copy a file in chunks, checked against the original
+move_file (function):       move a file, by renaming it or (across disks) by a checked copy
+finish_output (function):   move the partial file of a job into place, or remove it if the job failed
+Prefetcher (object):        copies sources to a local disk ahead of their jobs
+"""
+import concurrent.futures
+import errno
+import hashlib
+import itertools
+import os
+import shutil
+import threading
+
+import settings as st
+
+
+def partial_path(output) -> str:
+    """
+    :param output: (str) file a job makes
+    :return: (str) file the job writes to until it has succeeded: in settings.SCRATCH_DIR if set, otherwise next to
+    the output (the extension is kept, since ffmpeg picks the container from it)
+    """
+    base, ext = os.path.splitext(output)
+    if st.SCRATCH_DIR:
+        os.makedirs(st.SCRATCH_DIR, exist_ok=True)
+        name = hashlib.sha1(output.encode()).hexdigest()[:16]
+        return os.path.join(st.SCRATCH_DIR, f'{name}.partial{ext}')
+    return f'{base}.partial{ext}'
+
+
+def checksum(path) -> str:
+    """
+    :param path: (str) file
+    :return: (str) checksum of the file (BLAKE2b)
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(st.staging_chunk_mb * 2 ** 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(src, dst) -> str:
+    """
+    Summary
+    ---
+    Copy src to dst in chunks, working out the checksum of src as it's read.  The copy is flushed to disk, then
+    read back and checked against src (size and checksum); a copy that doesn't match is removed.
+
+    :param src: (str) file to copy
+    :param dst: (str) where to copy it
+    :return: (str) checksum of the file (raises OSError if the copy doesn't match)
+    """
+    digest = hashlib.blake2b()
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            for chunk in iter(lambda: f_src.read(st.staging_chunk_mb * 2 ** 20), b''):
+                digest.update(chunk)
+                f_dst.write(chunk)
+            f_dst.flush()
+            os.fsync(f_dst.fileno())
+
+        if os.path.getsize(dst) != os.path.getsize(src) or checksum(dst) != digest.hexdigest():
+            raise OSError(errno.EIO, 'Copy does not match the original', dst)
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+    return digest.hexdigest()
+
+
+def move_file(src, dst):
+    """
+    Summary
+    ---
+    Move src to dst, replacing dst if it exists.  On the same disk, this is a rename.  Across disks, src is copied
+    next to dst (see copy_file) and renamed into place, and src is only removed once the copy has checked out.
+
+    :param src: (str) file to move
+    :param dst: (str) where to move it
+    :return: None (raises OSError if it could not be moved, leaving src where it is)
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    partial = f'{dst}.{os.getpid()}.{threading.get_ident()}'
+    copy_file(src, partial)
+    os.replace(partial, dst)
+    os.remove(src)
+
+
+def finish_output(output, returncode) -> int:
+    """
+    Summary
+    ---
+    Once a job is done, move the partial file it wrote (see partial_path) into place, or remove it if the job
+    failed.  A file already in place is never replaced: the partial file is left where it is.
+
+    :param output: (str) file the job makes
+    :param returncode: (int) return code of the job
+    :return: (int) return code of the job, or 1 if it succeeded but its file could not be moved into place
+    """
+    partial = partial_path(output)
+    if returncode:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return returncode
+
+    if os.path.exists(output):
+        print(f'>>> Not replacing a file already converted, the new one is left at:\t{partial}\n\t\t{output}')
+        return 1
+
+    try:
+        move_file(partial, output)
+    except OSError as e:
+        print(f'>>> Could not move the converted file into place:\t{output}\n\t\t{e}')
+        return 1
+    return 0
+
+
+class Prefetcher:
+    """
+    Summary
+    ---
+    Copy sources to a local disk ahead of their jobs, one at a time.  A job whose source hasn't finished copying by
+    the time it starts reads the original instead (it isn't held up).  Sources are only copied when there's room
+    for them, leaving settings.prefetch_min_free_gb free.
+    """
+    def __init__(self, folder=None):
+        """
+        :param folder: (optional -> str) folder to copy sources to, defaults to settings.PREFETCH_DIR
+        """
+        self.folder = folder or st.PREFETCH_DIR
+        # Copies being made or made (values, futures of their paths), by source (keys)
+        self._copies = {}
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Numbers each copy, so a source fetched again after a release never shares a path with the copy being removed
+        self._fetches = itertools.count()
+
+    def _copy_path(self, source, fetch) -> str:
+        name = hashlib.sha1(source.encode()).hexdigest()[:16]
+        return os.path.join(self.folder, f'{name}.{fetch}{os.path.splitext(source)[1]}')
+
+    def _copy(self, source, copy) -> str:
+        copy_file(source, copy)
+        return copy
+
+    def fetch(self, source):
+        """
+        :param source: (str) source of a job coming up
+        :return: None
+        """
+        with self._lock:
+            if source in self._copies:
+                return
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                room = shutil.disk_usage(self.folder).free - os.path.getsize(source)
+            except OSError:
+                return
+            if room >= st.prefetch_min_free_gb * 2 ** 30:
+                self._copies[source] = self._pool.submit(self._copy, source,
+                                                         self._copy_path(source, next(self._fetches)))
+
+    def local(self, source) -> str:
+        """
+        :param source: (str) source of a job starting now
+        :return: (str) path to its local copy, if it's ready, otherwise the source itself
+        """
+        with self._lock:
+            copy = self._copies.get(source)
+        if copy is None or not copy.done() or copy.exception():
+            return source
+        return copy.result()
+
+    def release(self, source):
+        """
+        Remove the local copy of a source, once its jobs are done (after the copy finishes, if it's still going).  A
+        source fetched again in the meantime is copied to another path, so only this copy is removed.
+
+        :param source: (str) source file
+        :return: None
+        """
+        with self._lock:
+            copy = self._copies.pop(source, None)
+        if copy is None:
+            return
+
+        def remove(done):
+            if not done.exception() and os.path.exists(done.result()):
+                os.remove(done.result())
+        copy.add_done_callback(remove)
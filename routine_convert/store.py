@@ -0,0 +1,120 @@
+"""
+Routine Convert - persistent stores
+
+
+Summary
+-------
+A few parts of routine convert need to remember things between runs (probe results, for example).  These are kept
+in small SQLite files, which ship with python, under the media root folder.
+
+Stores (and a few other things kept for a whole run, such as the progress sinks) are made the first time they're
+used, through Lazy: importing a module that keeps one costs nothing, and a run that never uses one never opens its
+file.
+
+
+Description
+--------
+SqliteStore (object):     base class for a SQLite file that is safe to share between threads
+Lazy (object):            stands in for an object that is only made once it's used
+"""
+import os
+import sqlite3
+import threading
+
+
+class SqliteStore:
+    """
+    Summary
+    ---
+    Base class for a store kept in a SQLite file.  The connection is opened the first time it's needed (so creating
+    a store costs nothing), and every statement is run under a lock so worker threads can share one store.
+    Subclasses set "schema" to the SQL that creates their tables.
+    """
+    schema = ''
+
+    def __init__(self, path):
+        """
+        :param path: (str) location of the SQLite file.  Parent folders are made if they don't exist.
+        """
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(self.schema)
+        return self._conn
+
+    def execute(self, sql, params=()):
+        """
+        Summary
+        ---
+        Run a statement and commit it.
+
+        :param sql: (str) SQL statement
+        :param params: (tuple/dict) parameters for the statement
+        :return: (list) rows returned by the statement
+        """
+        with self._lock, self.conn:
+            return self.conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, seq_of_params):
+        """
+        Summary
+        ---
+        Run a statement once for each set of parameters, in a single transaction.
+
+        :param sql: (str) SQL statement
+        :param seq_of_params: (iterable) parameters for each run of the statement
+        :return: None
+        """
+        with self._lock, self.conn:
+            self.conn.executemany(sql, seq_of_params)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class Lazy:
+    """
+    Summary
+    ---
+    Stands in for an object that is only made the first time it's used: an attribute of it is read, or it's checked
+    for (an object turned off in the settings is made as None, and the stand-in is then falsy).  It's made once, even
+    when several threads get to it at the same time, and settings are read as it's made - not as it's imported.
+    """
+    def __init__(self, make):
+        """
+        :param make: (callable) makes the object (or None), called without arguments
+        """
+        self._lazy_make = make
+        self._lazy_lock = threading.Lock()
+        self._lazy_made = False
+        self._lazy_object = None
+
+    def _lazy_get(self):
+        if not self._lazy_made:
+            with self._lazy_lock:
+                if not self._lazy_made:
+                    self._lazy_object = self._lazy_make()
+                    self._lazy_made = True
+        return self._lazy_object
+
+    def __getattr__(self, name):
+        # Only called for attributes the stand-in doesn't have itself
+        if name.startswith('_lazy_'):
+            raise AttributeError(name)
+        return getattr(self._lazy_get(), name)
+
+    def __bool__(self):
+        return bool(self._lazy_get())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._lazy_object!r})' if self._lazy_made else \
+            f'{self.__class__.__name__}(not made yet)'
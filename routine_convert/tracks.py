@@ -0,0 +1,143 @@
+"""
+Routine Convert - audio and subtitle track selection
+
+
+Summary
+-------
+Discs come with plenty of audio and subtitle tracks: dubs, commentaries, subtitles in a dozen languages.  Left to the
+preset, HandBrakeCLI picks tracks by its own rules and re-encodes the audio it keeps.  Instead, using the probed
+streams of each file, only tracks in the languages we want are kept (commentaries are dropped), and audio already in
+a codec the preset can pass through (its "AudioCopyMask") is copied rather than encoded again.  Forced subtitles are
+always kept, and the preset's foreign audio scan and burned in subtitles still apply.
+
+
+Description
+--------
+TrackSelection (object):    audio tracks (with the encoder for each) and subtitle tracks to keep
+copy_encoder (function):    HandBrakeCLI passthrough encoder for an audio stream, if there is one
+is_commentary (function):   whether a stream is a commentary track
+select_tracks (function):   tracks to keep from a media file
+"""
+import preset_rules as pr
+import presets as ps
+import settings as st
+
+
+# ffprobe codec names (keys) and the HandBrakeCLI passthrough encoders for them (values)
+_COPY_ENCODERS = {
+    'aac': 'copy:aac',
+    'ac3': 'copy:ac3',
+    'eac3': 'copy:eac3',
+    'truehd': 'copy:truehd',
+    'dts': 'copy:dts',
+    'mp3': 'copy:mp3',
+    'mp2': 'copy:mp2',
+    'flac': 'copy:flac',
+    'opus': 'copy:opus',
+}
+
+# Languages of streams that aren't tagged with one
+_UNTAGGED = ('', 'und')
+
+
+class TrackSelection:
+    """
+    Summary
+    ---
+    Tracks of a media file to keep: audio tracks with the encoder for each, and subtitle tracks (after a foreign audio
+    scan track, if the preset adds one), and which of them is burned in.
+    """
+    __slots__ = ('audio', 'subtitles', 'scan', 'burn')
+
+    def __init__(self, audio, subtitles, scan=False, burn='none'):
+        """
+        :param audio: (list) tuples of (Stream, encoder)
+        :param subtitles: (list) Stream records
+        :param scan: (optional -> bool) whether to add a foreign audio scan track first (see Preset.subtitle_scan)
+        :param burn: (optional -> str) subtitle track to burn in, as the preset's "SubtitleBurnBehavior"
+        """
+        self.audio = audio
+        self.subtitles = subtitles
+        self.scan = scan
+        self.burn = burn
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(audio={self.audio}, subtitles={self.subtitles}, scan={self.scan}, ' \
+               f'burn={self.burn})'
+
+    def cli_args(self) -> str:
+        """
+        :return: (str) HandBrakeCLI arguments selecting the tracks
+        """
+        if self.audio:
+            args = '--audio ' + ','.join(str(s.number) for s, _ in self.audio) \
+                   + ' --aencoder ' + ','.join(e for _, e in self.audio)
+        else:
+            args = '--audio none'
+        subtitles = (['scan'] if self.scan else []) + [str(s.number) for s in self.subtitles]
+        args += f' --subtitle {",".join(subtitles) or "none"}'
+        if self.scan:
+            # Only the forced subtitles the scan finds are shown
+            args += ' --subtitle-forced=1'
+        if subtitles and (self.burn in ('first', 'foreign_first') or (self.burn == 'foreign' and self.scan)):
+            args += ' --subtitle-burned=1'
+        return args
+
+
+def copy_encoder(stream, copy_mask):
+    """
+    :param stream: (Stream) audio stream
+    :param copy_mask: (list) passthrough encoders the preset allows (its "AudioCopyMask")
+    :return: (str or None) passthrough encoder for the stream, or None if it has to be encoded
+    """
+    encoder = _COPY_ENCODERS.get(stream.codec_name)
+    if encoder == 'copy:dts' and 'HD' in stream.profile:
+        encoder = 'copy:dtshd'
+    return encoder if encoder in copy_mask else None
+
+
+def is_commentary(stream) -> bool:
+    """
+    :param stream: (Stream) audio or subtitle stream
+    :return: (bool) whether it's a commentary track (flagged as one, or named as one)
+    """
+    return stream.comment or 'commentary' in stream.title.lower()
+
+
+def _keep(streams, languages):
+    """
+    :param streams: (list) streams of one type
+    :param languages: (list) languages to keep (keep every language if empty)
+    :return: (list) streams in the languages wanted (or untagged), commentaries left out if set to be dropped.  Forced
+    streams are always kept.
+    """
+    return [s for s in streams
+            if s.forced or ((not languages or s.language in languages or s.language in _UNTAGGED)
+                            and not (st.drop_commentary and is_commentary(s)))]
+
+
+def select_tracks(m, preset=None):
+    """
+    Summary
+    ---
+    Pick the audio and subtitle tracks of m to keep (see settings.audio_languages, settings.subtitle_languages).
+    At least one audio track is always kept: if none are in a wanted language, the first one is.  Audio is passed
+    through when its codec is in the preset's AudioCopyMask, otherwise encoded with the preset's audio encoder.
+    Forced subtitles are kept whatever their language, and the preset's foreign audio scan and burn in still apply.
+
+    :param m: (Media) media object
+    :param preset: (optional -> str) preset name, defaults to the preset of the media (see preset_rules.preset_of)
+    :return: (TrackSelection or None) tracks to keep, or None if the file has no probed streams
+    """
+    if not m.streams:
+        return None
+
+    settings = ps.find_preset(preset or pr.preset_of(m))
+    copy_mask = settings.audio_copy_mask if settings else []
+    encoder = settings.audio_encoder if settings else 'av_aac'
+    scan, burn = (settings.subtitle_scan, settings.subtitle_burn) if settings else (False, 'none')
+
+    audio_streams = m.streams_of_type('audio')
+    audio = _keep(audio_streams, st.audio_languages) or audio_streams[:1]
+    subtitles = _keep(m.streams_of_type('subtitle'), st.subtitle_languages)
+    return TrackSelection([(s, copy_encoder(s, copy_mask) or encoder) for s in audio], subtitles, scan, burn)
@@ -0,0 +1,302 @@
+"""
+Routine Convert - watch for new media
+
+
+Summary
+-------
+Rather than waiting for the next scheduled run (and walking every "TO_CONVERT" folder again), routine convert can
+keep running and watch the source folders.  As soon as a new rip has finished being written, it's queued and
+converted.  On Linux, inotify tells us when files change; everywhere else, the source folders are polled.  A file
+whose conversion fails, raises an error or that can't be probed is queued again, after the journal's backoff (up to
+settings.job_max_attempts times, see journal.py).
+
+
+Description
+--------
+Inotify (object):           small wrapper around the Linux inotify API (through ctypes)
+SourceWatcher (object):     watches the source folders and hands over files once they stop growing
+"""
+import concurrent.futures
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import threading
+import time
+import traceback
+
+import convert_to as ct
+import folder_hierarchy as fh
+import settings as st
+import source as sc
+
+
+class Inotify:
+    """
+    Summary
+    ---
+    Watch folders for files being written, moved in or created, using the Linux inotify API.  Raises OSError if
+    inotify isn't available on this system.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_MODIFY = 0x00000002
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+
+    # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('inotify is not available on this system')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this system')
+
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        # Watch descriptors (keys) and the folder they watch (values)
+        self.paths = {}
+
+    def add_watch(self, path):
+        """
+        Watch path, and every folder underneath it.
+
+        :param path: (str) folder to watch
+        :return: None
+        """
+        for root, _, _ in os.walk(path):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(root), self.watch_mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'Could not watch folder: {root}')
+            self.paths[wd] = root
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for changes.  New folders are watched as they appear.
+
+        :param timeout: (float) seconds to wait
+        :return: (set) files that changed
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if wd not in self.paths or not name:
+                continue
+            path = os.path.join(self.paths[wd], name)
+            if mask & self.IN_ISDIR:
+                self.add_watch(path)
+                # Files may have landed in the folder before it was watched
+                changed.update(os.path.join(r, f) for r, _, files in os.walk(path) for f in files)
+            else:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SourceWatcher:
+    """
+    Summary
+    ---
+    Watch the source folders (see folder_hierarchy.Hierarchy.source_paths) for new files.  A file is handed to
+    on_ready once its size and modified time have stopped changing for "settle" seconds.
+    """
+    def __init__(self, on_ready, settle=None, poll_interval=None):
+        """
+        :param on_ready: (callable) called with the path of each file that is ready to be converted
+        :param settle: (optional -> float) seconds a file must stay unchanged, defaults to the settings value
+        :param poll_interval: (optional -> float) seconds between checks, defaults to the settings value
+        """
+        self.on_ready = on_ready
+        self.settle = st.watch_settle_secs if settle is None else settle
+        self.poll_interval = poll_interval or st.watch_poll_secs
+        self.paths = [p for p in fh.Hierarchy().source_paths() if os.path.exists(p)]
+
+        # Files waiting to settle (keys), with their last (size, mtime) and when that was first seen (values)
+        self.pending = {}
+        # Files already handed over, so they aren't queued twice
+        self.queued = set()
+        # Files handed back to be queued again (see requeue)
+        self._requeued = queue.SimpleQueue()
+
+        try:
+            self.inotify = Inotify()
+            for p in self.paths:
+                self.inotify.add_watch(p)
+        except OSError:
+            self.inotify = None
+
+    def requeue(self, path):
+        """
+        Hand a file back, to be handed over again once it has settled.  Safe to call from any thread.
+
+        :param path: (str) file handed over before
+        :return: None
+        """
+        self._requeued.put(path)
+
+    def _scan(self):
+        """
+        Return every file in the source folders.  Only used at start up, and when polling (no inotify).
+
+        :return: (set) files found
+        """
+        return {os.path.join(r, f) for p in self.paths for r, _, files in os.walk(p) for f in files}
+
+    def _changed_files(self):
+        if self.inotify:
+            return self.inotify.read(self.poll_interval)
+        time.sleep(self.poll_interval)
+        return self._scan() - self.queued
+
+    def _settle(self, now):
+        """
+        Hand over files whose size and modified time haven't changed for long enough.
+
+        :param now: (float) current time (time.monotonic)
+        :return: None
+        """
+        for path, (stat_key, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Moved away or deleted before it settled
+                del self.pending[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime_ns) != stat_key:
+                self.pending[path] = ((stat.st_size, stat.st_mtime_ns), now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                self.queued.add(path)
+                self.on_ready(path)
+
+    def run(self):
+        """
+        Summary
+        ---
+        Watch forever (until interrupted).  Files already waiting when the watcher starts are picked up too.
+
+        :return: None
+        """
+        changed = self._scan()
+        try:
+            while True:
+                now = time.monotonic()
+                while not self._requeued.empty():
+                    path = self._requeued.get_nowait()
+                    self.queued.discard(path)
+                    changed.add(path)
+                for path in changed - self.queued:
+                    if path not in self.pending:
+                        self.pending[path] = ((None, None), now)
+                self._settle(now)
+                changed = self._changed_files()
+        finally:
+            if self.inotify:
+                self.inotify.close()
+
+
+if __name__ == "__main__":
+    # For running this as a script in CLI, to convert media as soon as it lands in a source folder
+    hb = ct.Handbrake()
+    if not hb.check_presets():
+        raise SystemExit(1)
+    if hb.journal:
+        for source in hb.journal.recover():
+            print(f'>>> Resuming interrupted job:\t{source}')
+    sources = sc.SourceFiles()
+    workers = max(1, st.encode_workers)
+    threads = hb.get_threads_per_job(workers) if workers > 1 else 0
+    hb.workers = workers
+    # Files (keys) that failed without the journal counting it (they raised an error or couldn't be probed, or there's
+    # no journal), and how many times (values)
+    errors = {}
+
+    def retry_at(path, returncode, raised):
+        """
+        :param path: (str) file that failed, or wasn't due (returncode None, see Handbrake.encode_media)
+        :param returncode: (int or None) return code of its conversion
+        :param raised: (bool) whether it failed by raising an error (or couldn't be probed)
+        :return: (float or None) when to try it again, with the journal's backoff, or None to give up
+        """
+        if hb.journal:
+            source = os.path.normpath(path)
+            state = hb.journal.state(source)
+            if raised and state and state[0] == hb.journal.RUNNING:
+                # Raised partway through, leaving the job running
+                hb.journal.finish(source, returncode)
+                state = hb.journal.state(source)
+            if not raised or (state and state[0] == hb.journal.FAILED):
+                return hb.journal.retry_at(source)
+        errors[path] = errors.get(path, 0) + 1
+        if errors[path] >= st.job_max_attempts:
+            return None
+        return time.time() + st.job_retry_backoff_secs * 2 ** (errors[path] - 1)
+
+    def retry(path, returncode=-1, raised=True):
+        at = retry_at(path, returncode, raised)
+        if at is None:
+            print(f'>>> Giving up, left where it is:\t{path}')
+            return
+        print(f'>>> Queued again, for {time.strftime("%H:%M", time.localtime(at))}:\t{path}')
+        timer = threading.Timer(max(0.0, at - time.time()), watcher.requeue, (path,))
+        timer.daemon = True
+        timer.start()
+
+    def encoded(path, future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            print(f'>>> Could not convert:\t{path}\n'
+                  + ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+            retry(path)
+        elif future.result() == 0:
+            errors.pop(path, None)
+        else:
+            # Failed (the failure is printed as the job finishes), or not due yet
+            retry(path, future.result(), raised=False)
+
+    hb.progress.open(workers)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            def queue_file(path):
+                m = sources.media_from_path(path)
+                if m:
+                    print(f'>>> Queued:\t{m.filename}')
+                    pool.submit(hb.encode_media, m, threads).add_done_callback(
+                        lambda future, path=path: encoded(path, future))
+                elif os.path.normpath(path) in sources.probe_errors:
+                    # Reported as it was probed; it may not be a whole rip yet
+                    retry(path)
+
+            watcher = SourceWatcher(queue_file)
+            watcher.run()
+    finally:
+        hb.progress.close()
@@ -0,0 +1,55 @@
+"""
+Tests run against a sandbox (see benchmark.use_sandbox): a made-up media root, fake executables and every file
+routine convert keeps between runs, in a temporary folder.  It's set up before any other module of routine convert
+is imported, so no file is ever opened outside it.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'routine_convert'))
+
+import benchmark  # noqa: E402
+
+SANDBOX = tempfile.mkdtemp(prefix='routine_convert_tests_')
+benchmark.use_sandbox(SANDBOX, files=0)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(SANDBOX, ignore_errors=True)
+
+
+def probe_dict(duration=5400.0, height=1080, size=2 ** 30, chapters=None, **tags):
+    """
+    :return: (dict) probe result of a file (as media.Media takes it), with a single video stream
+    """
+    probe = {
+        'duration': str(duration),
+        'size': str(size),
+        'bit_rate': str(int(size * 8 / duration)),
+        'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'width': height * 16 // 9,
+                     'height': height, 'pix_fmt': 'yuv420p', 'avg_frame_rate': '24000/1001'}],
+        **tags,
+    }
+    if chapters is not None:
+        probe['chapters'] = chapters
+    return probe
+
+
+@pytest.fixture
+def make_media(tmp_path):
+    """
+    :return: (callable) makes a source file under tmp_path (its content is its path, unless given) and a media
+    object for it, probed with probe_dict
+    """
+    import media as me
+
+    def make(relpath, cls=me.Movie, content=None, **probe):
+        path = tmp_path / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content if content is not None else str(path).encode())
+        return cls(str(path), probe_dict=probe_dict(**probe))
+    return make
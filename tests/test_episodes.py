@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import episodes as ep
+import media as me
+import staging as stg
+
+# Two episodes, as EpisodeIndex.episodes finds them: first and last chapter, start and end
+TWO_EPISODES = [(1, 4, 0.0, 1320.0), (5, 8, 1320.0, 2640.0)]
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    index = ep.EpisodeIndex(str(tmp_path / 'episodes.sqlite'))
+    monkeypatch.setattr(index, 'episodes', lambda file_: TWO_EPISODES)
+    monkeypatch.setattr(ep, 'index', index)
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def plan(tmp_path, index):
+    output_dir = tmp_path / 'CONVERTED'
+    output_dir.mkdir()
+
+    def plan(*shows):
+        plans = ep.plan_episodes(shows, lambda show: str(output_dir))
+        return {os.path.basename(show.filename): [os.path.basename(e.output) for e in episodes]
+                for show, episodes in plans.items()}
+    return plan
+
+
+@pytest.mark.parametrize('filename', ['Friends Season 2 Disc 1.mkv', 'Friends S02D1_t00.mkv',
+                                      'friends_season_2_disc_2.mkv', 'Friends.S02.D3.mkv'])
+def test_series_title_from_filename(make_media, filename):
+    assert ep.series_title(make_media(filename, cls=me.Show)) == 'Friends'
+
+
+def test_numbered_across_discs(make_media, plan):
+    assert plan(make_media('Friends S02D2.mkv', cls=me.Show), make_media('Friends S02D1.mkv', cls=me.Show)) == {
+        'Friends S02D1.mkv': ['Friends_s02e01.mkv', 'Friends_s02e02.mkv'],
+        'Friends S02D2.mkv': ['Friends_s02e03.mkv', 'Friends_s02e04.mkv'],
+    }
+
+
+def test_numbered_on_from_earlier_runs(make_media, plan):
+    first = make_media('Friends Season 2 Disc 1.mkv', cls=me.Show)
+    assert plan(first)['Friends Season 2 Disc 1.mkv'] == ['Friends_s02e01.mkv', 'Friends_s02e02.mkv']
+    # The same disc keeps its numbers, a later disc carries on from them, another season starts again
+    assert plan(first)['Friends Season 2 Disc 1.mkv'] == ['Friends_s02e01.mkv', 'Friends_s02e02.mkv']
+    assert plan(make_media('Friends Season 2 Disc 2.mkv', cls=me.Show)) == {
+        'Friends Season 2 Disc 2.mkv': ['Friends_s02e03.mkv', 'Friends_s02e04.mkv']}
+    assert plan(make_media('Friends Season 3 Disc 1.mkv', cls=me.Show)) == {
+        'Friends Season 3 Disc 1.mkv': ['Friends_s03e01.mkv', 'Friends_s03e02.mkv']}
+
+
+def test_single_episode_named_as_one(make_media, plan, index, monkeypatch):
+    monkeypatch.setattr(index, 'episodes', lambda file_: [] if 'D2' in file_ else TWO_EPISODES)
+    assert plan(*(make_media(f'Friends S02D{d}.mkv', cls=me.Show) for d in (1, 2, 3))) == {
+        'Friends S02D1.mkv': ['Friends_s02e01.mkv', 'Friends_s02e02.mkv'],
+        'Friends S02D2.mkv': ['Friends_s02e03.mkv'],
+        'Friends S02D3.mkv': ['Friends_s02e04.mkv', 'Friends_s02e05.mkv'],
+    }
+
+
+def test_numbered_on_from_outputs(make_media, plan, tmp_path):
+    (tmp_path / 'CONVERTED' / 'Friends_s02e05.mkv').write_bytes(b'episode')
+    assert plan(make_media('Friends S02D3.mkv', cls=me.Show)) == {
+        'Friends S02D3.mkv': ['Friends_s02e06.mkv', 'Friends_s02e07.mkv']}
+
+
+def test_outputs_never_replaced(make_media, plan, tmp_path):
+    show = make_media('Friends S02D1.mkv', cls=me.Show)
+    plan(show)
+    converted = tmp_path / 'CONVERTED' / 'Friends_s02e01.mkv'
+    converted.write_bytes(b'episode')
+
+    # An episode converted before a retry is left out
+    assert plan(show) == {'Friends S02D1.mkv': ['Friends_s02e02.mkv']}
+
+    partial = stg.partial_path(str(converted))
+    with open(partial, 'wb') as f:
+        f.write(b'another episode')
+    assert stg.finish_output(str(converted), 0) == 1
+    assert converted.read_bytes() == b'episode'
+    assert os.path.exists(partial)
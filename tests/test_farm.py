@@ -0,0 +1,162 @@
+import threading
+
+import pytest
+
+import convert_to as ct
+import decisions as dc
+import episodes as ep
+import farm
+import media as me
+import progress as pg
+import settings as st
+
+
+class FakeHandbrake:
+    """
+    What the coordinator needs of convert_to.Handbrake, with remux jobs (no presets to import) and the results it's
+    told of kept in "finished"
+    """
+    journal = None
+    part_done = staticmethod(ct.Handbrake.part_done)
+
+    def __init__(self, media):
+        self.progress = pg.ProgressSink()
+        self.decisions = {m: dc.Decision(dc.REMUX, 'test') for m in media}
+        self._clr_str_dict = {m: f'"ffmpeg" -i "{m.filename}"' for m in media}
+        self.finished = []
+
+    def get_output_file(self, m):
+        return m.filename + '.out'
+
+    def make_cli_str(self, m, output=None, extra_args=''):
+        return f'"ffmpeg" -i "{m.filename}" {extra_args} "{output}"'
+
+    @staticmethod
+    def split_media(m, episodes, workers):
+        return episodes.get(m)
+
+    @staticmethod
+    def join_parts(m, parts, returncode):
+        return returncode
+
+    def _finish(self, m, returncode):
+        self.finished.append((m, returncode))
+
+
+@pytest.fixture
+def coordinator(make_media):
+    def coordinator(*names):
+        media = [make_media(name) for name in names]
+        coordinator = farm.Coordinator(handbrake=FakeHandbrake(media), address=('127.0.0.1', 0))
+        coordinator.queue = list(media)
+        return coordinator
+    return coordinator
+
+
+def expire(coordinator):
+    for lease in coordinator.leases.values():
+        lease.expires = 0
+
+
+@pytest.mark.parametrize('host, token, listens', [('0.0.0.0', '', False), ('0.0.0.0', 'secret', True),
+                                                   ('127.0.0.1', '', True)])
+def test_listens_elsewhere_only_with_a_token(coordinator, monkeypatch, host, token, listens):
+    coordinator = coordinator()
+    coordinator.address = (host, 0)
+    monkeypatch.setattr(st, 'farm_token', token)
+    # Planning starts with checking the presets, once the coordinator has decided to listen
+    checked = []
+    coordinator.handbrake.check_presets = lambda: checked.append(True)
+    coordinator.run()
+    assert bool(checked) == listens
+
+
+def test_job_says_what_it_does(coordinator):
+    job = coordinator('movie.mkv').lease('a')
+    assert job['action'] == dc.REMUX
+    assert 'preset' not in job
+
+
+def test_expired_lease_is_leased_again(coordinator):
+    coordinator = coordinator('movie.mkv')
+    first = coordinator.lease('a')
+    assert coordinator.lease('b') == {'done': False}
+
+    expire(coordinator)
+    second = coordinator.lease('b')
+    assert second['job_id'] == first['job_id']
+
+    # The first worker's lease was taken back: its heartbeat and result are turned down
+    assert coordinator.heartbeat('a', first['lease']) == {'renewed': False}
+    assert coordinator.finish('a', first['lease'], 0) == {'confirmed': False}
+    assert not coordinator.handbrake.finished
+
+    assert coordinator.heartbeat('b', second['lease']) == {'renewed': True}
+    assert coordinator.finish('b', second['lease'], 0) == {'confirmed': True}
+    assert [returncode for _, returncode in coordinator.handbrake.finished] == [0]
+    assert coordinator.finished
+    assert coordinator.lease('b') == {'done': True}
+
+
+def test_expired_lease_is_no_attempt(coordinator):
+    coordinator = coordinator('movie.mkv')
+    started = []
+    coordinator.handbrake.journal = type('Journal', (), {'start': lambda self, source: started.append(source),
+                                                         'retry_at': lambda self, source: 0.0})()
+    coordinator.lease('a')
+    expire(coordinator)
+    second = coordinator.lease('b')
+    assert len(started) == 1
+
+    # A failure the worker reports is, and the retry starts the job again
+    assert coordinator.finish('b', second['lease'], 1) == {'confirmed': True}
+    coordinator.lease('c')
+    assert len(started) == 2
+
+
+def test_finish_holds_up_no_lease(coordinator):
+    coordinator = coordinator('movie.mkv', 'other.mkv')
+    first, second = coordinator.lease('a'), coordinator.lease('b')
+
+    moving, moved = threading.Event(), threading.Event()
+
+    def _finish(m, returncode):
+        if not returncode:
+            moving.set()
+            moved.wait(5)
+    coordinator.handbrake._finish = _finish
+    finishing = threading.Thread(target=coordinator.finish, args=('a', first['lease'], 0))
+    finishing.start()
+    assert moving.wait(5)
+
+    # While the first result's source is moved, other workers are still answered, and the run isn't over
+    try:
+        assert coordinator.heartbeat('b', second['lease']) == {'renewed': True}
+        assert coordinator.finish('b', second['lease'], 1) == {'confirmed': True}
+        assert not coordinator.finished
+        assert coordinator.lease('c') == {'done': False}
+    finally:
+        moved.set()
+        finishing.join()
+    assert coordinator.finished
+
+
+def test_episodes_finish_with_their_last(coordinator, make_media, monkeypatch):
+    show = make_media('Friends S01D1.mkv', cls=me.Show)
+    coordinator = coordinator()
+    coordinator.handbrake = FakeHandbrake([show])
+    coordinator.handbrake.decisions[show] = dc.Decision(dc.ENCODE, 'test')
+    coordinator.episodes = {show: [ep.Episode(show, i, 2, i * 60.0, 60.0, f'{show.filename}.{i}', 1, 1, 1, i + 1)
+                                   for i in range(2)]}
+    coordinator.queue = [show]
+    monkeypatch.setattr(coordinator, '_job', lambda lease: {'lease': lease.token, 'job_id': lease.job_id})
+    monkeypatch.setattr(farm.sch, 'history', None)
+
+    first, second = coordinator.lease('a'), coordinator.lease('b')
+    assert coordinator.finish('a', first['lease'], 0) == {'confirmed': True}
+    assert not coordinator.handbrake.finished
+    expire(coordinator)
+    second_again = coordinator.lease('c')
+    assert second_again['job_id'] == second['job_id']
+    assert coordinator.finish('c', second_again['lease'], 0) == {'confirmed': True}
+    assert coordinator.handbrake.finished == [(show, 0)]
@@ -0,0 +1,112 @@
+import mmap
+import shutil
+
+import pytest
+
+import fingerprint as fp
+import media as me
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = fp.FingerprintIndex(str(tmp_path / 'fingerprints.sqlite'))
+    yield index
+    index.close()
+
+
+def test_fingerprint_samples_large_files(tmp_path, monkeypatch):
+    path = tmp_path / 'big.mkv'
+    with open(path, 'wb') as f:
+        f.truncate(64 * 2 ** 20)
+    sampled = fp.fingerprint(str(path))
+
+    # A byte between the sampled blocks doesn't change it, one in a sampled block (the first) does
+    with open(path, 'r+b') as f:
+        f.seek(2 ** 20 + 100)
+        f.write(b'x')
+    assert fp.fingerprint(str(path)) == sampled
+    with open(path, 'r+b') as f:
+        f.write(b'x')
+    changed = fp.fingerprint(str(path))
+    assert changed != sampled
+
+    # Read without mmap, the same blocks give the same fingerprint
+    def no_mmap(*args, **kwargs):
+        raise OSError('mmap not supported')
+    monkeypatch.setattr(mmap, 'mmap', no_mmap)
+    assert fp.fingerprint(str(path)) == changed
+
+
+def test_fingerprint_includes_size(tmp_path):
+    small, padded = tmp_path / 'a.mkv', tmp_path / 'b.mkv'
+    small.write_bytes(b'\0' * 100)
+    padded.write_bytes(b'\0' * 101)
+    assert fp.fingerprint(str(small)) != fp.fingerprint(str(padded))
+
+
+def test_copy_is_a_duplicate(make_media, index):
+    original = make_media('DVD/Movies/TO_CONVERT/Film.mkv', content=b'film')
+    copy = make_media('DVD/Movies/TO_CONVERT/Film (copy).mkv', content=b'film')
+
+    duplicates = fp.find_duplicates([original, copy], index)
+    assert list(duplicates) == [copy]
+    assert duplicates[copy].reason == fp.Duplicate.SAME_FILE
+    assert duplicates[copy].original == original.filename
+
+
+def test_same_title_keeps_the_larger_video(make_media, index):
+    dvd = make_media('DVD/Movies/TO_CONVERT/Film.mkv', height=480, duration=5400)
+    blu_ray = make_media('Blu-Ray/Movies/TO_CONVERT/Film.mkv', height=1080, duration=5410)
+
+    duplicates = fp.find_duplicates([dvd, blu_ray], index)
+    assert list(duplicates) == [dvd]
+    assert duplicates[dvd].reason == fp.Duplicate.SAME_TITLE
+    assert duplicates[dvd].original == blu_ray.filename
+
+
+def test_different_lengths_are_different_titles(make_media, index):
+    theatrical = make_media('DVD/Movies/TO_CONVERT/Film.mkv', duration=5400)
+    extended = make_media('Blu-Ray/Movies/TO_CONVERT/Film.mkv', duration=6000)
+    assert fp.find_duplicates([theatrical, extended], index) == {}
+
+
+@pytest.mark.parametrize('cls', [me.Show, me.Movie])
+def test_titles_of_one_disc_are_not_duplicates(make_media, index, cls):
+    # MakeMKV names the titles of a disc "<disc>_t00", "<disc>_t01"...: episodes of about the same length
+    titles = [make_media(f'DVD/TV Shows/TO_CONVERT/My Show S01D1_t0{i}.mkv', cls=cls, duration=1320 + i)
+              for i in range(3)]
+    assert fp.find_duplicates(titles, index) == {}
+
+    for m in titles[:2]:
+        index.add_converted(m, m.filename + '.out')
+    assert fp.find_duplicates(titles[2:], index) == {}
+
+
+def test_converted_sources_are_duplicates(make_media, index, tmp_path):
+    film = make_media('DVD/Movies/TO_CONVERT/Film.mkv', height=480)
+    index.add_converted(film, str(tmp_path / 'Film.out.mkv'))
+    processed = tmp_path / 'Film.processed.mkv'
+    shutil.move(film.filename, processed)
+
+    again = make_media('DVD/Movies/TO_CONVERT/Film again.mkv', content=processed.read_bytes(), height=480)
+    rerip = make_media('DVD/Movies/TO_CONVERT/Other Rip/Film.mkv', height=480)
+    upgrade = make_media('Blu-Ray/Movies/TO_CONVERT/Film.mkv', height=1080)
+
+    duplicates = fp.find_duplicates([again, rerip], index)
+    assert duplicates[again].reason == fp.Duplicate.SAME_FILE and duplicates[again].converted
+    assert duplicates[rerip].reason == fp.Duplicate.SAME_TITLE and duplicates[rerip].converted
+    # A larger video of a title converted before is worth converting again
+    assert fp.find_duplicates([upgrade], index) == {}
+
+
+def test_stored_only_reads_no_file(make_media, index, monkeypatch):
+    original = make_media('DVD/Movies/TO_CONVERT/Film.mkv', content=b'film')
+    copy = make_media('DVD/Movies/TO_CONVERT/Film (copy).mkv', content=b'film')
+    new = make_media('DVD/Movies/TO_CONVERT/Film (another copy).mkv', content=b'film')
+    fp.find_duplicates([original, copy], index)
+
+    def read(path):
+        raise AssertionError(f'{path} read')
+    monkeypatch.setattr(fp, 'fingerprint', read)
+    # Only the files fingerprinted before are compared
+    assert list(fp.find_duplicates([original, copy, new], index, stored_only=True)) == [copy]
@@ -0,0 +1,100 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import journal as jn
+import settings as st
+
+CLI_STR = '"HandBrakeCLI" -i "source.mkv"'
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = jn.JobJournal(str(tmp_path / 'journal.sqlite'), max_attempts=2, backoff_secs=60)
+    yield journal
+    journal.close()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source.mkv'
+    path.write_bytes(b'source')
+    return str(path)
+
+
+def fail(journal, source, times=1):
+    for _ in range(times):
+        journal.start(source)
+        journal.finish(source, 1)
+
+
+def test_interrupted_job_recovered(journal, source):
+    journal.enqueue(source, CLI_STR)
+    journal.start(source)
+    # Still running, and heard from
+    assert journal.recover() == []
+    assert not journal.is_ready(source)
+
+    # Not heard from since
+    assert journal.recover(now=time.time() + st.job_stale_secs + 1) == [source]
+    assert journal.state(source)[0] == journal.QUEUED
+    assert journal.recover() == []
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='processes are not looked up on Windows')
+def test_job_of_ended_process_recovered(journal, source):
+    journal.enqueue(source, CLI_STR)
+    journal.start(source)
+    ended = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+    journal.execute('UPDATE jobs SET owner = ?', (f'{socket.gethostname()}:{ended.stdout.strip()}',))
+    assert journal.recover() == [source]
+
+
+def test_failed_job_retried_with_backoff(journal, source):
+    journal.enqueue(source, CLI_STR)
+    fail(journal, source)
+    retry_at = journal.retry_at(source)
+    assert not journal.is_ready(source)
+    assert journal.is_ready(source, now=retry_at)
+
+    fail(journal, source)
+    # Out of attempts, even once enqueued again on the next run
+    journal.enqueue(source, CLI_STR)
+    assert journal.retry_at(source) is None
+    assert not journal.is_ready(source, now=retry_at + 3600)
+
+
+def test_failed_job_reset_when_source_changes(journal, source):
+    journal.enqueue(source, CLI_STR)
+    fail(journal, source, times=2)
+
+    # Ripped again
+    with open(source, 'ab') as f:
+        f.write(b' again')
+    journal.enqueue(source, CLI_STR)
+    assert journal.state(source)[:2] == (journal.QUEUED, 0)
+
+
+def test_failed_job_reset_when_command_changes(journal, source):
+    journal.enqueue(source, CLI_STR)
+    fail(journal, source, times=2)
+    journal.enqueue(source, CLI_STR + ' --encoder-preset slow')
+    assert journal.is_ready(source)
+
+
+def test_retry_failed_jobs(journal, source, tmp_path):
+    other = str(tmp_path / 'other.mkv')
+    for s in (source, other):
+        journal.enqueue(s, CLI_STR)
+        fail(journal, s, times=2)
+    assert {s for s, *_ in journal.failed()} == {source, other}
+
+    assert journal.retry([other, os.path.join(str(tmp_path), 'missing.mkv')]) == 1
+    assert journal.is_ready(other)
+    assert not journal.is_ready(source)
+    assert journal.retry() == 1
+    assert journal.failed() == []
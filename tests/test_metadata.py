@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+import media as me
+import metadata as md
+
+
+class FakeRecord(dict):
+    """
+    Stands in for imdb.Movie: read with get(field) and getID()
+    """
+    def __init__(self, id_, **fields):
+        super().__init__(fields)
+        self.id_ = id_
+
+    def getID(self):
+        return self.id_
+
+
+class FakeIMDb:
+    """
+    Stands in for imdb.IMDb: finds every title but "Missing", and counts the requests made
+    """
+    def __init__(self):
+        self.requests = []
+
+    def search_movie(self, title):
+        self.requests.append(('search_movie', title))
+        return [] if title == 'Missing' else [FakeRecord('0057012', title='Dr. Strangelove', year=1964)]
+
+    def get_movie(self, id_):
+        self.requests.append(('get_movie', id_))
+        return FakeRecord(id_, kind='movie', title='Dr. Strangelove', year=1964, runtimes=['95'], plot=['...'])
+
+    def get_episode(self, id_):
+        self.requests.append(('get_episode', id_))
+        return FakeRecord(id_, kind='episode', title='The Pilot', season=1, episode=1,
+                          **{'episode of': FakeRecord('0108778', title='Friends')})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = md.ImdbCache(str(tmp_path / 'imdb_cache.sqlite'))
+    yield cache
+    cache.close()
+
+
+def resolver(cache):
+    return md.MetadataResolver(ia=FakeIMDb(), cache=cache, workers=2, rate=1000)
+
+
+def test_lookups_cached(cache, make_media):
+    movie = make_media('Dr Strangelove.mkv')
+    first = resolver(cache)
+    assert first.cached(movie) is None
+    record = first.resolve(movie)
+    assert record.getID() == '0057012' and record.get('runtimes') == ['95']
+    assert first.cached(movie) == record
+
+    # Another resolver with the same cache doesn't go out to IMDb
+    second = resolver(cache)
+    assert second.resolve(movie) == record
+    assert second.ia.requests == []
+
+
+def test_only_fields_used_cached_as_json(cache, make_media):
+    resolver(cache).resolve(make_media('Dr Strangelove.mkv'))
+    (value,) = cache.execute("SELECT value FROM lookups WHERE kind = 'get_movie'")[0]
+    assert json.loads(value) == {'id': '0057012', 'kind': 'movie', 'title': 'Dr. Strangelove', 'year': 1964,
+                                 'runtimes': ['95']}
+
+
+def test_expired_purged_as_resolver_starts(cache):
+    cache.put('search_movie', 'old', None, ttl=-1)
+    resolver(cache)
+    assert cache.execute('SELECT COUNT(*) FROM lookups')[0][0] == 0
+
+
+def test_shows_fetched_as_episodes(cache, make_media):
+    show = make_media('Friends S01D1.mkv', cls=me.Show)
+    record = resolver(cache).resolve(show)
+    assert (record['kind'], record['series'], record['season'], record['episode']) == ('episode', 'Friends', 1, 1)
+
+
+def test_titles_not_found_cached(cache, make_media):
+    missing = make_media('Missing.mkv', title='Missing')
+    first, second = resolver(cache), resolver(cache)
+    assert first.resolve(missing) is None
+    assert second.resolve(missing) is None
+    assert len(first.ia.requests) == 1
+    assert second.ia.requests == []
+
+
+def test_cache_disabled(make_media):
+    movie = make_media('Dr Strangelove.mkv')
+    uncached = resolver(False)
+    assert uncached.cache is None
+    uncached.resolve(movie)
+    uncached.resolve(movie)
+    assert len(uncached.ia.requests) == 4
+    assert uncached.cached(movie) is None
+
+
+def test_resolve_all_reports_errors(cache, make_media):
+    movies = [make_media('Dr Strangelove.mkv'), make_media('Broken.mkv', title='Broken')]
+    failing = resolver(cache)
+    search = failing.ia.search_movie
+    failing.ia.search_movie = lambda title: search(title) if title != 'Broken' else 1 / 0
+    records, errors = failing.resolve_all(movies)
+    assert list(records) == [movies[0]] and records[movies[0]].getID() == '0057012'
+    assert list(errors) == [movies[1]] and isinstance(errors[movies[1]], ZeroDivisionError)
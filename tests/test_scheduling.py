@@ -0,0 +1,18 @@
+import pytest
+
+import decisions as dc
+import scheduling as sch
+
+
+@pytest.mark.parametrize('policy', list(sch.policies))
+def test_decisions_made_are_not_made_again(make_media, monkeypatch, policy):
+    media = [make_media(f'Movie {i}.mkv', duration=1000.0 * (3 - i)) for i in range(3)]
+    decisions = {m: dc.Decision(dc.REMUX, 'test') for m in media}
+
+    def decide(m):
+        raise AssertionError(f'{m.filename} decided again')
+    monkeypatch.setattr(dc, 'decide', decide)
+    queue = sch.order_jobs(media, policy, workers=2, decisions=decisions)
+    assert sorted(queue, key=media.index) == media
+    etas, batch_secs = sch.plan_etas(queue, 2, decisions)
+    assert batch_secs == max(secs for _, secs in etas)
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import convert_to as ct
+import segments as sg
+
+
+@pytest.fixture
+def movie(make_media):
+    return make_media('Blu-Ray/Movies/TO_CONVERT/Movie_t00.mkv', duration=6000.0)
+
+
+def encode(segments):
+    for segment in segments:
+        with open(segment.output, 'wb') as f:
+            f.write(b'segment')
+
+
+def test_folders_of_one_title(make_media, movie):
+    dvd = make_media('DVD/Movies/TO_CONVERT/Movie_t00.mkv', duration=6000.0)
+    assert sg.segment_folder(dvd) != sg.segment_folder(movie)
+    assert {os.path.dirname(s.output) for s in sg.plan_segments(dvd, 2)} == {sg.segment_folder(dvd)}
+
+
+def test_removed_when_one_fails(movie):
+    segments = sg.plan_segments(movie, 3)
+    encode(segments[:2])
+    assert ct.Handbrake().join_parts(movie, segments, 1) == 1
+    assert not os.path.exists(sg.segment_folder(movie))
+
+
+def test_leftovers_removed_when_split_again(movie):
+    encode(sg.plan_segments(movie, 3))
+    segments = sg.plan_segments(movie, 2)
+    assert os.listdir(sg.segment_folder(movie)) == []
+    assert [s.length for s in segments] == [3000.0, 3000.0]
+
+
+@pytest.mark.parametrize('durations, problems', [
+    ([2000.0, 2000.4, 1999.8], 0),
+    # A short and a long piece, that still add up to the length of the source
+    ([1990.0, 2010.0, 2000.0], 2),
+    # A short piece, and so a short title
+    ([2000.0, 2000.0, 1900.0], 2),
+])
+def test_each_segment_checked_against_its_range(movie, monkeypatch, durations, problems):
+    segments = sg.plan_segments(movie, 3)
+    lengths = dict(zip((s.output for s in segments), durations))
+    monkeypatch.setattr(sg, '_probe_streams', lambda file_: ({'video': 1, 'audio': 1}, lengths[file_],
+                                                             [('video', 0.0, lengths[file_]),
+                                                              ('audio', 0.0, lengths[file_])]))
+    assert len(sg.check_segments(segments)) == problems
+
+
+@pytest.mark.parametrize('audio, problems', [
+    ((0.02, 1999.98), 0),
+    # Starts late: the sound is out of sync from this segment on
+    ((0.5, 2000.0), 1),
+    # Runs short, leaving a gap
+    ((0.0, 1998.0), 1),
+    # Length not known (as with some containers)
+    ((0.0, None), 0),
+])
+def test_audio_checked_against_video(movie, monkeypatch, audio, problems):
+    segments = sg.plan_segments(movie, 3)
+    timing = {s.output: [('video', 0.0, 2000.0), ('audio', 0.0, 2000.0)] for s in segments}
+    timing[segments[1].output][1] = ('audio',) + audio
+    monkeypatch.setattr(sg, '_probe_streams', lambda file_: ({'video': 1, 'audio': 1}, 2000.0, timing[file_]))
+    assert len(sg.check_segments(segments)) == problems
@@ -0,0 +1,35 @@
+import concurrent.futures
+import os
+import shutil
+import threading
+
+import staging as stg
+
+
+def test_copy_fetched_again_outlives_the_one_released(tmp_path, monkeypatch):
+    source = tmp_path / 'source.mkv'
+    source.write_bytes(b'source')
+    prefetcher = stg.Prefetcher(str(tmp_path / 'prefetch'))
+    # The first copy is held up until the second is done (they aren't run one at a time here)
+    prefetcher._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    first, second_done = threading.Event(), threading.Event()
+
+    def copy_file(src, dst):
+        if not first.is_set():
+            first.set()
+            second_done.wait(5)
+        shutil.copyfile(src, dst)
+    monkeypatch.setattr(stg, 'copy_file', copy_file)
+
+    # Released (its job failed) while still copying, then fetched again for the retry
+    prefetcher.fetch(str(source))
+    assert first.wait(5)
+    prefetcher.release(str(source))
+    prefetcher.fetch(str(source))
+    prefetcher._copies[str(source)].result(5)
+    second_done.set()
+    prefetcher._pool.shutdown(wait=True)
+
+    copy = prefetcher.local(str(source))
+    assert copy != str(source)
+    assert os.listdir(tmp_path / 'prefetch') == [os.path.basename(copy)]
@@ -0,0 +1,36 @@
+import pytest
+
+import presets as ps
+import tracks as tr
+
+STREAMS = [
+    {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080},
+    {'index': 1, 'codec_type': 'audio', 'codec_name': 'ac3', 'tags': {'language': 'eng'}},
+    {'index': 2, 'codec_type': 'audio', 'codec_name': 'ac3', 'tags': {'language': 'fre'}},
+    {'index': 3, 'codec_type': 'subtitle', 'codec_name': 'hdmv_pgs_subtitle', 'tags': {'language': 'eng'}},
+    {'index': 4, 'codec_type': 'subtitle', 'codec_name': 'hdmv_pgs_subtitle', 'tags': {'language': 'fre'}},
+    {'index': 5, 'codec_type': 'subtitle', 'codec_name': 'hdmv_pgs_subtitle', 'tags': {'language': 'fre'},
+     'disposition': {'forced': 1}},
+]
+
+
+def select(make_media, monkeypatch, **preset):
+    settings = dict({'AudioCopyMask': ['copy:ac3'], 'SubtitleAddForeignAudioSearch': False,
+                     'SubtitleBurnBehavior': 'none'}, **preset)
+    monkeypatch.setattr(ps, 'find_preset', lambda name: ps.Preset(name, '', settings))
+    return tr.select_tracks(make_media('movie.mkv', streams=STREAMS), 'test').cli_args()
+
+
+def test_forced_subtitles_kept(make_media, monkeypatch):
+    assert select(make_media, monkeypatch) == '--audio 1 --aencoder copy:ac3 --subtitle 1,3'
+
+
+@pytest.mark.parametrize('scan, burn, args', [
+    (True, 'none', '--subtitle scan,1,3 --subtitle-forced=1'),
+    (True, 'foreign', '--subtitle scan,1,3 --subtitle-forced=1 --subtitle-burned=1'),
+    (False, 'foreign', '--subtitle 1,3'),
+    (False, 'first', '--subtitle 1,3 --subtitle-burned=1'),
+])
+def test_preset_scan_and_burn_in_kept(make_media, monkeypatch, scan, burn, args):
+    assert select(make_media, monkeypatch, SubtitleAddForeignAudioSearch=scan,
+                  SubtitleBurnBehavior=burn).endswith(args)